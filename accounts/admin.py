@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import UserProfile
+from .models import Friendship, UserProfile
 
 
 @admin.register(UserProfile)
@@ -20,3 +20,12 @@ class UserProfileAdmin(admin.ModelAdmin):
             'fields': ('is_email_verified', 'created_at', 'updated_at')
         }),
     )
+
+
+@admin.register(Friendship)
+class FriendshipAdmin(admin.ModelAdmin):
+    list_display = ('from_user', 'to_user', 'status', 'created_at')
+    list_filter = ('status',)
+    search_fields = ('from_user__username', 'to_user__username')
+    raw_id_fields = ('from_user', 'to_user')
+    readonly_fields = ('created_at', 'updated_at')
@@ -0,0 +1,39 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.db import transaction
+
+from photoalbum.instrumentation import record_cache
+
+# Bounded so a worker that missed an invalidation (per-process cache) catches up
+USER_CACHE_TIMEOUT = 5 * 60
+
+
+def _user_key(user_id):
+    return f'auth_user:{user_id}'
+
+
+def invalidate_cached_user(user_id):
+    transaction.on_commit(lambda: cache.delete(_user_key(user_id)))
+
+
+class CachedModelBackend(ModelBackend):
+    """``ModelBackend`` that serves ``request.user`` (and its profile) from the cache.
+
+    The user is cached with its ``profile`` already joined, so templates
+    showing the avatar do not query either. Saving or deleting the user or
+    its profile drops the entry (see accounts/models.py).
+    """
+
+    def get_user(self, user_id):
+        key = _user_key(user_id)
+        user = cache.get(key)
+        record_cache('auth_user', user is not None)
+        if user is None:
+            UserModel = get_user_model()
+            try:
+                user = UserModel._default_manager.select_related('profile').get(pk=user_id)
+            except UserModel.DoesNotExist:
+                return None
+            cache.set(key, user, USER_CACHE_TIMEOUT)
+        return user if self.user_can_authenticate(user) else None
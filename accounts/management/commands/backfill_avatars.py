@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from accounts.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Generate the square avatar renditions for profiles uploaded before they existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Regenerate profiles that already have renditions')
+
+    def handle(self, *args, **options):
+        profiles = UserProfile.objects.exclude(avatar='').exclude(avatar__isnull=True).order_by('pk')
+        if not options['all']:
+            profiles = profiles.filter(avatar_small__isnull=True)
+
+        updated = 0
+        for profile in profiles.iterator(chunk_size=200):
+            profile.generate_avatar_renditions()
+            updated += 1
+            if updated % 100 == 0:
+                self.stdout.write(f'Processed {updated} profiles (last id {profile.pk})')
+
+        self.stdout.write(self.style.SUCCESS(f'Updated {updated} profiles.'))
@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-19 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_friendship'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='avatar_large',
+            field=models.ImageField(blank=True, editable=False, help_text='256x256 WebP', null=True, upload_to='avatars/renditions/%Y/%m/%d/'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='avatar_medium',
+            field=models.ImageField(blank=True, editable=False, help_text='64x64 WebP', null=True, upload_to='avatars/renditions/%Y/%m/%d/'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='avatar_small',
+            field=models.ImageField(blank=True, editable=False, help_text='32x32 WebP', null=True, upload_to='avatars/renditions/%Y/%m/%d/'),
+        ),
+    ]
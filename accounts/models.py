@@ -1,8 +1,35 @@
-from django.db import models
+import logging
+import os
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import models, transaction
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.core.validators import FileExtensionValidator
 from PIL import Image
 
+from photoalbum.instrumentation import image_stage, record_cache
+from photos import imaging
+from photos.storage_gc import schedule_file_deletion
+
+from .backends import invalidate_cached_user
+
+logger = logging.getLogger(__name__)
+
+
+# Square avatar renditions: navbar / byline / profile page
+AVATAR_RENDITIONS = {
+    'avatar_small': 32,
+    'avatar_medium': 64,
+    'avatar_large': 256,
+}
+
+
+def _rendition_field(size):
+    return models.ImageField(upload_to='avatars/renditions/%Y/%m/%d/', blank=True, null=True,
+                             editable=False, help_text=f'{size}x{size} WebP')
+
 
 class UserProfile(models.Model):
     """Extend Django User model with additional profile information"""
@@ -14,6 +41,9 @@ class UserProfile(models.Model):
         null=True,
         validators=[FileExtensionValidator(allowed_extensions=['jpg', 'jpeg', 'png', 'gif', 'webp'])]
     )
+    avatar_small = _rendition_field(AVATAR_RENDITIONS['avatar_small'])
+    avatar_medium = _rendition_field(AVATAR_RENDITIONS['avatar_medium'])
+    avatar_large = _rendition_field(AVATAR_RENDITIONS['avatar_large'])
     location = models.CharField(max_length=100, blank=True, default='')
     birth_date = models.DateField(null=True, blank=True)
     website = models.URLField(blank=True, default='')
@@ -33,23 +63,186 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"{self.user.username}'s Profile"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored avatar so a replaced file can be removed
+        instance._loaded_avatar = instance.__dict__.get('avatar')
+        return instance
+
     def save(self, *args, **kwargs):
-        """Override save to optimize avatar image"""
+        """Save, regenerating the avatar renditions only when the avatar changed"""
         super().save(*args, **kwargs)
-        
-        # Optimize avatar image if it exists
+
+        previous = getattr(self, '_loaded_avatar', None)
+        current = self.avatar.name if self.avatar else None
+        if previous != current:
+            self.generate_avatar_renditions()
+            if previous:
+                schedule_file_deletion([previous])
+        self._loaded_avatar = current
+
+    def generate_avatar_renditions(self):
+        """(Re)write square WebP renditions of the avatar (works with cloud storage)"""
+        stale = [getattr(self, field).name for field in AVATAR_RENDITIONS]
+        for field in AVATAR_RENDITIONS:
+            setattr(self, field, None)
         if self.avatar:
-            img = Image.open(self.avatar.path)
-            
-            # Resize image if too large
-            if img.height > 300 or img.width > 300:
-                output_size = (300, 300)
-                img.thumbnail(output_size)
-                img.save(self.avatar.path)
+            try:
+                with image_stage('decode'), self.avatar.storage.open(self.avatar.name, 'rb') as f:
+                    img = Image.open(f)
+                    img.load()
+                base = os.path.splitext(os.path.basename(self.avatar.name))[0]
+                for field, size in AVATAR_RENDITIONS.items():
+                    with image_stage('encode'):
+                        data = imaging.square_webp(img, size)
+                    with image_stage('storage_write'):
+                        getattr(self, field).save(f'{base}_{size}.webp', ContentFile(data), save=False)
+            except Exception:
+                logger.exception('Error generating avatar renditions for profile %s', self.pk)
+        super().save(update_fields=list(AVATAR_RENDITIONS))
+        # Only once the row stops referencing them (the job re-checks)
+        schedule_file_deletion(stale)
+
+    def _avatar_url(self, field):
+        """URL of a rendition, falling back to the original until it exists"""
+        rendition = getattr(self, field)
+        if rendition:
+            return rendition.url
+        return self.avatar.url if self.avatar else ''
+
+    @property
+    def avatar_small_url(self):
+        return self._avatar_url('avatar_small')
+
+    @property
+    def avatar_medium_url(self):
+        return self._avatar_url('avatar_medium')
+
+    @property
+    def avatar_large_url(self):
+        return self._avatar_url('avatar_large')
+
+
+# Short enough to bound staleness when workers do not share a cache backend
+FRIEND_IDS_CACHE_TIMEOUT = 5 * 60
+
+
+def _friend_ids_key(user_id):
+    return f'friend_ids:{user_id}'
+
+
+class FriendshipManager(models.Manager):
+    def friend_ids(self, user_id):
+        """Ids of the user's accepted friends, cached until the graph changes"""
+        key = _friend_ids_key(user_id)
+        ids = cache.get(key)
+        record_cache('friend_ids', ids is not None)
+        if ids is None:
+            ids = frozenset(self.filter(from_user_id=user_id, status=Friendship.ACCEPTED)
+                            .values_list('to_user_id', flat=True))
+            cache.set(key, ids, FRIEND_IDS_CACHE_TIMEOUT)
+        return ids
+
+    def between(self, user_id, other_id):
+        """The ``from user -> other`` edge, or ``None``"""
+        return self.filter(from_user_id=user_id, to_user_id=other_id).first()
+
+    @transaction.atomic
+    def send_request(self, from_user, to_user):
+        """Ask ``to_user`` to be friends, or accept a pending reverse request"""
+        if from_user.pk == to_user.pk:
+            raise ValueError('Cannot befriend yourself')
+        reverse = self.select_for_update().filter(from_user=to_user, to_user=from_user).first()
+        if reverse and reverse.status == Friendship.BLOCKED:
+            return None
+        if reverse and reverse.status == Friendship.PENDING:
+            return self.accept(to_user, from_user)
+        edge, _ = self.get_or_create(from_user=from_user, to_user=to_user,
+                                     defaults={'status': Friendship.PENDING})
+        return edge
+
+    @transaction.atomic
+    def accept(self, from_user, to_user):
+        """Accept ``from_user``'s pending request to ``to_user``"""
+        updated = self.filter(from_user=from_user, to_user=to_user,
+                              status=Friendship.PENDING).update(status=Friendship.ACCEPTED,
+                                                                updated_at=timezone.now())
+        if not updated:
+            return None
+        # Accepted friendships are stored as two edges so visibility checks
+        # only ever look up (owner -> viewer)
+        edge, _ = self.update_or_create(from_user=to_user, to_user=from_user,
+                                        defaults={'status': Friendship.ACCEPTED})
+        _invalidate_friend_ids(from_user.pk, to_user.pk)
+        return edge
+
+    @transaction.atomic
+    def remove(self, user, other):
+        """Unfriend, cancel or decline between the two users (blocks are kept)"""
+        self.filter(
+            models.Q(from_user=user, to_user=other) | models.Q(from_user=other, to_user=user)
+        ).exclude(status=Friendship.BLOCKED).delete()
+        _invalidate_friend_ids(user.pk, other.pk)
+
+    @transaction.atomic
+    def block(self, user, other):
+        """Block ``other``: drops any friendship and refuses future requests"""
+        self.filter(from_user=other, to_user=user).delete()
+        edge, _ = self.update_or_create(from_user=user, to_user=other,
+                                        defaults={'status': Friendship.BLOCKED})
+        _invalidate_friend_ids(user.pk, other.pk)
+        return edge
+
+    def unblock(self, user, other):
+        self.filter(from_user=user, to_user=other, status=Friendship.BLOCKED).delete()
+
+
+def _invalidate_friend_ids(*user_ids):
+    transaction.on_commit(lambda: cache.delete_many([_friend_ids_key(pk) for pk in user_ids]))
+
+
+class Friendship(models.Model):
+    """Directed edge in the friends graph.
+
+    A request is a single pending ``from_user -> to_user`` edge; accepting it
+    stores an accepted edge in both directions.
+    """
+    PENDING = 'pending'
+    ACCEPTED = 'accepted'
+    BLOCKED = 'blocked'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (ACCEPTED, 'Accepted'),
+        (BLOCKED, 'Blocked'),
+    ]
+
+    from_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='friendships')
+    to_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = FriendshipManager()
+
+    class Meta:
+        verbose_name = 'Friendship'
+        verbose_name_plural = 'Friendships'
+        constraints = [
+            models.UniqueConstraint(fields=['from_user', 'to_user'], name='unique_friendship_edge'),
+        ]
+        indexes = [
+            # Serves the visibility EXISTS lookup (owner -> viewer, accepted)
+            models.Index(fields=['from_user', 'to_user', 'status']),
+            models.Index(fields=['to_user', 'status']),
+        ]
+
+    def __str__(self):
+        return f'{self.from_user_id} -> {self.to_user_id} ({self.status})'
 
 
 # Signal to create profile when user is created
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 
@@ -60,7 +253,20 @@ def create_user_profile(sender, instance, created, **kwargs):
         UserProfile.objects.create(user=instance)
 
 
-@receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    """Automatically save the UserProfile when the User is saved"""
-    instance.profile.save()
+@receiver([post_save, post_delete], sender=User)
+@receiver([post_save, post_delete], sender=UserProfile)
+def drop_cached_user(sender, instance, **kwargs):
+    """Drop the user cached by ``CachedModelBackend``"""
+    invalidate_cached_user(instance.pk if sender is User else instance.user_id)
+
+
+@receiver(post_delete, sender=UserProfile)
+def delete_user_profile_avatar(sender, instance, **kwargs):
+    """Remove the avatar and its renditions once the profile deletion commits"""
+    schedule_file_deletion(getattr(instance, field).name for field in ('avatar', *AVATAR_RENDITIONS))
+
+
+@receiver([post_save, post_delete], sender=Friendship)
+def invalidate_friend_ids(sender, instance, **kwargs):
+    """Keep cached friend sets in step with edits made outside the manager"""
+    _invalidate_friend_ids(instance.from_user_id, instance.to_user_id)
@@ -0,0 +1,110 @@
+"""Cache-first sessions with write-behind to the database.
+
+Reads are served from the cache and fall back to the ``django_session`` row,
+as with Django's ``cached_db`` engine. Saves update the cache immediately;
+the database copy is written by a background thread every
+``SESSION_WRITE_BEHIND_SECONDS``, coalescing any number of saves of the same
+session into one upsert. Creating a session and logging in or out still write
+through, so an evicted cache entry can never log a user in or out.
+
+Write-behind needs a cache shared by all workers (``CACHE_URL``); with the
+per-process default the setting is 0 and every save writes through.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.db import connections, router
+
+logger = logging.getLogger(__name__)
+
+AUTH_KEYS = (SESSION_KEY, BACKEND_SESSION_KEY, HASH_SESSION_KEY)
+
+
+class _WriteBehindBuffer:
+    def __init__(self):
+        self._dirty = {}              # session_key -> expire_date
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def add(self, session_key, expire_date):
+        with self._lock:
+            self._dirty[session_key] = expire_date
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='session-write-behind', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def discard(self, session_key):
+        # Wait for an in-flight flush so it cannot re-insert a deleted session
+        with self._flush_lock, self._lock:
+            self._dirty.pop(session_key, None)
+
+    def flush(self):
+        """Upsert every dirty session still present in the cache"""
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return 0
+            store = SessionStore()
+            model = store.model
+            keys = {store.cache_key_prefix + key: key for key in dirty}
+            cached = store._cache.get_many(keys)
+            rows = [
+                model(session_key=keys[cache_key], session_data=store.encode(data),
+                      expire_date=dirty[keys[cache_key]])
+                for cache_key, data in cached.items()
+            ]
+            db = router.db_for_write(model)
+            try:
+                model.objects.using(db).bulk_create(
+                    rows, update_conflicts=True, unique_fields=['session_key'],
+                    update_fields=['session_data', 'expire_date'],
+                )
+            finally:
+                connections[db].close()
+            return len(rows)
+
+    def _run(self):
+        while True:
+            time.sleep(settings.SESSION_WRITE_BEHIND_SECONDS)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Session write-behind flush failed')
+
+
+write_behind = _WriteBehindBuffer()
+
+
+class SessionStore(CachedDBStore):
+    def load(self):
+        data = super().load()
+        self._loaded_auth = _auth_fields(data)
+        return data
+
+    def save(self, must_create=False):
+        delay = getattr(settings, 'SESSION_WRITE_BEHIND_SECONDS', 0)
+        if (must_create or not delay or self.session_key is None
+                or getattr(self, '_loaded_auth', None) != _auth_fields(self._get_session())):
+            super().save(must_create)
+            self._loaded_auth = _auth_fields(self._session)
+            return
+        self._cache.set(self.cache_key, self._session, self.get_expiry_age())
+        write_behind.add(self.session_key, self.get_expiry_date())
+
+    def delete(self, session_key=None):
+        key = session_key or self.session_key
+        if key:
+            write_behind.discard(key)
+        super().delete(session_key)
+
+
+def _auth_fields(data):
+    return tuple(data.get(key) for key in AUTH_KEYS)
@@ -1,3 +1,154 @@
-from django.test import TestCase
+import io
+import shutil
+import tempfile
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from photos.models import Photo
+
+from .backends import CachedModelBackend
+from .models import AVATAR_RENDITIONS, Friendship
+
+
+class FriendshipTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+
+    def befriend(self):
+        Friendship.objects.send_request(self.alice, self.bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.send_request(self.bob, self.alice)  # accepts the pending request
+
+    def test_request_then_accept_stores_both_edges(self):
+        edge = Friendship.objects.send_request(self.alice, self.bob)
+        self.assertEqual(edge.status, Friendship.PENDING)
+        self.assertEqual(Friendship.objects.friend_ids(self.alice.pk), frozenset())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.accept(self.alice, self.bob)
+        self.assertEqual(Friendship.objects.friend_ids(self.alice.pk), {self.bob.pk})
+        self.assertEqual(Friendship.objects.friend_ids(self.bob.pk), {self.alice.pk})
+
+    def test_crossing_requests_become_friends(self):
+        self.befriend()
+        self.assertEqual(Friendship.objects.filter(status=Friendship.ACCEPTED).count(), 2)
+
+    def test_cannot_befriend_yourself(self):
+        with self.assertRaises(ValueError):
+            Friendship.objects.send_request(self.alice, self.alice)
+
+    def test_remove_invalidates_friend_ids(self):
+        self.befriend()
+        self.assertEqual(Friendship.objects.friend_ids(self.alice.pk), {self.bob.pk})
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.remove(self.bob, self.alice)
+        self.assertEqual(Friendship.objects.friend_ids(self.alice.pk), frozenset())
+
+    def test_block_refuses_requests(self):
+        self.befriend()
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.block(self.alice, self.bob)
+        self.assertIsNone(Friendship.objects.send_request(self.bob, self.alice))
+        self.assertEqual(Friendship.objects.friend_ids(self.bob.pk), frozenset())
+
+        Friendship.objects.unblock(self.alice, self.bob)
+        self.assertEqual(Friendship.objects.send_request(self.bob, self.alice).status, Friendship.PENDING)
+
+    def test_friends_only_photos(self):
+        photo = Photo.objects.create(owner=self.alice, title='friends', privacy='friends')
+        carol = User.objects.create_user('carol')
+        self.befriend()
+        for viewer, visible in ((self.alice, True), (self.bob, True), (carol, False)):
+            with self.subTest(viewer=viewer.username):
+                self.assertEqual(Photo.objects.visible_to(viewer).filter(pk=photo.pk).exists(), visible)
+                self.assertEqual(photo.is_visible_to(viewer), visible)
+
+
+class CachedUserTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice')
+        self.backend = CachedModelBackend()
+
+    def test_user_and_profile_come_from_the_cache(self):
+        self.backend.get_user(self.user.pk)
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+            self.assertEqual(user.profile.user_id, self.user.pk)
+
+    def test_profile_save_invalidates(self):
+        self.backend.get_user(self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.profile.bio = 'hello'
+            self.user.profile.save()
+        self.assertEqual(self.backend.get_user(self.user.pk).profile.bio, 'hello')
+
+    def test_inactive_user_is_refused(self):
+        self.backend.get_user(self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_missing_user(self):
+        self.assertIsNone(self.backend.get_user(self.user.pk + 1000))
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class SessionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_user('alice', password='secret')
+
+    @override_settings(SESSION_WRITE_BEHIND_SECONDS=60)
+    def test_login_and_logout_write_through(self):
+        response = self.client.post(reverse('accounts:login'), {'username': 'alice', 'password': 'secret'})
+        self.assertEqual(response.status_code, 302)
+        key = self.client.session.session_key
+        self.assertTrue(Session.objects.filter(session_key=key).exists())
+
+        self.client.post(reverse('accounts:logout'))
+        self.assertFalse(Session.objects.filter(session_key=key).exists())
+
+
+class AvatarTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.profile = User.objects.create_user('alice').profile
+
+    def set_avatar(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (300, 200), (10, 120, 200)).save(buffer, 'PNG')
+        self.profile.avatar = SimpleUploadedFile('avatar.png', buffer.getvalue(), content_type='image/png')
+        self.profile.save()
+
+    def test_renditions_are_square_webp(self):
+        self.set_avatar()
+        for field, size in AVATAR_RENDITIONS.items():
+            with self.subTest(field=field), getattr(self.profile, field).open('rb') as f:
+                img = Image.open(f)
+                self.assertEqual((img.format, img.size), ('WEBP', (size, size)))
+        self.assertEqual(self.profile.avatar_small_url, self.profile.avatar_small.url)
+
+    def test_unchanged_avatar_is_not_reprocessed(self):
+        self.set_avatar()
+        names = [getattr(self.profile, field).name for field in AVATAR_RENDITIONS]
+        self.profile.bio = 'hello'
+        self.profile.save()
+        self.profile.refresh_from_db()
+        self.assertEqual([getattr(self.profile, field).name for field in AVATAR_RENDITIONS], names)
+
+    def test_urls_without_an_avatar(self):
+        self.assertEqual(self.profile.avatar_large_url, '')
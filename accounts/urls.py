@@ -9,4 +9,10 @@ urlpatterns = [
     path('logout/', views.logout_view, name='logout'),
     path('profile/<int:user_id>/', views.profile_view, name='profile'),
     path('profile/edit/', views.profile_edit, name='profile_edit'),
+    path('friends/', views.friends, name='friends'),
+    path('friends/<int:user_id>/request/', views.friend_action, {'action': 'request'}, name='friend_request'),
+    path('friends/<int:user_id>/accept/', views.friend_action, {'action': 'accept'}, name='friend_accept'),
+    path('friends/<int:user_id>/remove/', views.friend_action, {'action': 'remove'}, name='friend_remove'),
+    path('friends/<int:user_id>/block/', views.friend_action, {'action': 'block'}, name='friend_block'),
+    path('friends/<int:user_id>/unblock/', views.friend_action, {'action': 'unblock'}, name='friend_unblock'),
 ]
@@ -3,7 +3,10 @@ from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from .models import UserProfile
+from django.utils.http import url_has_allowed_host_and_scheme
+from django.views.decorators.http import require_POST
+from photos.models import Photo
+from .models import Friendship, UserProfile
 from .forms import UserRegistrationForm, UserProfileForm
 
 
@@ -53,13 +56,20 @@ def profile_view(request, user_id):
     """View user profile"""
     user = get_object_or_404(User, pk=user_id)
     profile = user.profile
-    photos = user.photos.filter(privacy='public').order_by('-created_at')
+    photos = Photo.objects.visible_to(request.user).filter(owner=user).order_by('-created_at')
+
+    friendship = incoming = None
+    if request.user.is_authenticated and request.user != user:
+        friendship = Friendship.objects.between(request.user.pk, user.pk)
+        incoming = Friendship.objects.between(user.pk, request.user.pk)
     
     context = {
         'user': user,
         'profile': profile,
         'photos': photos,
         'photo_count': user.photos.count(),
+        'friendship': friendship,
+        'incoming_request': incoming if incoming and incoming.status == Friendship.PENDING else None,
     }
     
     return render(request, 'accounts/profile.html', context)
@@ -84,3 +94,52 @@ def profile_edit(request):
         form = UserProfileForm(instance=profile)
     
     return render(request, 'accounts/profile_edit.html', {'form': form})
+
+
+@login_required(login_url='accounts:login')
+def friends(request):
+    """List friends and pending friend requests"""
+    edges = Friendship.objects.select_related('to_user__profile')
+    context = {
+        'friends': edges.filter(from_user=request.user, status=Friendship.ACCEPTED),
+        'incoming': Friendship.objects.select_related('from_user__profile').filter(
+            to_user=request.user, status=Friendship.PENDING),
+        'outgoing': edges.filter(from_user=request.user, status=Friendship.PENDING),
+    }
+    return render(request, 'accounts/friends.html', context)
+
+
+@login_required(login_url='accounts:login')
+@require_POST
+def friend_action(request, user_id, action):
+    """Send, accept, remove (unfriend/decline/cancel), block or unblock"""
+    other = get_object_or_404(User, pk=user_id)
+    if other == request.user:
+        messages.error(request, '無法對自己進行此操作。')
+        return redirect('accounts:profile', user_id=user_id)
+
+    if action == 'request':
+        edge = Friendship.objects.send_request(request.user, other)
+        if edge is None:
+            messages.error(request, '無法向此用戶發送好友邀請。')
+        elif edge.status == Friendship.ACCEPTED:
+            messages.success(request, f'您與 {other.username} 已成為好友。')
+        elif edge.status == Friendship.PENDING:
+            messages.success(request, '好友邀請已送出。')
+    elif action == 'accept':
+        if Friendship.objects.accept(other, request.user):
+            messages.success(request, f'您與 {other.username} 已成為好友。')
+    elif action == 'remove':
+        Friendship.objects.remove(request.user, other)
+        messages.success(request, '已移除好友關係。')
+    elif action == 'block':
+        Friendship.objects.block(request.user, other)
+        messages.success(request, f'已封鎖 {other.username}。')
+    elif action == 'unblock':
+        Friendship.objects.unblock(request.user, other)
+        messages.success(request, f'已解除封鎖 {other.username}。')
+
+    next_url = request.POST.get('next')
+    if next_url and url_has_allowed_host_and_scheme(next_url, {request.get_host()}, request.is_secure()):
+        return redirect(next_url)
+    return redirect('accounts:friends')
@@ -10,5 +10,15 @@ python manage.py migrate --noinput || echo "migrate failed or DB not ready"
 # Collect static files
 python manage.py collectstatic --noinput || echo "collectstatic failed"
 
-# Start gunicorn
-exec gunicorn photoalbum.wsgi:application --bind 0.0.0.0:8080 --workers 2
+# Background job worker (media deletion, feed fan-out, admin bulk actions).
+# Set RUN_JOBS_WORKER=0 when a separate worker service processes the queue;
+# on Cloud Run it needs CPU allocated outside requests.
+if [ "${RUN_JOBS_WORKER:-1}" != "0" ]; then
+    python manage.py run_jobs --loop &
+fi
+
+# Start gunicorn with ASGI (uvicorn) workers so async views can overlap storage I/O
+exec gunicorn photoalbum.asgi:application \
+    --worker-class uvicorn.workers.UvicornWorker \
+    --bind 0.0.0.0:8080 \
+    --workers ${WEB_CONCURRENCY:-2}
@@ -0,0 +1,7 @@
+from django.db.backends.sqlite3 import base
+
+from photoalbum.db.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    """SQLite backend that borrows connections from a process-wide pool (for local testing)"""
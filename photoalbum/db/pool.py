@@ -0,0 +1,240 @@
+"""Process-wide database connection pool used by the pooled backends.
+
+Django opens a connection per thread and, with ``CONN_MAX_AGE``, keeps it for
+the thread's lifetime, so connections grow with worker concurrency. The
+pooled backends (``photoalbum.db.backends.*``) run with ``CONN_MAX_AGE=0``:
+Django "closes" its connection at the end of every request, which hands it
+back to this pool, and concurrency above ``MAX_SIZE`` waits for a free
+connection instead of opening new ones.
+
+* ``MIN_SIZE`` connections are kept open once created.
+* A connection idle for longer than ``CHECK_IDLE_SECONDS`` is pinged before
+  it is handed out; broken ones are discarded and replaced transparently.
+* Connections are retired after ``MAX_LIFETIME`` seconds (with jitter, so a
+  pool created at once does not reconnect at once) or ``MAX_IDLE`` idle.
+* Waiting longer than ``TIMEOUT`` raises ``PoolTimeout``.
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from django.db import OperationalError
+
+from photoalbum.instrumentation import Counter, Histogram, register
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MIN_SIZE': 2,
+    'MAX_SIZE': 10,
+    'TIMEOUT': 10.0,
+    'MAX_LIFETIME': 1800.0,
+    'MAX_IDLE': 600.0,
+    'CHECK_IDLE_SECONDS': 5.0,
+}
+LIFETIME_JITTER = 0.1
+
+WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+POOL_WAIT_SECONDS = register(Histogram(
+    'db_pool_wait_seconds', 'Time spent waiting to check out a pooled connection.', WAIT_BUCKETS))
+POOL_EVENTS = register(Counter(
+    'db_pool_events_total', 'Pooled connection lifecycle events (opened, closed, broken, timeout).'))
+
+
+class PoolTimeout(OperationalError):
+    """No connection became available within the pool timeout"""
+
+
+class _Pooled:
+    __slots__ = ('connection', 'created_at', 'expires_at', 'returned_at')
+
+    def __init__(self, connection, max_lifetime):
+        now = time.monotonic()
+        self.connection = connection
+        self.created_at = now
+        self.expires_at = now + max_lifetime * (1 - LIFETIME_JITTER * random.random())
+        self.returned_at = now
+
+
+class ConnectionPool:
+    def __init__(self, alias, ping, close, **options):
+        self.alias = alias
+        self._ping = ping
+        self._close = close
+        config = {**DEFAULTS, **{key.upper(): value for key, value in options.items()}}
+        self.min_size = int(config['MIN_SIZE'])
+        self.max_size = int(config['MAX_SIZE'])
+        self.timeout = float(config['TIMEOUT'])
+        self.max_lifetime = float(config['MAX_LIFETIME'])
+        self.max_idle = float(config['MAX_IDLE'])
+        self.check_idle = float(config['CHECK_IDLE_SECONDS'])
+
+        self._idle = deque()   # most recently returned on the right
+        self._in_use = {}      # id(connection) -> _Pooled
+        self._opening = 0
+        self._cond = threading.Condition()
+
+    @property
+    def size(self):
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def stats(self):
+        with self._cond:
+            return {'idle': len(self._idle), 'in_use': len(self._in_use), 'max_size': self.max_size}
+
+    def getconn(self, connect):
+        """Check out an idle connection, or open one with ``connect()``"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        while True:
+            pooled = self._acquire(deadline)
+            if pooled is None:
+                pooled = self._open(connect)
+            elif not self._healthy(pooled):
+                self._discard(pooled, 'broken')
+                continue
+            with self._cond:
+                self._in_use[id(pooled.connection)] = pooled
+            POOL_WAIT_SECONDS.observe(time.monotonic() - started, alias=self.alias)
+            return pooled.connection
+
+    def putconn(self, connection, broken=False):
+        with self._cond:
+            pooled = self._in_use.pop(id(connection), None)
+        if pooled is None:
+            self._close_quietly(connection)
+            return
+        now = time.monotonic()
+        if broken or now >= pooled.expires_at:
+            self._discard(pooled, 'broken' if broken else 'expired')
+            return
+        pooled.returned_at = now
+        with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+        for pooled in idle:
+            self._close_quietly(pooled.connection)
+
+    def _acquire(self, deadline):
+        """Pop an idle connection, or reserve a slot to open one (returns None)"""
+        with self._cond:
+            while True:
+                self._retire_idle()
+                if self._idle:
+                    return self._idle.pop()
+                if self.size < self.max_size:
+                    self._opening += 1
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    POOL_EVENTS.inc(alias=self.alias, event='timeout')
+                    raise PoolTimeout(
+                        f'No connection available in the "{self.alias}" pool after {self.timeout:.1f}s '
+                        f'(max size {self.max_size})'
+                    )
+                self._cond.wait(remaining)
+
+    def _open(self, connect):
+        try:
+            connection = connect()
+        except Exception:
+            with self._cond:
+                self._opening -= 1
+                self._cond.notify()
+            raise
+        POOL_EVENTS.inc(alias=self.alias, event='opened')
+        with self._cond:
+            self._opening -= 1
+        return _Pooled(connection, self.max_lifetime)
+
+    def _healthy(self, pooled):
+        now = time.monotonic()
+        if now >= pooled.expires_at:
+            return False
+        if now - pooled.returned_at < self.check_idle:
+            return True
+        try:
+            self._ping(pooled.connection)
+        except Exception:
+            logger.warning('Discarding broken pooled connection for "%s"', self.alias)
+            return False
+        return True
+
+    def _retire_idle(self):
+        """Close connections idle past MAX_IDLE while above MIN_SIZE (lock held)"""
+        now = time.monotonic()
+        while self._idle and self.size > self.min_size and now - self._idle[0].returned_at > self.max_idle:
+            self._close_quietly(self._idle.popleft().connection)
+            POOL_EVENTS.inc(alias=self.alias, event='closed')
+
+    def _discard(self, pooled, reason):
+        POOL_EVENTS.inc(alias=self.alias, event=reason)
+        self._close_quietly(pooled.connection)
+        with self._cond:
+            self._cond.notify()
+
+    def _close_quietly(self, connection):
+        try:
+            self._close(connection)
+        except Exception:
+            pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, factory):
+    """The process-wide pool for a database alias, created by ``factory()``"""
+    pool = _pools.get(alias)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(alias)
+            if pool is None:
+                pool = _pools[alias] = factory()
+    return pool
+
+
+class PooledDatabaseWrapperMixin:
+    """Make a Django ``DatabaseWrapper`` borrow its connections from a pool.
+
+    Pool settings come from the ``POOL`` entry of the database's settings.
+    """
+
+    def _pool(self):
+        return get_pool(self.alias, lambda: ConnectionPool(
+            self.alias,
+            ping=_ping_connection,
+            close=lambda connection: connection.close(),
+            **self.settings_dict.get('POOL', {}),
+        ))
+
+    def get_new_connection(self, conn_params):
+        return self._pool().getconn(lambda: super(PooledDatabaseWrapperMixin, self).get_new_connection(conn_params))
+
+    def _close(self):
+        if self.connection is None:
+            return
+        connection, broken = self.connection, False
+        try:
+            # Never hand out a connection inside a transaction
+            if not self.get_autocommit() or self.in_atomic_block:
+                connection.rollback()
+        except Exception:
+            broken = True
+        self._pool().putconn(connection, broken=broken or (self.errors_occurred and not self.is_usable()))
+
+
+def _ping_connection(connection):
+    cursor = connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    finally:
+        cursor.close()
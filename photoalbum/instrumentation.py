@@ -0,0 +1,321 @@
+"""Per-request performance instrumentation.
+
+``PerformanceMiddleware`` times every request and, for a sampled fraction of
+them (``PERF_SAMPLE_RATE``), also collects SQL, template, cache and image
+pipeline timings. Sampled requests get a ``Server-Timing`` header, and every
+request feeds the in-process Prometheus histograms served by
+``metrics_view``. Unsampled requests cost two clock reads and one histogram
+update; the SQL wrapper and the other hooks return immediately for them.
+
+Metrics are kept per process, so each gunicorn worker exposes its own series.
+"""
+import logging
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template.backends.django import DjangoTemplates
+
+logger = logging.getLogger('photoalbum.performance')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+TOP_QUERIES = 5
+
+_current = ContextVar('request_stats', default=None)
+
+
+# --------------------------------------------------------------------------
+# Metric registry
+# --------------------------------------------------------------------------
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{self.name}_bucket{_labels(key + (("le", le),))} {cumulative}')
+                lines.append(f'{self.name}_sum{_labels(key)} {total}')
+                lines.append(f'{self.name}_count{_labels(key)} {count}')
+        return lines
+
+
+def _labels(items):
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in items) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Request latency by view.')
+REQUEST_QUERIES = Histogram('http_request_sql_queries', 'SQL queries per sampled request.',
+                            QUERY_COUNT_BUCKETS)
+REQUEST_SQL_SECONDS = Histogram('http_request_sql_seconds', 'SQL time per sampled request.')
+REQUEST_TEMPLATE_SECONDS = Histogram('http_request_template_seconds',
+                                     'Template render time per sampled request.')
+CACHE_REQUESTS = Counter('cache_requests_total', 'Application cache lookups by result.')
+IMAGE_STAGE_SECONDS = Histogram('image_pipeline_stage_seconds', 'Image pipeline stage durations.')
+
+REGISTRY = [REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_SQL_SECONDS, REQUEST_TEMPLATE_SECONDS,
+            CACHE_REQUESTS, IMAGE_STAGE_SECONDS]
+
+
+def register(metric):
+    """Add a metric to the ``/metrics`` output"""
+    REGISTRY.append(metric)
+    return metric
+
+
+# --------------------------------------------------------------------------
+# Per-request collection
+# --------------------------------------------------------------------------
+
+class RequestStats:
+    __slots__ = ('sql_count', 'sql_time', 'queries', 'template_time',
+                 'cache_hits', 'cache_misses', 'stages')
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.queries = []
+        self.template_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.stages = {}
+
+    def record_query(self, sql, duration):
+        self.sql_count += 1
+        self.sql_time += duration
+        # Keep only the slowest few statements for slow-request logs
+        if len(self.queries) < TOP_QUERIES:
+            self.queries.append((duration, sql))
+            self.queries.sort(reverse=True)
+        elif duration > self.queries[-1][0]:
+            self.queries[-1] = (duration, sql)
+            self.queries.sort(reverse=True)
+
+
+def _sql_wrapper(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.record_query(sql, time.perf_counter() - started)
+
+
+def _install_sql_wrapper(sender, connection, **kwargs):
+    if _sql_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_sql_wrapper)
+
+
+connection_created.connect(_install_sql_wrapper, dispatch_uid='photoalbum.instrumentation.sql')
+
+
+def record_cache(cache_name, hit):
+    """Record an application-level cache lookup"""
+    CACHE_REQUESTS.inc(cache=cache_name, result='hit' if hit else 'miss')
+    stats = _current.get()
+    if stats is not None:
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+
+@contextmanager
+def image_stage(stage):
+    """Time one image pipeline stage (decode, resize, encode, storage_write...)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        IMAGE_STAGE_SECONDS.observe(duration, stage=stage)
+        stats = _current.get()
+        if stats is not None:
+            stats.stages[stage] = stats.stages.get(stage, 0.0) + duration
+
+
+class TimedTemplate:
+    """Wraps a backend template to attribute render time to the current request"""
+
+    def __init__(self, template):
+        self._template = template
+
+    def __getattr__(self, name):
+        return getattr(self._template, name)
+
+    def render(self, context=None, request=None):
+        stats = _current.get()
+        if stats is None:
+            return self._template.render(context, request)
+        started = time.perf_counter()
+        try:
+            return self._template.render(context, request)
+        finally:
+            stats.template_time += time.perf_counter() - started
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """Django template backend that reports render time to the instrumentation"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class PerformanceMiddleware:
+    """Record request metrics and add ``Server-Timing`` to sampled responses"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PERF_SAMPLE_RATE', 1.0)
+        self.server_timing = getattr(settings, 'PERF_SERVER_TIMING', False)
+        self.slow_ms = getattr(settings, 'PERF_SLOW_REQUEST_MS', 1000)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = self._sample()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, stats, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        stats = self._sample()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, stats, time.perf_counter() - started)
+
+    def _sample(self):
+        if self.sample_rate >= 1 or (self.sample_rate > 0 and random.random() < self.sample_rate):
+            return RequestStats()
+        return None
+
+    def _finish(self, request, response, stats, duration):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        REQUEST_SECONDS.observe(duration, view=view, method=request.method,
+                                status=response.status_code)
+
+        if stats is not None:
+            REQUEST_QUERIES.observe(stats.sql_count, view=view)
+            REQUEST_SQL_SECONDS.observe(stats.sql_time, view=view)
+            REQUEST_TEMPLATE_SECONDS.observe(stats.template_time, view=view)
+            if self.server_timing:
+                response['Server-Timing'] = _server_timing(stats, duration)
+
+        if duration * 1000 >= self.slow_ms:
+            self._log_slow(request, view, duration, stats)
+        return response
+
+    def _log_slow(self, request, view, duration, stats):
+        if stats is None:
+            logger.warning('Slow request %s %s (%s): %.0fms (not sampled)',
+                           request.method, request.path, view, duration * 1000)
+            return
+        top = '\n'.join(f'  {d * 1000:8.2f}ms  {sql[:500]}' for d, sql in stats.queries)
+        logger.warning(
+            'Slow request %s %s (%s): %.0fms, %d queries in %.0fms, templates %.0fms\n%s',
+            request.method, request.path, view, duration * 1000, stats.sql_count,
+            stats.sql_time * 1000, stats.template_time * 1000, top,
+        )
+
+
+def _server_timing(stats, duration):
+    parts = [
+        f'sql;dur={stats.sql_time * 1000:.1f};desc="{stats.sql_count} queries"',
+        f'tpl;dur={stats.template_time * 1000:.1f}',
+    ]
+    if stats.cache_hits or stats.cache_misses:
+        parts.append(f'cache;desc="{stats.cache_hits} hit {stats.cache_misses} miss"')
+    for stage, seconds in stats.stages.items():
+        parts.append(f'img-{stage};dur={seconds * 1000:.1f}')
+    parts.append(f'total;dur={duration * 1000:.1f}')
+    return ', '.join(parts)
+
+
+def metrics_view(request):
+    """Prometheus text exposition of the in-process metrics"""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    authorised = (
+        (token and request.headers.get('Authorization') == f'Bearer {token}')
+        or (not token and settings.DEBUG)
+        or (request.user.is_authenticated and request.user.is_staff)
+    )
+    if not authorised:
+        return HttpResponseForbidden()
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
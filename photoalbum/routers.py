@@ -0,0 +1,119 @@
+"""Read-replica routing with read-your-writes stickiness.
+
+``ReplicaRouter`` sends reads of the app models to a random replica from
+``DATABASE_REPLICAS`` and every write to ``default``. Reads go to the primary
+instead while the current context is pinned:
+
+* for the whole of an unsafe request (POST, PUT, PATCH, DELETE);
+* for requests carrying the pin cookie, which ``ReplicaPinningMiddleware``
+  sets for ``REPLICA_PIN_SECONDS`` after an unsafe request that wrote, so a
+  user sees their own upload/edit/delete even while replicas lag;
+* inside ``use_primary()``, e.g. background jobs acting on rows that were
+  committed a moment ago.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+PIN_COOKIE = 'db_pin'
+UNSAFE_METHODS = frozenset({'POST', 'PUT', 'PATCH', 'DELETE'})
+
+_pinned = ContextVar('db_pinned', default=False)
+_wrote = ContextVar('db_wrote', default=None)
+
+
+@contextmanager
+def use_primary():
+    """Route every read inside the block to the primary database"""
+    token = _pinned.set(True)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+class ReplicaRouter:
+    def __init__(self):
+        self.replicas = list(getattr(settings, 'DATABASE_REPLICAS', []))
+        self.apps = set(getattr(settings, 'REPLICA_ROUTED_APPS', []))
+        self.primary_only = {label.lower() for label in getattr(settings, 'REPLICA_EXCLUDED_MODELS', [])}
+
+    def _replicable(self, model):
+        meta = model._meta
+        return meta.app_label in self.apps and meta.label_lower not in self.primary_only
+
+    def db_for_read(self, model, **hints):
+        if not self.replicas or _pinned.get() or not self._replicable(model):
+            return 'default'
+        return random.choice(self.replicas)
+
+    def db_for_write(self, model, **hints):
+        wrote = _wrote.get()
+        if wrote is not None:
+            wrote[0] = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas receive schema changes through replication
+        return db not in self.replicas
+
+
+class ReplicaPinningMiddleware:
+    """Pin unsafe requests, and the same client for a short while after, to the primary"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.pin_seconds = getattr(settings, 'REPLICA_PIN_SECONDS', 10)
+        self.enabled = bool(getattr(settings, 'DATABASE_REPLICAS', []))
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+        tokens = self._enter(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = self._exit(tokens)
+        return self._finish(request, response, wrote)
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+        tokens = self._enter(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            wrote = self._exit(tokens)
+        return self._finish(request, response, wrote)
+
+    def _enter(self, request):
+        pinned = request.method in UNSAFE_METHODS or PIN_COOKIE in request.COOKIES
+        # A one-element list so writes made in sync_to_async threads, which
+        # run in a copy of this context, are still seen here
+        return _pinned.set(pinned), _wrote.set([False])
+
+    def _exit(self, tokens):
+        wrote = _wrote.get()[0]
+        _pinned.reset(tokens[0])
+        _wrote.reset(tokens[1])
+        return wrote
+
+    def _finish(self, request, response, wrote):
+        if wrote and request.method in UNSAFE_METHODS:
+            response.set_cookie(PIN_COOKIE, '1', max_age=self.pin_seconds, httponly=True,
+                                samesite='Lax', secure=request.is_secure())
+        return response
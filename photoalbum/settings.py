@@ -59,6 +59,8 @@ INSTALLED_APPS = [
 
 
 MIDDLEWARE = [
+    'photoalbum.instrumentation.PerformanceMiddleware',
+    'photoalbum.routers.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -72,7 +74,8 @@ ROOT_URLCONF = 'photoalbum.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates plus render timing for the performance instrumentation
+        'BACKEND': 'photoalbum.instrumentation.TimedDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -89,6 +92,10 @@ TEMPLATES = [
 
 
 WSGI_APPLICATION = 'photoalbum.wsgi.application'
+ASGI_APPLICATION = 'photoalbum.asgi.application'
+
+# Threads used by async views for blocking storage calls (GCS/S3 clients are sync)
+ASYNC_STORAGE_THREADS = env.int('ASYNC_STORAGE_THREADS', default=16)
 
 
 # Database
@@ -120,6 +127,75 @@ if DATABASE_URL:
     }
     DATABASES['default'].setdefault('CONN_MAX_AGE', 600)
 
+# Read replicas: comma-separated database URLs, e.g.
+# `DATABASE_REPLICA_URLS=postgres://...replica-1/db,postgres://...replica-2/db`.
+# Locally, `sqlite:////abs/path/replica.sqlite3` pointing at a copy of
+# db.sqlite3 exercises the same routing. See photoalbum/routers.py.
+DATABASE_REPLICAS = []
+for index, url in enumerate(env.list('DATABASE_REPLICA_URLS', default=[]), start=1):
+    if url.startswith('postgresql+psycopg2://'):
+        url = url.replace('postgresql+psycopg2://', 'postgres://', 1)
+    alias = f'replica{index}'
+    DATABASES[alias] = env.db_url_config(url)
+    DATABASES[alias].setdefault('CONN_MAX_AGE', DATABASES['default'].get('CONN_MAX_AGE', 0))
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+
+# Application-level connection pooling (photoalbum/db/pool.py). Each worker
+# process keeps at most DB_POOL_MAX_SIZE connections per database however many
+# threads it runs, so WEB_CONCURRENCY can be raised without exhausting the
+# server's max_connections. Django's own persistent connections are disabled
+# for pooled databases.
+DB_POOL = env.bool('DB_POOL', default=False)
+POOLED_ENGINES = {
+    'django.db.backends.postgresql': 'photoalbum.db.backends.postgresql',
+    'django.db.backends.postgresql_psycopg2': 'photoalbum.db.backends.postgresql',
+    'django.db.backends.sqlite3': 'photoalbum.db.backends.sqlite3',
+}
+if DB_POOL:
+    for config in DATABASES.values():
+        if config['ENGINE'] not in POOLED_ENGINES:
+            continue
+        config['ENGINE'] = POOLED_ENGINES[config['ENGINE']]
+        config['CONN_MAX_AGE'] = 0
+        config['POOL'] = {
+            'MIN_SIZE': env.int('DB_POOL_MIN_SIZE', default=2),
+            'MAX_SIZE': env.int('DB_POOL_MAX_SIZE', default=10),
+            'TIMEOUT': env.float('DB_POOL_TIMEOUT', default=10.0),
+            'MAX_LIFETIME': env.float('DB_POOL_MAX_LIFETIME', default=1800.0),
+            'MAX_IDLE': env.float('DB_POOL_MAX_IDLE', default=600.0),
+            'CHECK_IDLE_SECONDS': env.float('DB_POOL_CHECK_IDLE_SECONDS', default=5.0),
+        }
+
+DATABASE_ROUTERS = ['photoalbum.routers.ReplicaRouter']
+# Apps whose reads may be served by a replica; sessions, admin and the job
+# queue always use the primary
+REPLICA_ROUTED_APPS = ['photos', 'accounts', 'auth']
+REPLICA_EXCLUDED_MODELS = ['photos.Job']
+# After a client's write, its reads stay on the primary for this long
+REPLICA_PIN_SECONDS = env.int('REPLICA_PIN_SECONDS', default=10)
+
+
+# Shared cache, e.g. `CACHE_URL=redis://host:6379/0`. The per-process default
+# is fine for a single worker; cached data invalidated on writes (friend sets)
+# is only consistent across workers with a shared backend.
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+
+# Sessions live in the cache (accounts/sessions.py) and are written back to the
+# database in the background when the cache is shared between workers
+SESSION_ENGINE = 'accounts.sessions'
+SESSION_WRITE_BEHIND_SECONDS = env.int(
+    'SESSION_WRITE_BEHIND_SECONDS', default=5 if env('CACHE_URL', default=None) else 0)
+
+# request.user and its profile are served from the cache as well. ModelBackend
+# stays listed so sessions logged in before the switch remain valid.
+AUTHENTICATION_BACKENDS = [
+    'accounts.backends.CachedModelBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -178,7 +254,10 @@ else:
     try:
         # Insert WhiteNoise middleware right after SecurityMiddleware if not present
         if 'whitenoise.middleware.WhiteNoiseMiddleware' not in MIDDLEWARE:
-            MIDDLEWARE.insert(1, 'whitenoise.middleware.WhiteNoiseMiddleware')
+            MIDDLEWARE.insert(
+                MIDDLEWARE.index('django.middleware.security.SecurityMiddleware') + 1,
+                'whitenoise.middleware.WhiteNoiseMiddleware',
+            )
     except Exception:
         pass
 
@@ -216,3 +295,53 @@ AUTH_USER_MODEL = 'auth.User'
 MAX_UPLOAD_SIZE = 10485760  # 10MB
 ALLOWED_IMAGE_TYPES = ['image/jpeg', 'image/png', 'image/webp', 'image/gif']
 
+# Animated uploads are always transcoded to animated WebP; also produce a muted
+# MP4 when an ffmpeg binary is on PATH
+ANIMATION_MP4_ENABLED = env.bool('ANIMATION_MP4_ENABLED', default=True)
+
+# Upload admission control (see photos/admission.py): token buckets per user and
+# across all users, shared through the cache, and a cap on uploads processed at
+# once per worker process. Over budget, uploads get a 429 with Retry-After.
+UPLOAD_ADMISSION = env.bool('UPLOAD_ADMISSION', default=True)
+UPLOAD_USER_RATE_PER_MINUTE = env.float('UPLOAD_USER_RATE_PER_MINUTE', default=10.0)
+UPLOAD_USER_BURST = env.int('UPLOAD_USER_BURST', default=5)
+UPLOAD_GLOBAL_RATE_PER_MINUTE = env.float('UPLOAD_GLOBAL_RATE_PER_MINUTE', default=120.0)
+UPLOAD_GLOBAL_BURST = env.int('UPLOAD_GLOBAL_BURST', default=20)
+UPLOAD_MAX_CONCURRENT = env.int('UPLOAD_MAX_CONCURRENT', default=1)
+
+# Background jobs (see photos/jobs.py), processed by `manage.py run_jobs`
+# (started by entrypoint.sh). When eager, jobs also run in-process right after
+# the enqueuing transaction commits, i.e. inside the request; that is only the
+# default for local development, where no worker runs
+JOBS_EAGER = env.bool('JOBS_EAGER', default=DEBUG)
+
+# `manage.py gc_media` leaves files younger than this alone, so uploads whose
+# row has not been committed yet are never collected
+MEDIA_GC_MIN_AGE_HOURS = env.int('MEDIA_GC_MIN_AGE_HOURS', default=24)
+
+# Performance instrumentation (see photoalbum/instrumentation.py)
+# Fraction of requests that collect SQL/template/cache/image timings
+PERF_SAMPLE_RATE = env.float('PERF_SAMPLE_RATE', default=1.0 if DEBUG else 0.05)
+# Expose the collected timings to clients as a Server-Timing header
+PERF_SERVER_TIMING = env.bool('PERF_SERVER_TIMING', default=DEBUG)
+# Requests slower than this are logged with their slowest queries
+PERF_SLOW_REQUEST_MS = env.int('PERF_SLOW_REQUEST_MS', default=1000)
+# Bearer token for /metrics; without one only staff (or DEBUG) may scrape
+METRICS_TOKEN = env('METRICS_TOKEN', default=None)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {'format': '{levelname} {name}: {message}', 'style': '{'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'simple'},
+    },
+    'root': {'handlers': ['console'], 'level': 'WARNING'},
+    'loggers': {
+        'photos': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+        'accounts': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+        'photoalbum': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
@@ -0,0 +1,236 @@
+import copy
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from contextlib import closing
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connections, router, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from accounts.models import UserProfile
+from photos.models import Job, Photo
+
+from .db import pool as pool_module
+from .db.backends.sqlite3.base import DatabaseWrapper as SQLitePooledWrapper
+from .db.pool import ConnectionPool, PoolTimeout
+from .routers import PIN_COOKIE, ReplicaRouter, use_primary
+
+REPLICA = 'replica_test'
+
+
+class ReplicaRoutingTests(TestCase):
+    """The test database is the primary; a second SQLite file with the same
+    schema is a replica that only holds the rows a test copies to it."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_dir = tempfile.mkdtemp()
+        path = os.path.join(cls.replica_dir, 'replica.sqlite3')
+        primary = connections['default']
+        primary.ensure_connection()
+        with closing(sqlite3.connect(path)) as replica:
+            primary.connection.backup(replica)
+        super().setUpClass()
+        # Registered after TestCase set up its databases, which only knows the configured ones
+        connections.settings[REPLICA] = {**connections.settings['default'], 'NAME': path}
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections[REPLICA].close()
+        del connections[REPLICA]
+        del connections.settings[REPLICA]
+        shutil.rmtree(cls.replica_dir, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+        # Like TestCase does for default: every test's replica rows are rolled back
+        replica_atomic = transaction.atomic(using=REPLICA)
+        replica_atomic.__enter__()
+        self.addCleanup(self.rollback_replica, replica_atomic)
+        replica_router = next(r for r in router.routers if isinstance(r, ReplicaRouter))
+        patcher = mock.patch.object(replica_router, 'replicas', [REPLICA])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        settings = override_settings(DATABASE_REPLICAS=[REPLICA], SECURE_SSL_REDIRECT=False)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.owner = User.objects.create_user('owner', password='pw')
+        self.replicate(self.owner, self.owner.profile)
+
+    def rollback_replica(self, replica_atomic):
+        transaction.set_rollback(True, using=REPLICA)
+        replica_atomic.__exit__(None, None, None)
+
+    def replicate(self, *objs):
+        """Copy rows to the replica as replication would, without signals"""
+        for obj in objs:
+            type(obj)._base_manager.using(REPLICA).bulk_create([copy.copy(obj)])
+
+    def test_reads_use_the_replica_and_writes_the_primary(self):
+        photo = Photo.objects.create(owner=self.owner, title='new')
+        self.assertEqual(Photo.objects.all().db, REPLICA)
+        self.assertEqual(UserProfile.objects.all().db, REPLICA)
+        self.assertEqual(Job.objects.all().db, 'default')  # excluded from replica reads
+
+        # The replica has not caught up with the insert yet
+        self.assertFalse(Photo.objects.filter(pk=photo.pk).exists())
+        self.assertTrue(Photo.objects.using('default').filter(pk=photo.pk).exists())
+
+    def test_use_primary(self):
+        photo = Photo.objects.create(owner=self.owner, title='new')
+        with use_primary():
+            self.assertEqual(Photo.objects.all().db, 'default')
+            self.assertTrue(Photo.objects.filter(pk=photo.pk).exists())
+        self.assertEqual(Photo.objects.all().db, REPLICA)
+
+    def test_writer_reads_their_own_writes(self):
+        photo = Photo.objects.create(owner=self.owner, title='old')
+        self.replicate(photo)
+        url = reverse('photos:api_photo', args=[photo.pk])
+        self.client.force_login(self.owner)
+
+        response = self.client.patch(url, json.dumps({'title': 'new'}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], 10)
+
+        # The pin cookie keeps this client on the primary...
+        self.assertEqual(self.client.get(url).json()['title'], 'new')
+        # ...while clients without it still see the lagging replica
+        del self.client.cookies[PIN_COOKIE]
+        self.assertEqual(self.client.get(url).json()['title'], 'old')
+
+    def test_reads_do_not_pin_the_client(self):
+        photo = Photo.objects.create(owner=self.owner, title='old')
+        self.replicate(photo)
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('photos:api_photo', args=[photo.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = self.broken = False
+
+    def ping(self):
+        if self.broken:
+            raise OSError('server closed the connection')
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def make_pool(self, **options):
+        self.opened = []
+        return ConnectionPool('test', ping=FakeConnection.ping,
+                              close=lambda connection: setattr(connection, 'closed', True), **options)
+
+    def connect(self):
+        connection = FakeConnection()
+        self.opened.append(connection)
+        return connection
+
+    def test_returned_connections_are_reused(self):
+        pool = self.make_pool()
+        first = pool.getconn(self.connect)
+        pool.putconn(first)
+        self.assertIs(pool.getconn(self.connect), first)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_waits_for_a_free_connection_up_to_the_timeout(self):
+        pool = self.make_pool(max_size=1, timeout=0.05)
+        held = pool.getconn(self.connect)
+        with self.assertRaises(PoolTimeout):
+            pool.getconn(self.connect)
+
+        pool.timeout = 5
+        threading.Timer(0.05, pool.putconn, [held]).start()
+        self.assertIs(pool.getconn(self.connect), held)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_broken_idle_connections_are_replaced(self):
+        pool = self.make_pool(check_idle_seconds=0)
+        broken = pool.getconn(self.connect)
+        pool.putconn(broken)
+        broken.broken = True
+
+        replacement = pool.getconn(self.connect)
+        self.assertIsNot(replacement, broken)
+        self.assertTrue(broken.closed)
+
+    def test_expired_and_broken_connections_are_closed_on_return(self):
+        pool = self.make_pool(max_lifetime=0)
+        expired = pool.getconn(self.connect)
+        pool.putconn(expired)
+        self.assertTrue(expired.closed)
+
+        pool = self.make_pool()
+        broken = pool.getconn(self.connect)
+        pool.putconn(broken, broken=True)
+        self.assertTrue(broken.closed)
+        self.assertEqual(pool.stats(), {'idle': 0, 'in_use': 0, 'max_size': 10})
+
+    def test_idle_connections_above_min_size_are_retired(self):
+        pool = self.make_pool(min_size=1, max_idle=0)
+        connections = [pool.getconn(self.connect) for _ in range(3)]
+        for connection in connections:
+            pool.putconn(connection)
+        pool.getconn(self.connect)
+        self.assertEqual([connection.closed for connection in connections], [True, True, False])
+
+    def test_failed_connect_frees_its_slot(self):
+        pool = self.make_pool(max_size=1, timeout=0.05)
+
+        def refuse():
+            raise OSError('connection refused')
+
+        with self.assertRaises(OSError):
+            pool.getconn(refuse)
+        self.assertEqual(pool.size, 0)
+        pool.getconn(self.connect)
+
+
+class PooledBackendTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        settings_dict = {
+            **connections.settings['default'],
+            'ENGINE': 'photoalbum.db.backends.sqlite3',
+            'NAME': os.path.join(directory, 'pooled.sqlite3'),
+            'POOL': {'MAX_SIZE': 2},
+        }
+        self.wrapper = SQLitePooledWrapper(settings_dict, alias='pool_test')
+        self.addCleanup(lambda: pool_module._pools.pop('pool_test').close_all())
+
+    def test_closing_returns_the_connection_to_the_pool(self):
+        self.wrapper.ensure_connection()
+        raw = self.wrapper.connection
+        self.wrapper.close()
+        self.assertEqual(self.wrapper._pool().stats()['idle'], 1)
+
+        self.wrapper.ensure_connection()
+        self.assertIs(self.wrapper.connection, raw)
+        self.wrapper.close()
+
+    def test_open_transaction_is_rolled_back_before_reuse(self):
+        self.wrapper.ensure_connection()
+        with self.wrapper.cursor() as cursor:
+            cursor.execute('CREATE TABLE item (id integer)')
+        self.wrapper.set_autocommit(False)
+        with self.wrapper.cursor() as cursor:
+            cursor.execute('INSERT INTO item VALUES (1)')
+        self.wrapper.close()
+
+        self.wrapper.ensure_connection()
+        with self.wrapper.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM item')
+            self.assertEqual(cursor.fetchone(), (0,))
+        self.wrapper.close()
@@ -1,5 +1,13 @@
-from django.contrib import admin
-from .models import Photo, PhotoCategory, PhotoTag
+from datetime import datetime
+
+from django.contrib import admin, messages
+from django.contrib.auth.models import User
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .maintenance import enqueue_action
+from .models import Job, Photo, PhotoCategory, PhotoTag
+from .pagination import EstimatedCountPaginator
 
 
 @admin.register(PhotoCategory)
@@ -16,11 +24,43 @@ class PhotoTagAdmin(admin.ModelAdmin):
     readonly_fields = ('created_at',)
 
 
+class CreatedYearFilter(admin.SimpleListFilter):
+    """Upload year, as a ``created_at`` range that the index serves.
+
+    Unlike ``date_hierarchy`` it never runs ``SELECT DISTINCT`` over dates:
+    the choices come from the min/max upload times.
+    """
+    title = '上傳年份'
+    parameter_name = 'year'
+
+    def lookups(self, request, model_admin):
+        bounds = Photo.objects.aggregate(first=Min('created_at'), last=Max('created_at'))
+        if bounds['first'] is None:
+            return []
+        first, last = (timezone.localtime(bounds[key]).year for key in ('first', 'last'))
+        return [(str(year), str(year)) for year in range(last, first - 1, -1)]
+
+    def queryset(self, request, queryset):
+        if not (self.value() or '').isdigit():
+            return queryset
+        year = int(self.value())
+        start = timezone.make_aware(datetime(year, 1, 1))
+        end = timezone.make_aware(datetime(year + 1, 1, 1))
+        return queryset.filter(created_at__gte=start, created_at__lt=end)
+
+
 @admin.register(Photo)
 class PhotoAdmin(admin.ModelAdmin):
     list_display = ('title', 'owner', 'privacy', 'view_count', 'is_featured', 'created_at')
-    list_filter = ('privacy', 'is_featured', 'created_at', 'category')
-    search_fields = ('title', 'description', 'owner__username', 'tags__name')
+    list_filter = ('privacy', 'is_featured', CreatedYearFilter, 'category')
+    list_select_related = ('owner',)
+    # Title matches use the trigram index on PostgreSQL (migration 0008);
+    # see get_search_results for owners. Tags have their own page on the site.
+    search_fields = ('title',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ('regenerate_renditions', 'recompute_metadata',
+               'make_public', 'make_friends_only', 'make_private')
     readonly_fields = ('created_at', 'updated_at', 'view_count', 'width', 'height', 'file_size')
     filter_horizontal = ('tags',)
     
@@ -50,3 +90,52 @@ class PhotoAdmin(admin.ModelAdmin):
         if obj:  # Editing an existing object
             readonly_fields.append('owner')
         return readonly_fields
+
+    def get_search_results(self, request, queryset, search_term):
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        term = search_term.strip()
+        if term:
+            # An exact username resolved up front keeps both sides of the OR indexed
+            owner_ids = list(User.objects.filter(username=term).values_list('pk', flat=True))
+            if owner_ids:
+                results |= queryset.filter(owner_id__in=owner_ids)
+        return results, may_have_duplicates
+
+    def _enqueue(self, request, queryset, action, label, **kwargs):
+        # One job per action: the worker resolves the selection and batches it
+        if request.POST.get('select_across') != '1':
+            ids = list(queryset.values_list('pk', flat=True))  # at most one changelist page
+            enqueue_action(action, request.user, ids=ids, **kwargs)
+            scope = f'{len(ids)} 張相片'
+        else:
+            # "Select all": the changelist's filters and search are applied again by the worker
+            enqueue_action(action, request.user, params=request.GET.urlencode(), **kwargs)
+            scope = '所有符合條件的相片'
+        self.message_user(request, f'已排入背景工作：{label}（{scope}）', messages.SUCCESS)
+
+    @admin.action(description='重新產生縮圖與轉檔')
+    def regenerate_renditions(self, request, queryset):
+        self._enqueue(request, queryset, 'regenerate_renditions', '重新產生縮圖與轉檔')
+
+    @admin.action(description='重新計算圖片資訊')
+    def recompute_metadata(self, request, queryset):
+        self._enqueue(request, queryset, 'recompute_metadata', '重新計算圖片資訊')
+
+    @admin.action(description='設為公開')
+    def make_public(self, request, queryset):
+        self._enqueue(request, queryset, 'set_photo_privacy', '設為公開', privacy='public')
+
+    @admin.action(description='設為僅限好友')
+    def make_friends_only(self, request, queryset):
+        self._enqueue(request, queryset, 'set_photo_privacy', '設為僅限好友', privacy='friends')
+
+    @admin.action(description='設為私人')
+    def make_private(self, request, queryset):
+        self._enqueue(request, queryset, 'set_photo_privacy', '設為私人', privacy='private')
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'attempts', 'run_after', 'updated_at')
+    list_filter = ('status', 'name')
+    readonly_fields = ('created_at', 'updated_at', 'last_error')
@@ -0,0 +1,119 @@
+"""Admission control for uploads.
+
+Processing an upload (decoding, thumbnails, adaptive encoding) holds a worker
+for seconds, so a single client uploading in a loop could occupy every worker
+and stall page views. The request body has already been read by then
+(``CsrfViewMiddleware`` parses ``request.POST``), so what admission protects
+is the processing: before an upload is processed it must pass
+
+* a free processing slot in this process (``UPLOAD_MAX_CONCURRENT``), taken
+  before the form is validated;
+* a token bucket per user and one shared by all users, kept in the cache so
+  every worker process draws from the same budget
+  (``UPLOAD_USER_RATE_PER_MINUTE``/``UPLOAD_USER_BURST`` and
+  ``UPLOAD_GLOBAL_RATE_PER_MINUTE``/``UPLOAD_GLOBAL_BURST``), charged only
+  once the form is valid, so a rejected submission costs no tokens.
+
+Otherwise ``UploadRejected`` is raised at once, carrying the seconds to send
+as ``Retry-After`` with a 429. The buckets are updated without a lock, so a
+few simultaneous requests may share a token; the slots still bound the work
+each process takes on.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from photoalbum.instrumentation import Counter, register
+
+# Retry-After when only the processing slots are full: uploads finish in seconds
+BUSY_RETRY_AFTER = 2
+
+UPLOAD_ADMISSIONS = register(Counter(
+    'upload_admissions_total', 'Upload admission decisions (admitted, user_rate, global_rate, busy).'))
+
+_slots = None  # (size, semaphore)
+_slots_lock = threading.Lock()
+
+
+class UploadRejected(Exception):
+    """The upload is over budget; retry after ``retry_after`` seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def _processing_slots():
+    global _slots
+    size = settings.UPLOAD_MAX_CONCURRENT
+    with _slots_lock:
+        if _slots is None or _slots[0] != size:
+            _slots = (size, threading.BoundedSemaphore(size))
+        return _slots[1]
+
+
+def _refill(state, rate, burst, now):
+    """Tokens in a bucket last seen as ``state`` (``None`` for a full one)"""
+    if state is None:
+        return burst
+    tokens, updated = state
+    return min(burst, tokens + (now - updated) * rate)
+
+
+def take_tokens(user_id):
+    """Take a token from ``user_id``'s bucket and the global one, or raise ``UploadRejected``"""
+    buckets = {
+        f'upload_bucket:user:{user_id}': (
+            'user_rate', settings.UPLOAD_USER_RATE_PER_MINUTE / 60, settings.UPLOAD_USER_BURST),
+        'upload_bucket:global': (
+            'global_rate', settings.UPLOAD_GLOBAL_RATE_PER_MINUTE / 60, settings.UPLOAD_GLOBAL_BURST),
+    }
+    now = time.time()
+    states = cache.get_many(list(buckets))
+    tokens = {}
+    for key, (reason, rate, burst) in buckets.items():
+        tokens[key] = _refill(states.get(key), rate, burst, now)
+        if tokens[key] < 1:
+            # Neither bucket is charged for a rejected upload
+            raise UploadRejected(reason, math.ceil((1 - tokens[key]) / rate))
+    for key, (_, rate, burst) in buckets.items():
+        # Expires once it would have refilled anyway
+        cache.set(key, (tokens[key] - 1, now), math.ceil(burst / rate) + 1)
+
+
+def _no_charge():
+    pass
+
+
+@contextmanager
+def admit_upload(user):
+    """Hold a processing slot for one upload by ``user``, or raise ``UploadRejected``.
+
+    Yields ``charge``: call it once the upload is valid, before processing
+    it, to take the user's tokens (it raises ``UploadRejected`` over budget).
+    """
+    if not settings.UPLOAD_ADMISSION:
+        yield _no_charge
+        return
+    slots = _processing_slots()
+    if not slots.acquire(blocking=False):
+        UPLOAD_ADMISSIONS.inc(result='busy')
+        raise UploadRejected('busy', BUSY_RETRY_AFTER)
+
+    def charge():
+        try:
+            take_tokens(user.pk)
+        except UploadRejected as e:
+            UPLOAD_ADMISSIONS.inc(result=e.reason)
+            raise
+        UPLOAD_ADMISSIONS.inc(result='admitted')
+
+    try:
+        yield charge
+    finally:
+        slots.release()
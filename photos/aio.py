@@ -0,0 +1,71 @@
+"""Helpers for the async views.
+
+Django 4.2 resolves ``request.user`` lazily and synchronously, and storage
+backends (GCS, S3) only offer blocking clients, so the async views use these
+helpers to keep that work off the event loop.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404
+from django.shortcuts import render, resolve_url
+
+_storage_pool = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'ASYNC_STORAGE_THREADS', 16),
+    thread_name_prefix='storage-io',
+)
+
+# Template rendering may still touch lazy relations (e.g. the navbar avatar)
+arender = sync_to_async(render)
+
+
+async def run_io(func, *args, **kwargs):
+    """Run a blocking storage call in the storage thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_storage_pool, partial(func, *args, **kwargs))
+
+
+async def get_user(request):
+    """Resolve ``request.user`` without blocking the event loop"""
+    def resolve():
+        user = request.user
+        user.is_authenticated  # evaluates the lazy object (session + auth lookup)
+        return user
+    return await sync_to_async(resolve)()
+
+
+def alogin_required(view):
+    """Async counterpart of ``login_required(login_url='accounts:login')``"""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        user = await get_user(request)
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path(), resolve_url('accounts:login'))
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+async def aget_object_or_404(klass, *args, **kwargs):
+    """Async ``get_object_or_404`` (Django 4.2 does not ship one)"""
+    queryset = klass._default_manager.all() if hasattr(klass, '_default_manager') else klass
+    try:
+        return await queryset.aget(*args, **kwargs)
+    except queryset.model.DoesNotExist:
+        raise Http404(f'No {queryset.model._meta.object_name} matches the given query.')
+
+
+async def stream_file(field, chunk_size=64 * 1024):
+    """Yield the contents of a stored file chunk by chunk"""
+    f = await run_io(field.storage.open, field.name, 'rb')
+    try:
+        while True:
+            chunk = await run_io(f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        await run_io(f.close)
@@ -0,0 +1,330 @@
+"""Lightweight JSON API for the mobile client.
+
+Endpoints reuse the HTML forms for validation and support sparse fieldsets
+(``?fields=id,title,thumb``), keyset pagination (``?cursor=...``) and
+conditional GET through ``ETag`` headers. Related objects are only joined or
+prefetched when a requested field needs them, so every endpoint runs a fixed
+number of queries regardless of page size.
+"""
+import hashlib
+import json
+
+from django.db.models import prefetch_related_objects
+from django.http import Http404, HttpResponse, JsonResponse, QueryDict
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+from .admission import UploadRejected, admit_upload
+from .feed import feed_page
+from .forms import PhotoEditForm, PhotoUploadForm
+from .models import Photo, PhotoCategory, PhotoTag
+from .pagination import InvalidCursor, cursor_page
+from .tag_index import tag_index
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+def _file_url(request, field):
+    if not field:
+        return None
+    return request.build_absolute_uri(field.url)
+
+
+PHOTO_FIELDS = {
+    'id': lambda request, photo: photo.pk,
+    'title': lambda request, photo: photo.title,
+    'description': lambda request, photo: photo.description,
+    'owner': lambda request, photo: {'id': photo.owner_id, 'username': photo.owner.username},
+    'category': lambda request, photo: (
+        {'id': photo.category_id, 'name': photo.category.name} if photo.category_id else None
+    ),
+    'tags': lambda request, photo: [tag.name for tag in photo.tags.all()],
+    'privacy': lambda request, photo: photo.privacy,
+    'view_count': lambda request, photo: photo.view_count,
+    'width': lambda request, photo: photo.width,
+    'height': lambda request, photo: photo.height,
+    'file_size': lambda request, photo: photo.file_size,
+    'dominant_color': lambda request, photo: photo.dominant_color or None,
+    'placeholder': lambda request, photo: photo.placeholder or None,
+    'created_at': lambda request, photo: photo.created_at.isoformat(),
+    'updated_at': lambda request, photo: photo.updated_at.isoformat(),
+    'image': lambda request, photo: _file_url(request, photo.image),
+    'thumb': lambda request, photo: _file_url(request, photo.thumbnail or photo.image),
+    'is_animated': lambda request, photo: photo.is_animated,
+    'renditions': lambda request, photo: {
+        'original': _file_url(request, photo.image),
+        'thumb': _file_url(request, photo.thumbnail),
+        'animation': _file_url(request, photo.animation),
+        'video': _file_url(request, photo.video),
+    },
+    'url': lambda request, photo: request.build_absolute_uri(
+        reverse('photos:detail', args=[photo.pk])
+    ),
+}
+
+LIST_FIELDS = ('id', 'title', 'owner', 'thumb', 'width', 'height', 'dominant_color',
+               'view_count', 'created_at')
+DETAIL_FIELDS = tuple(PHOTO_FIELDS)
+
+
+class ApiError(Exception):
+    def __init__(self, status, detail):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+def api_view(methods):
+    """Restrict a view to ``methods`` and turn errors into JSON responses"""
+    def decorator(view):
+        def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                response = _json({'detail': 'Method not allowed.'}, status=405)
+                response['Allow'] = ', '.join(methods)
+                return response
+            try:
+                return view(request, *args, **kwargs)
+            except ApiError as e:
+                return _json({'detail': e.detail}, status=e.status)
+            except Http404:
+                return _json({'detail': 'Not found.'}, status=404)
+        wrapper.__name__ = view.__name__
+        wrapper.__doc__ = view.__doc__
+        return wrapper
+    return decorator
+
+
+def _json(data, status=200):
+    return JsonResponse(data, status=status,
+                        json_dumps_params={'separators': (',', ':'), 'ensure_ascii': False})
+
+
+def _require_login(request):
+    if not request.user.is_authenticated:
+        raise ApiError(401, 'Authentication required.')
+
+
+def _requested_fields(request, default):
+    raw = request.GET.get('fields')
+    if not raw:
+        return default
+    fields = tuple(dict.fromkeys(f.strip() for f in raw.split(',') if f.strip()))
+    unknown = [f for f in fields if f not in PHOTO_FIELDS]
+    if unknown:
+        raise ApiError(400, f'Unknown fields: {", ".join(unknown)}')
+    return fields
+
+
+def _limit(request):
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError(400, 'limit must be an integer.')
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def _with_relations(queryset, fields):
+    """Join only the relations needed to serialize ``fields``"""
+    related = [name for name in ('owner', 'category') if name in fields]
+    if related:
+        queryset = queryset.select_related(*related)
+    return queryset
+
+
+def _prefetch(photos, fields):
+    if 'tags' in fields:
+        prefetch_related_objects(photos, 'tags')
+
+
+def serialize_photo(request, photo, fields):
+    return {name: PHOTO_FIELDS[name](request, photo) for name in fields}
+
+
+def _etag(*parts):
+    digest = hashlib.md5(repr(parts).encode(), usedforsecurity=False).hexdigest()
+    return quote_etag(digest)
+
+
+def _not_modified(request, etag):
+    """Return a 304 response when the client's copy is still current"""
+    return get_conditional_response(request, etag=etag)
+
+
+def _photo_payload_response(request, photo, fields, status=200):
+    _prefetch([photo], fields)
+    return _json(serialize_photo(request, photo, fields), status=status)
+
+
+def _form_errors(form):
+    return _json({'detail': 'Validation failed.', 'errors': form.errors}, status=400)
+
+
+@api_view(['GET', 'POST'])
+def photo_collection(request):
+    """List photos visible to the caller, or upload a new photo"""
+    if request.method == 'POST':
+        return _photo_create(request)
+
+    fields = _requested_fields(request, LIST_FIELDS)
+    limit = _limit(request)
+
+    photos = Photo.objects.visible_to(request.user)
+    if request.GET.get('owner'):
+        photos = photos.filter(owner__username=request.GET['owner'])
+    if request.GET.get('category'):
+        if not request.GET['category'].isdigit():
+            raise ApiError(400, 'category must be a category id.')
+        photos = photos.filter(category_id=int(request.GET['category']))
+    if request.GET.get('tag'):
+        photos = photos.filter(tags__name=request.GET['tag'])
+
+    try:
+        page = cursor_page(_with_relations(photos, fields), request.GET.get('cursor'), limit)
+    except (InvalidCursor, ValueError):
+        raise ApiError(400, 'Invalid cursor or filter.')
+
+    etag = _etag(fields, page.next_cursor,
+                 [(p.pk, p.updated_at, p.view_count) for p in page])
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+
+    _prefetch(page.items, fields)
+    response = _json({
+        'results': [serialize_photo(request, photo, fields) for photo in page],
+        'next_cursor': page.next_cursor,
+    })
+    response['ETag'] = etag
+    return response
+
+
+@api_view(['GET'])
+def feed(request):
+    """The caller's home feed: their own and their friends' photos"""
+    _require_login(request)
+    fields = _requested_fields(request, LIST_FIELDS)
+    try:
+        page = feed_page(request.user, request.GET.get('cursor'), _limit(request))
+    except InvalidCursor:
+        raise ApiError(400, 'Invalid cursor.')
+
+    _prefetch(page.items, fields)
+    return _json({
+        'results': [serialize_photo(request, photo, fields) for photo in page],
+        'next_cursor': page.next_cursor,
+    })
+
+
+def _photo_create(request):
+    _require_login(request)
+    try:
+        with admit_upload(request.user) as charge:
+            form = PhotoUploadForm(request.POST, request.FILES)
+            if not form.is_valid():
+                return _form_errors(form)
+            charge()
+            form.instance.owner = request.user
+            photo = form.save()
+    except UploadRejected as e:
+        response = _json({'detail': 'Too many uploads.', 'retry_after': e.retry_after}, status=429)
+        response['Retry-After'] = str(e.retry_after)
+        return response
+    return _photo_payload_response(request, photo, DETAIL_FIELDS, status=201)
+
+
+@api_view(['GET', 'PATCH', 'POST', 'DELETE'])
+def photo_item(request, photo_id):
+    """Retrieve, edit or delete a single photo"""
+    if request.method == 'GET':
+        fields = _requested_fields(request, DETAIL_FIELDS)
+        photo = get_object_or_404(_with_relations(Photo.objects.all(), fields), pk=photo_id)
+        if not photo.is_visible_to(request.user):
+            raise Http404
+        etag = _etag(fields, photo.pk, photo.updated_at, photo.view_count)
+        not_modified = _not_modified(request, etag)
+        if not_modified is not None:
+            return not_modified
+        response = _photo_payload_response(request, photo, fields)
+        response['ETag'] = etag
+        return response
+
+    _require_login(request)
+    photo = get_object_or_404(Photo, pk=photo_id)
+    if photo.owner_id != request.user.id:
+        raise ApiError(403, 'You do not own this photo.')
+
+    if request.method == 'DELETE':
+        photo.delete()
+        return HttpResponse(status=204)
+
+    form = PhotoEditForm(_edit_data(request, photo), instance=photo)
+    if not form.is_valid():
+        return _form_errors(form)
+    photo = form.save()
+    return _photo_payload_response(request, photo, DETAIL_FIELDS)
+
+
+def _edit_data(request, photo):
+    """Merge a partial JSON or form-encoded update onto the current values"""
+    data = QueryDict(mutable=True)
+    data.update({
+        'title': photo.title,
+        'description': photo.description,
+        'category': photo.category_id or '',
+        'privacy': photo.privacy,
+        'tags': ', '.join(tag.name for tag in photo.tags.all()),
+    })
+    if request.content_type == 'application/json':
+        try:
+            payload = json.loads(request.body or b'{}')
+        except ValueError:
+            raise ApiError(400, 'Malformed JSON body.')
+        if not isinstance(payload, dict):
+            raise ApiError(400, 'Expected a JSON object.')
+    elif request.method == 'POST':
+        payload = request.POST.dict()
+    elif request.content_type == 'application/x-www-form-urlencoded':
+        # Django only parses form bodies of POST requests
+        payload = QueryDict(request.body, encoding=request.encoding).dict()
+    elif not request.body:
+        payload = {}
+    else:
+        raise ApiError(415, 'Expected a JSON or form-encoded body.')
+    for key, value in payload.items():
+        if key == 'tags' and isinstance(value, list):
+            value = ', '.join(str(v) for v in value)
+        data[key] = '' if value is None else value
+    return data
+
+
+@api_view(['GET'])
+def tag_list(request):
+    """List tags in name order, paginated by the last name seen"""
+    limit = _limit(request)
+    tags = PhotoTag.objects.order_by('name')
+    if request.GET.get('cursor'):
+        tags = tags.filter(name__gt=request.GET['cursor'])
+    names = list(tags.values_list('name', flat=True)[:limit + 1])
+    return _json({
+        'results': names[:limit],
+        'next_cursor': names[limit - 1] if len(names) > limit else None,
+    })
+
+
+@api_view(['GET'])
+def tag_autocomplete(request):
+    """Most used tags starting with ``?q=``, case- and width-insensitive"""
+    results = tag_index.suggest(request.GET.get('q', ''), _limit(request))
+    response = _json({'results': [{'name': name, 'count': count} for name, count in results]})
+    response['Cache-Control'] = 'public, max-age=60'
+    return response
+
+
+@api_view(['GET'])
+def category_list(request):
+    """List all categories"""
+    categories = PhotoCategory.objects.values('id', 'name', 'icon')
+    return _json({'results': list(categories)})
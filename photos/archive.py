@@ -0,0 +1,97 @@
+"""Date archive of public photos.
+
+``ArchiveBucket`` holds the number of public photos per year, month and day,
+globally and per owner, kept up to date by the signals in photos/signals.py
+as photos are created, deleted or change privacy. The timeline sidebar reads
+these rows directly instead of grouping the photo table, and a period's
+photos are a ``created_at`` range read on the ``-created_at`` indexes.
+``manage.py rebuild_archive`` recomputes every bucket from scratch.
+
+Periods are calendar dates in ``TIME_ZONE``.
+"""
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import ArchiveBucket, Photo
+
+
+def bucket_keys(created_at):
+    """``(year, month, day)`` keys of the year, month and day containing ``created_at``"""
+    local = timezone.localtime(created_at)
+    return [(local.year, 0, 0), (local.year, local.month, 0), (local.year, local.month, local.day)]
+
+
+def adjust(owner_id, created_at, delta):
+    """Add ``delta`` to the global and ``owner_id``'s buckets for ``created_at``"""
+    keys = bucket_keys(created_at)
+    if delta > 0:
+        # Rows are created empty first so concurrent uploads never lose a count
+        ArchiveBucket.objects.bulk_create(
+            [ArchiveBucket(owner_id=owner, year=y, month=m, day=d)
+             for owner in (None, owner_id) for y, m, d in keys],
+            ignore_conflicts=True,
+        )
+    periods = Q()
+    for year, month, day in keys:
+        periods |= Q(year=year, month=month, day=day)
+    ArchiveBucket.objects.filter(Q(owner__isnull=True) | Q(owner_id=owner_id)).filter(periods).update(
+        count=Greatest(F('count') + delta, 0))
+
+
+def rebuild():
+    """Recompute every bucket from the photo table; returns the number of rows"""
+    counts = Counter()
+    photos = Photo.objects.filter(privacy='public').values_list('owner_id', 'created_at')
+    for owner_id, created_at in photos.iterator(chunk_size=5000):
+        for key in bucket_keys(created_at):
+            counts[(None, *key)] += 1
+            counts[(owner_id, *key)] += 1
+    ArchiveBucket.objects.all().delete()
+    ArchiveBucket.objects.bulk_create(
+        [ArchiveBucket(owner_id=owner, year=y, month=m, day=d, count=n) for (owner, y, m, d), n in counts.items()],
+        batch_size=1000,
+    )
+    return len(counts)
+
+
+def period_range(year, month=None, day=None):
+    """Aware ``[start, end)`` datetimes of a year, month or day; ``ValueError`` if invalid"""
+    if day:
+        start = date(year, month, day)
+        end = start + timedelta(days=1)
+    elif month:
+        start = date(year, month, 1)
+        end = date(year + month // 12, month % 12 + 1, 1)
+    else:
+        start, end = date(year, 1, 1), date(year + 1, 1, 1)
+    return tuple(timezone.make_aware(datetime.combine(d, datetime.min.time())) for d in (start, end))
+
+
+def timeline(owner_id=None):
+    """Years, newest first, each with its count and its months' counts"""
+    buckets = ArchiveBucket.objects.filter(owner_id=owner_id, day=0, count__gt=0).order_by('-year', 'month')
+    years = []
+    for bucket in buckets:
+        if bucket.month == 0:
+            years.append({'year': bucket.year, 'count': bucket.count, 'months': []})
+        elif years and years[-1]['year'] == bucket.year:
+            years[-1]['months'].append({'month': bucket.month, 'count': bucket.count})
+    return years
+
+
+def days(owner_id, year, month):
+    """``[(day, count), ...]`` of the days of a month holding photos"""
+    return list(
+        ArchiveBucket.objects.filter(owner_id=owner_id, year=year, month=month, day__gt=0, count__gt=0)
+        .order_by('day').values_list('day', 'count')
+    )
+
+
+def period_count(owner_id, year, month=None, day=None):
+    bucket = ArchiveBucket.objects.filter(
+        owner_id=owner_id, year=year, month=month or 0, day=day or 0).values_list('count', flat=True).first()
+    return bucket or 0
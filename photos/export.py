@@ -0,0 +1,292 @@
+"""Streaming ZIP export of a user's photos.
+
+The archive holds ``manifest.json`` (titles, tags and metadata) and every
+original, stored uncompressed (photos are already compressed) and written on
+the fly: each file is read from storage in ``CHUNK_SIZE`` pieces and its
+CRC-32 is sent in a data descriptor after the data, so memory stays constant
+however large the export and nothing is written to disk.
+
+Because the layout depends only on the photo list and file sizes, the total
+length and each entry's offset are known before the first byte is sent. That
+gives downloads a ``Content-Length`` and lets an interrupted download resume
+with an HTTP ``Range`` request (or ``manage.py export_photos --resume``).
+Resuming still needs the CRC of files before the resume point; they are
+cached as files are streamed and otherwise recomputed by reading the files
+without sending them.
+"""
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
+from django.utils.text import slugify
+
+from . import object_cache
+from .aio import alogin_required, get_user, run_io
+from .models import Photo
+
+CHUNK_SIZE = 64 * 1024
+CRC_CACHE_TIMEOUT = 30 * 24 * 60 * 60
+
+# ZIP format: stored entries with a data descriptor (flag bit 3), UTF-8 names (bit 11)
+_FLAGS = 0x0008 | 0x0800
+_ZIP64_LIMIT = 0xFFFFFFFF     # offsets and sizes from here on need ZIP64 records
+_MAX32 = 0xFFFFFFFF
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_DATA_DESCRIPTOR = struct.Struct('<IIII')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END_RECORD = struct.Struct('<IHHHHIIH')
+_ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+_ZIP64_LOCATOR = struct.Struct('<IIQI')
+
+
+class ExportError(Exception):
+    """Raised when a stored file no longer matches the planned archive"""
+
+
+class _Entry:
+    __slots__ = ('arcname', 'size', 'dos_time', 'dos_date', 'data', 'storage', 'name', 'crc', 'offset')
+
+    def __init__(self, arcname, size, modified, data=None, storage=None, name=None):
+        self.arcname = arcname.encode()
+        self.size = size
+        local = timezone.localtime(modified)
+        self.dos_time = local.hour << 11 | local.minute << 5 | local.second // 2
+        self.dos_date = max(local.year - 1980, 0) << 9 | local.month << 5 | local.day
+        self.data, self.storage, self.name = data, storage, name
+        self.crc = zlib.crc32(data) if data is not None else None
+        self.offset = 0
+
+    @property
+    def crc_key(self):
+        return 'export_crc:' + hashlib.md5(f'{self.name}|{self.size}'.encode()).hexdigest()
+
+    def local_header(self):
+        return _LOCAL_HEADER.pack(
+            0x04034b50, 20, _FLAGS, 0, self.dos_time, self.dos_date, 0, 0, 0, len(self.arcname), 0,
+        ) + self.arcname
+
+    def data_descriptor(self):
+        return _DATA_DESCRIPTOR.pack(0x08074b50, self.crc, self.size, self.size)
+
+    def central_header(self):
+        zip64 = self.offset >= _ZIP64_LIMIT
+        extra = struct.pack('<HHQ', 0x0001, 8, self.offset) if zip64 else b''
+        return _CENTRAL_HEADER.pack(
+            0x02014b50, 0x0300 | 45, 45 if zip64 else 20, _FLAGS, 0, self.dos_time, self.dos_date,
+            self.crc, self.size, self.size, len(self.arcname), len(extra), 0, 0, 0,
+            0o100644 << 16, _MAX32 if zip64 else self.offset,
+        ) + self.arcname + extra
+
+    def central_header_size(self):
+        return _CENTRAL_HEADER.size + len(self.arcname) + (12 if self.offset >= _ZIP64_LIMIT else 0)
+
+
+class PhotoArchive:
+    """A planned ZIP: its length and ETag are known before any byte is produced"""
+
+    def __init__(self, entries):
+        self.entries = entries
+        offset = 0
+        for entry in entries:
+            if entry.size >= _MAX32:
+                raise ExportError(f'{entry.name} is too large to export')
+            entry.offset = offset
+            offset += _LOCAL_HEADER.size + len(entry.arcname) + entry.size + _DATA_DESCRIPTOR.size
+        self.central_offset = offset
+        self.central_size = sum(entry.central_header_size() for entry in entries)
+        self.zip64 = (self.central_offset + self.central_size >= _ZIP64_LIMIT or len(entries) >= 0xFFFF)
+        end_size = _END_RECORD.size + (_ZIP64_END_RECORD.size + _ZIP64_LOCATOR.size if self.zip64 else 0)
+        self.size = self.central_offset + self.central_size + end_size
+        plan = [(entry.arcname, entry.name, entry.size, entry.crc if entry.data is not None else None)
+                for entry in entries]
+        self.etag = '"%s"' % hashlib.md5(repr(plan).encode(), usedforsecurity=False).hexdigest()
+
+    def iter_bytes(self, start=0, stop=None):
+        """Yield the archive bytes in ``[start, stop)``"""
+        stop = self.size if stop is None else stop
+        pos = 0
+        for entry in self.entries:
+            if pos >= stop:
+                return
+            header = entry.local_header()
+            yield from _window(header, pos, start, stop)
+            pos += len(header)
+            if pos + entry.size > start and pos < stop:
+                yield from self._entry_data(entry, max(start - pos, 0), min(stop - pos, entry.size))
+            pos += entry.size
+            # The CRC may mean reading the whole file: only when the descriptor is sent
+            if pos + _DATA_DESCRIPTOR.size > start and pos < stop:
+                self._ensure_crc(entry)
+                yield from _window(entry.data_descriptor(), pos, start, stop)
+            pos += _DATA_DESCRIPTOR.size
+
+        if pos >= stop:
+            return
+        for entry in self.entries:
+            if pos >= stop:
+                return
+            header_size = entry.central_header_size()
+            if pos + header_size > start:
+                self._ensure_crc(entry)
+                yield from _window(entry.central_header(), pos, start, stop)
+            pos += header_size
+        yield from _window(self._end_records(), pos, start, stop)
+
+    def _entry_data(self, entry, skip, end):
+        if entry.data is not None:
+            yield entry.data[skip:end]
+            return
+        with entry.storage.open(entry.name, 'rb') as f:
+            crc, read = None, 0
+            if skip and entry.crc is not None and f.seekable():
+                f.seek(skip)
+                read = skip
+            else:
+                crc = 0  # the CRC is only known by reading the file from its start
+            while read < end:
+                chunk = f.read(min(CHUNK_SIZE, end - read) if crc is None else CHUNK_SIZE)
+                if not chunk:
+                    break
+                if crc is not None:
+                    crc = zlib.crc32(chunk, crc)
+                if read + len(chunk) > skip:
+                    yield chunk[max(skip - read, 0):end - read]
+                read += len(chunk)
+            if read < end or (crc is not None and end == entry.size and (read > end or f.read(1))):
+                raise ExportError(f'{entry.name} changed size during the export')
+            if crc is not None and end == entry.size:
+                self._store_crc(entry, crc)
+
+    def _ensure_crc(self, entry):
+        if entry.crc is not None:
+            return
+        crc, read = 0, 0
+        with entry.storage.open(entry.name, 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                crc = zlib.crc32(chunk, crc)
+                read += len(chunk)
+        if read != entry.size:
+            raise ExportError(f'{entry.name} changed size during the export')
+        self._store_crc(entry, crc)
+
+    def _store_crc(self, entry, crc):
+        entry.crc = crc
+        cache.set(entry.crc_key, crc, CRC_CACHE_TIMEOUT)
+
+    def _end_records(self):
+        count = len(self.entries)
+        if not self.zip64:
+            return _END_RECORD.pack(0x06054b50, 0, 0, count, count, self.central_size, self.central_offset, 0)
+        zip64_end_offset = self.central_offset + self.central_size
+        return (
+            _ZIP64_END_RECORD.pack(0x06064b50, _ZIP64_END_RECORD.size - 12, 0x0300 | 45, 45, 0, 0,
+                                   count, count, self.central_size, self.central_offset)
+            + _ZIP64_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1)
+            + _END_RECORD.pack(0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF), _MAX32, _MAX32, 0)
+        )
+
+
+def _window(data, pos, start, stop):
+    """The part of ``data`` (found at ``pos``) inside ``[start, stop)``, as a one-item iterable"""
+    if pos + len(data) <= start or pos >= stop:
+        return ()
+    return (data[max(start - pos, 0):stop - pos],)
+
+
+def build_archive(user):
+    """Plan the export of all of ``user``'s photos"""
+    photos = list(
+        Photo.objects.filter(owner=user).exclude(image='').select_related('category')
+        .prefetch_related('tags').order_by('created_at', 'pk')
+    )
+    entries, manifest = [], []
+    storage = Photo._meta.get_field('image').storage
+    stale = []
+    for photo in photos:
+        # The archive layout must match the stored bytes exactly, so the
+        # recorded file_size is only a cache: refresh it when it is wrong
+        size = storage.size(photo.image.name)
+        if photo.file_size != size:
+            photo.file_size = size
+            stale.append(photo)
+        extension = os.path.splitext(photo.image.name)[1].lower()
+        arcname = f'photos/{photo.pk}-{slugify(photo.title, allow_unicode=True) or "photo"}{extension}'
+        entries.append(_Entry(arcname, size, photo.created_at, storage=storage, name=photo.image.name))
+        manifest.append({
+            'id': photo.pk,
+            'file': arcname,
+            'title': photo.title,
+            'description': photo.description,
+            'category': photo.category.name if photo.category else None,
+            'tags': sorted(tag.name for tag in photo.tags.all()),
+            'privacy': photo.privacy,
+            'created_at': photo.created_at.isoformat(),
+            'updated_at': photo.updated_at.isoformat(),
+            'width': photo.width,
+            'height': photo.height,
+            'file_size': size,
+        })
+    if stale:
+        Photo.objects.bulk_update(stale, ['file_size'])
+        object_cache.bump_photos(stale)
+    # Deterministic (no export time, no view counts) so a resumed download matches
+    data = json.dumps({'user': user.username, 'photos': manifest}, ensure_ascii=False, indent=2).encode()
+    crcs = cache.get_many([entry.crc_key for entry in entries])
+    for entry in entries:
+        entry.crc = crcs.get(entry.crc_key)
+    modified = max((photo.updated_at for photo in photos), default=user.date_joined)
+    entries.insert(0, _Entry('manifest.json', len(data), modified, data=data))
+    return PhotoArchive(entries)
+
+
+def parse_range(header, size):
+    """``(start, stop)`` of a single ``bytes=`` range, ``None`` without one; ``ValueError`` if unsatisfiable"""
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    if not first:
+        start, stop = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        stop = min(int(last) + 1, size) if last else size
+    if start >= stop:
+        raise ValueError(header)
+    return start, stop
+
+
+@alogin_required
+async def download(request):
+    """The signed-in user's photos as a ZIP, resumable with ``Range``"""
+    user = await get_user(request)
+    archive = await sync_to_async(build_archive)(user)
+
+    byte_range = None
+    if request.headers.get('If-Range', archive.etag) == archive.etag:
+        try:
+            byte_range = parse_range(request.headers.get('Range'), archive.size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{archive.size}'
+            return response
+    start, stop = byte_range or (0, archive.size)
+
+    async def body():
+        chunks = archive.iter_bytes(start, stop)
+        while (chunk := await run_io(next, chunks, None)) is not None:
+            yield chunk
+
+    response = StreamingHttpResponse(body(), content_type='application/zip', status=206 if byte_range else 200)
+    response['Content-Length'] = stop - start
+    if byte_range:
+        response['Content-Range'] = f'bytes {start}-{stop - 1}/{archive.size}'
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = archive.etag
+    response['Content-Disposition'] = content_disposition_header(True, f'photos-{user.username}.zip')
+    return response
@@ -0,0 +1,138 @@
+"""Materialised home feeds.
+
+Publishing a photo fans it out to ``FeedEntry`` rows for the owner and each
+accepted friend through the background job queue (never inside the upload
+request), so reading a feed page is a range scan of the
+``(user, -created_at, -photo)`` index. Owners with more than
+``FANOUT_MAX_FOLLOWERS`` friends are not fanned out; their photos are pulled
+at read time and merged into the page instead. ``manage.py trim_feeds`` caps
+each feed at ``MAX_ENTRIES``.
+"""
+import heapq
+
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from accounts.models import Friendship
+from photoalbum.instrumentation import record_cache
+
+from .jobs import job
+from .models import FeedEntry, Photo
+from .pagination import CursorPage, decode_cursor, encode_position
+
+FANOUT_MAX_FOLLOWERS = 5000
+FANOUT_BATCH_SIZE = 1000
+BACKFILL_PHOTOS = 50
+MAX_ENTRIES = 1000
+HEAVY_OWNERS_CACHE_KEY = 'feed:heavy_owners'
+HEAVY_OWNERS_CACHE_TIMEOUT = 10 * 60
+
+SHARED_PRIVACY = ('public', 'friends')
+
+
+def heavy_owner_ids():
+    """Ids of users with too many friends to fan out to, cached"""
+    ids = cache.get(HEAVY_OWNERS_CACHE_KEY)
+    record_cache('feed_heavy_owners', ids is not None)
+    if ids is None:
+        ids = frozenset(
+            Friendship.objects.filter(status=Friendship.ACCEPTED)
+            .values('from_user').annotate(followers=Count('id'))
+            .filter(followers__gt=FANOUT_MAX_FOLLOWERS).values_list('from_user', flat=True)
+        )
+        cache.set(HEAVY_OWNERS_CACHE_KEY, ids, HEAVY_OWNERS_CACHE_TIMEOUT)
+    return ids
+
+
+def _insert(photo, user_ids):
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), FANOUT_BATCH_SIZE):
+        FeedEntry.objects.bulk_create([
+            FeedEntry(user_id=user_id, photo_id=photo['id'], owner_id=photo['owner_id'],
+                      created_at=photo['created_at'])
+            for user_id in user_ids[start:start + FANOUT_BATCH_SIZE]
+        ], ignore_conflicts=True)
+
+
+@job('feed_fanout')
+def fanout(photo_id):
+    photo = (Photo.objects.filter(pk=photo_id, privacy__in=SHARED_PRIVACY)
+             .values('id', 'owner_id', 'created_at').first())
+    if photo is None:
+        return
+    followers = list(Friendship.objects.filter(from_user_id=photo['owner_id'], status=Friendship.ACCEPTED)
+                     .values_list('to_user_id', flat=True)[:FANOUT_MAX_FOLLOWERS + 1])
+    if len(followers) > FANOUT_MAX_FOLLOWERS:
+        # Readers pull this owner's photos instead (fan-out on read)
+        followers = []
+    _insert(photo, [photo['owner_id']] + followers)
+
+
+@job('feed_retract')
+def retract(photo_id):
+    FeedEntry.objects.filter(photo_id=photo_id).delete()
+
+
+@job('feed_backfill')
+def backfill(user_id, owner_id):
+    """Copy an owner's recent photos into a new friend's feed"""
+    if owner_id != user_id and owner_id in heavy_owner_ids():
+        return
+    photos = (Photo.objects.filter(owner_id=owner_id, privacy__in=SHARED_PRIVACY)
+              .order_by('-created_at', '-id').values('id', 'owner_id', 'created_at')[:BACKFILL_PHOTOS])
+    for photo in photos:
+        _insert(photo, [user_id])
+
+
+@job('feed_unlink')
+def unlink(user_id, owner_id):
+    FeedEntry.objects.filter(user_id=user_id, owner_id=owner_id).delete()
+
+
+def trim(user_id, max_entries=MAX_ENTRIES):
+    """Drop everything past the newest ``max_entries`` of a feed"""
+    boundary = (FeedEntry.objects.filter(user_id=user_id).order_by('-created_at', '-photo_id')
+                .values_list('created_at', 'photo_id')[max_entries:max_entries + 1].first())
+    if boundary is None:
+        return 0
+    created_at, photo_id = boundary
+    deleted, _ = FeedEntry.objects.filter(user_id=user_id).filter(
+        Q(created_at__lt=created_at) | Q(created_at=created_at, photo_id__lte=photo_id)
+    ).delete()
+    return deleted
+
+
+def _after(queryset, cursor, pk_field):
+    if not cursor:
+        return queryset
+    created_at, pk = decode_cursor(cursor)
+    return queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, **{f'{pk_field}__lt': pk}))
+
+
+def feed_page(user, cursor=None, limit=12):
+    """Return a ``CursorPage`` of the user's home feed"""
+    candidates = [
+        _after(FeedEntry.objects.filter(user_id=user.pk), cursor, 'photo_id')
+        .order_by('-created_at', '-photo_id').values_list('created_at', 'photo_id')[:limit + 1]
+    ]
+    pulled = Friendship.objects.friend_ids(user.pk) & heavy_owner_ids()
+    if pulled:
+        candidates.append(
+            _after(Photo.objects.filter(owner_id__in=pulled, privacy__in=SHARED_PRIVACY), cursor, 'id')
+            .order_by('-created_at', '-id').values_list('created_at', 'id')[:limit + 1]
+        )
+
+    # Merge the newest-first streams, dropping photos present in both
+    keys, seen = [], set()
+    for key in heapq.merge(*map(list, candidates), reverse=True):
+        if key[1] not in seen:
+            seen.add(key[1])
+            keys.append(key)
+        if len(keys) > limit:
+            break
+
+    # Re-check visibility in case the feed has not caught up with an unfriend
+    photos = (Photo.objects.visible_to(user).filter(pk__in=[pk for _, pk in keys[:limit]])
+              .select_related('owner').order_by('-created_at', '-id'))
+    next_cursor = encode_position(*keys[limit - 1]) if len(keys) > limit else None
+    return CursorPage(list(photos), next_cursor)
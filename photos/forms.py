@@ -1,5 +1,15 @@
 from django import forms
-from .models import Photo, PhotoCategory, PhotoTag
+from .models import Photo, PhotoCategory, PhotoTag, normalize_tag
+
+
+def split_tags(tags_str):
+    """Split a comma-separated tag string, dropping blanks and near-duplicates"""
+    names = {}
+    for name in tags_str.replace('，', ',').split(','):
+        name = name.strip()
+        if name:
+            names.setdefault(normalize_tag(name), name)
+    return list(names.values())
 
 
 class PhotoUploadForm(forms.ModelForm):
@@ -9,7 +19,9 @@ class PhotoUploadForm(forms.ModelForm):
         required=False,
         widget=forms.TextInput(attrs={
             'class': 'form-control',
-            'placeholder': '例如: 風景, 建築, 肖像'
+            'placeholder': '例如: 風景, 建築, 肖像',
+            'autocomplete': 'off',
+            'data-tag-autocomplete': '',
         })
     )
 
@@ -52,9 +64,8 @@ class PhotoUploadForm(forms.ModelForm):
         # Handle tags
         tags_str = self.cleaned_data.get('tags', '')
         if tags_str:
-            tag_names = [tag.strip() for tag in tags_str.split(',') if tag.strip()]
-            for tag_name in tag_names:
-                tag, created = PhotoTag.objects.get_or_create(name=tag_name)
+            for tag_name in split_tags(tags_str):
+                tag, created = PhotoTag.objects.get_or_create_normalized(tag_name)
                 instance.tags.add(tag)
         
         return instance
@@ -67,7 +78,9 @@ class PhotoEditForm(forms.ModelForm):
         required=False,
         widget=forms.TextInput(attrs={
             'class': 'form-control',
-            'placeholder': '例如: 風景, 建築, 肖像'
+            'placeholder': '例如: 風景, 建築, 肖像',
+            'autocomplete': 'off',
+            'data-tag-autocomplete': '',
         })
     )
 
@@ -101,9 +114,8 @@ class PhotoEditForm(forms.ModelForm):
         # Handle tags
         tags_str = self.cleaned_data.get('tags', '')
         if tags_str:
-            tag_names = [tag.strip() for tag in tags_str.split(',') if tag.strip()]
-            for tag_name in tag_names:
-                tag, created = PhotoTag.objects.get_or_create(name=tag_name)
+            for tag_name in split_tags(tags_str):
+                tag, created = PhotoTag.objects.get_or_create_normalized(tag_name)
                 instance.tags.add(tag)
         
         return instance
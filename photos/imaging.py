@@ -0,0 +1,341 @@
+"""Image pipeline helpers shared by the Photo model and management commands"""
+import base64
+import os
+import shutil
+import subprocess
+import tempfile
+from collections import namedtuple
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageOps, ImageSequence
+
+
+# Longest edge of the inline low-quality placeholder, in pixels
+PLACEHOLDER_SIZE = 20
+PLACEHOLDER_QUALITY = 40
+
+# Side of the square sample used to estimate the dominant colour
+COLOR_SAMPLE_SIZE = 32
+
+
+def format_for_name(name):
+    """Pillow format name (e.g. ``JPEG``) implied by a file name's extension"""
+    return Image.registered_extensions()[os.path.splitext(name)[1].lower()]
+
+
+def to_rgb(img):
+    """Return an RGB copy of the image, flattening transparency onto white"""
+    if img.mode == 'RGB':
+        return img
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        rgba = img.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.split()[-1])
+        return background
+    return img.convert('RGB')
+
+
+def placeholder_data_uri(img, size=PLACEHOLDER_SIZE):
+    """Encode a tiny WebP preview of the image as a ``data:`` URI"""
+    small = to_rgb(img).copy()
+    small.thumbnail((size, size), Image.Resampling.BILINEAR)
+    buffer = BytesIO()
+    small.save(buffer, format='WEBP', quality=PLACEHOLDER_QUALITY, method=6)
+    encoded = base64.b64encode(buffer.getvalue()).decode('ascii')
+    return f'data:image/webp;base64,{encoded}'
+
+
+def square_webp(img, size, quality=80):
+    """Centre-crop the image to a ``size``-pixel square and encode it as WebP"""
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'PA') else 'RGB')
+    square = ImageOps.fit(img, (size, size), Image.Resampling.LANCZOS)
+    buffer = BytesIO()
+    square.save(buffer, format='WEBP', quality=quality, method=6)
+    return buffer.getvalue()
+
+
+def color_sample(img, size=COLOR_SAMPLE_SIZE):
+    """Downsample the image to a ``(size * size, 3)`` uint8 pixel array"""
+    sample = to_rgb(img).resize((size, size), Image.Resampling.BILINEAR)
+    return np.asarray(sample, dtype=np.uint8).reshape(-1, 3)
+
+
+def dominant_colors(samples):
+    """Return the dominant colour of each sample as a ``#rrggbb`` string.
+
+    ``samples`` is a ``(N, P, 3)`` uint8 array of N images with P pixels each.
+    Pixels are quantised to 4 bits per channel, the most populated bucket of
+    every image is found with a single ``bincount`` over the whole batch, and
+    the colour is the mean of the original pixels that fell into that bucket.
+    """
+    samples = np.asarray(samples, dtype=np.uint8)
+    if samples.ndim == 2:
+        samples = samples[np.newaxis]
+    count, pixels, _ = samples.shape
+    if count == 0:
+        return []
+
+    quantised = (samples >> 4).astype(np.int32)
+    buckets = (quantised[..., 0] << 8) | (quantised[..., 1] << 4) | quantised[..., 2]
+    offsets = np.arange(count, dtype=np.int32)[:, np.newaxis] * 4096
+    histogram = np.bincount((buckets + offsets).ravel(), minlength=count * 4096)
+    top = histogram.reshape(count, 4096).argmax(axis=1)
+
+    mask = buckets == top[:, np.newaxis]
+    totals = (samples.astype(np.float64) * mask[..., np.newaxis]).sum(axis=1)
+    means = np.rint(totals / mask.sum(axis=1, keepdims=True)).astype(np.uint8)
+    return ['#%02x%02x%02x' % tuple(int(c) for c in row) for row in means]
+
+
+def dominant_color(img):
+    """Return the dominant colour of a single image as ``#rrggbb``"""
+    return dominant_colors(color_sample(img))[0]
+
+
+# Caps applied when transcoding animated GIF/WebP uploads
+ANIMATION_MAX_FRAMES = 300
+ANIMATION_MAX_DURATION_MS = 30000
+ANIMATION_MAX_SIDE = 720
+ANIMATION_WEBP_QUALITY = 70
+DEFAULT_FRAME_MS = 100
+MIN_FRAME_MS = 20  # browsers clamp faster GIF frames anyway
+
+
+def is_animated(img):
+    """True for multi-frame GIF/WebP/PNG images"""
+    return getattr(img, 'is_animated', False) and getattr(img, 'n_frames', 1) > 1
+
+
+def animation_frames(img, max_frames=ANIMATION_MAX_FRAMES,
+                     max_duration_ms=ANIMATION_MAX_DURATION_MS, max_side=ANIMATION_MAX_SIDE):
+    """Decode frames of an animated image, downscaled and capped.
+
+    Returns ``(frames, durations)`` where frames are RGBA images no larger
+    than ``max_side`` and durations are in milliseconds.
+    """
+    frames, durations, total = [], [], 0
+    for index, frame in enumerate(ImageSequence.Iterator(img)):
+        if index >= max_frames or total >= max_duration_ms:
+            break
+        duration = max(MIN_FRAME_MS, int(frame.info.get('duration') or DEFAULT_FRAME_MS))
+        rgba = frame.convert('RGBA')
+        rgba.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+        frames.append(rgba)
+        durations.append(duration)
+        total += duration
+    return frames, durations
+
+
+def encode_animated_webp(frames, durations, quality=ANIMATION_WEBP_QUALITY):
+    """Encode frames as a looping lossy animated WebP"""
+    buffer = BytesIO()
+    frames[0].save(
+        buffer, format='WEBP', save_all=True, append_images=frames[1:],
+        duration=durations, loop=0, quality=quality, method=4,
+    )
+    return buffer.getvalue()
+
+
+def encode_mp4(frames, durations, ffmpeg=None):
+    """Encode frames as a muted H.264 MP4 with a local ffmpeg binary.
+
+    Returns ``None`` when no encoder is available or encoding fails; the
+    animated WebP is always produced, so the video is an optional extra.
+    """
+    ffmpeg = ffmpeg or shutil.which('ffmpeg')
+    if not ffmpeg or not frames:
+        return None
+
+    width, height = frames[0].size
+    fps = max(1, round(1000 * len(durations) / sum(durations)))
+    raw = b''.join(to_rgb(frame.resize((width, height))).tobytes() for frame in frames)
+
+    with tempfile.NamedTemporaryFile(suffix='.mp4') as output:
+        command = [
+            ffmpeg, '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+            '-an', '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '28', '-pix_fmt', 'yuv420p',
+            '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', '-movflags', '+faststart',
+            output.name,
+        ]
+        try:
+            subprocess.run(command, input=raw, check=True, timeout=120, capture_output=True)
+        except (OSError, subprocess.SubprocessError):
+            return None
+        output.seek(0)
+        return output.read() or None
+
+
+# Adaptive still-image encoding: the lowest quality whose SSIM against the
+# source still reaches the target, in whichever format is smallest
+SSIM_TARGET_ORIGINAL = 0.99
+SSIM_TARGET_THUMBNAIL = 0.98
+SSIM_WINDOW = 8
+MIN_QUALITY = 40
+MAX_QUALITY = 95
+# Quality searches on larger images run on a mosaic of tiles of this size
+SEARCH_MAX_PIXELS = 768 * 768
+SEARCH_TILE = 384
+# Faster WebP effort while searching; the final encode uses WEBP_METHOD
+SEARCH_WEBP_METHOD = 1
+WEBP_METHOD = 4
+# Images with at most this many colours (screenshots, diagrams) are also
+# tried as lossless PNG
+GRAPHIC_MAX_COLORS = 4096
+
+EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp', 'PNG': '.png'}
+
+Encoded = namedtuple('Encoded', 'data format quality score')
+
+
+def ssim(a, b, window=SSIM_WINDOW):
+    """Mean structural similarity of two equally sized luma arrays.
+
+    Statistics are taken over non-overlapping ``window``-pixel blocks rather
+    than a sliding Gaussian, which is far cheaper and plenty to rank
+    encoder settings against each other.
+    """
+    a, b = _blocks(a, window), _blocks(b, window)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mu_a, mu_b = a.mean(axis=(1, 3)), b.mean(axis=(1, 3))
+    var_a, var_b = a.var(axis=(1, 3)), b.var(axis=(1, 3))
+    covariance = (a * b).mean(axis=(1, 3)) - mu_a * mu_b
+    similarity = ((2 * mu_a * mu_b + c1) * (2 * covariance + c2)) / (
+        (mu_a * mu_a + mu_b * mu_b + c1) * (var_a + var_b + c2))
+    return float(similarity.mean())
+
+
+def _blocks(values, window):
+    """View a 2-D array as ``(rows, window, columns, window)`` blocks, cropping the edges"""
+    values = np.asarray(values, dtype=np.float32)
+    rows, columns = values.shape[0] // window, values.shape[1] // window
+    return values[:rows * window, :columns * window].reshape(rows, window, columns, window)
+
+
+def luma(img):
+    return np.asarray(to_rgb(img).convert('L'), dtype=np.float32)
+
+
+def prepare_for_encoding(img):
+    """Apply the EXIF orientation and drop metadata except the colour profile"""
+    icc_profile = img.info.get('icc_profile')
+    img = ImageOps.exif_transpose(img)
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+    img = img.convert('RGBA' if has_alpha else 'RGB')
+    img.info = {'icc_profile': icc_profile} if icc_profile else {}
+    return img
+
+
+def encode_adaptive(img, target=SSIM_TARGET_ORIGINAL, formats=('JPEG', 'WEBP', 'PNG')):
+    """Encode ``img`` as small as possible while keeping SSIM >= ``target``.
+
+    Lossy formats get a binary search over quality; JPEG is skipped for
+    images with transparency and lossless PNG is only tried for graphics
+    with few colours. Returns an ``Encoded(data, format, quality, score)``.
+    """
+    img = prepare_for_encoding(img)
+    has_alpha = img.mode == 'RGBA'
+    sample = _search_sample(img)
+    reference = luma(sample)
+    scale = img.width * img.height / (sample.width * sample.height)
+
+    # Search every lossy format on the sample, then encode only the
+    # smallest at full size
+    searched = []
+    for fmt in formats:
+        if fmt == 'PNG' or (fmt == 'JPEG' and has_alpha):
+            continue
+        quality, score, size = _search_quality(sample, reference, fmt, target)
+        searched.append((size * scale, fmt, quality, score))
+    candidates = []
+    if searched:
+        # Formats reaching the target compete on size; failing that, the closest one wins
+        reached = [entry for entry in searched if entry[3] >= target]
+        _size, fmt, quality, score = min(reached) if reached else max(searched, key=lambda entry: entry[3])
+        candidates.append(Encoded(_encode(img, fmt, quality), fmt, quality, score))
+    if 'PNG' in formats and _is_graphic(img):
+        candidates.append(Encoded(_encode(img, 'PNG'), 'PNG', None, 1.0))
+    return min(candidates, key=lambda encoded: len(encoded.data))
+
+
+def _encode(img, fmt, quality=None, webp_method=WEBP_METHOD):
+    buffer = BytesIO()
+    options = {}
+    if img.info.get('icc_profile'):
+        options['icc_profile'] = img.info['icc_profile']
+    if fmt == 'JPEG':
+        options.update(quality=quality, optimize=True, progressive=True, subsampling='4:2:0' if quality < 90 else 0)
+    elif fmt == 'WEBP':
+        options.update(quality=quality, method=webp_method)
+    else:
+        options.update(optimize=True)
+        img = _exact_palette(img)
+    try:
+        img.save(buffer, format=fmt, **options)
+    except OSError:
+        if fmt != 'JPEG':
+            raise
+        # Pillow buffers optimised/progressive JPEGs in one byte per pixel,
+        # which noisy images at high quality exceed; baseline streams instead
+        buffer = BytesIO()
+        options.update(optimize=False, progressive=False)
+        img.save(buffer, format=fmt, **options)
+    return buffer.getvalue()
+
+
+def _search_quality(sample, reference, fmt, target):
+    """Lowest quality in [MIN_QUALITY, MAX_QUALITY] reaching ``target`` on ``sample``.
+
+    Returns ``(quality, score, encoded size of the sample)``.
+    """
+    low, high = MIN_QUALITY, MAX_QUALITY
+    best = None
+    while low <= high:
+        quality = (low + high) // 2
+        data = _encode(sample, fmt, quality, SEARCH_WEBP_METHOD)
+        with Image.open(BytesIO(data)) as decoded:
+            score = ssim(reference, luma(decoded))
+        if score >= target:
+            best = (quality, score, len(data))
+            high = quality - 1
+        else:
+            low = quality + 1
+    if best is None:
+        data = _encode(sample, fmt, MAX_QUALITY, SEARCH_WEBP_METHOD)
+        with Image.open(BytesIO(data)) as decoded:
+            best = (MAX_QUALITY, ssim(reference, luma(decoded)), len(data))
+    return best
+
+
+def _search_sample(img):
+    """The image itself, or a mosaic of tiles from its four quadrants if large"""
+    width, height = img.size
+    tile = SEARCH_TILE
+    if width * height <= SEARCH_MAX_PIXELS or width < 2 * tile or height < 2 * tile:
+        return img
+    mosaic = Image.new(img.mode, (2 * tile, 2 * tile))
+    for row in range(2):
+        for column in range(2):
+            # Centre of each quadrant, on the 16px grid of JPEG macroblocks
+            left = (width * (2 * column + 1) // 4 - tile // 2) // 16 * 16
+            top = (height * (2 * row + 1) // 4 - tile // 2) // 16 * 16
+            mosaic.paste(img.crop((left, top, left + tile, top + tile)), (column * tile, row * tile))
+    mosaic.info = img.info
+    return mosaic
+
+
+def _exact_palette(img):
+    """A palette copy of an RGB image with <= 256 colours, if it is lossless"""
+    if img.mode != 'RGB' or img.getcolors(256) is None:
+        return img
+    paletted = img.quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+    if np.array_equal(np.asarray(paletted.convert('RGB')), np.asarray(img)):
+        paletted.info = img.info
+        return paletted
+    return img
+
+
+def _is_graphic(img):
+    return img.getcolors(GRAPHIC_MAX_COLORS) is not None
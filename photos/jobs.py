@@ -0,0 +1,157 @@
+"""Minimal database-backed background job queue.
+
+Handlers are registered by name with ``@job('name')`` and scheduled with
+``enqueue('name', **payload)``. Jobs are only written once the surrounding
+transaction commits, so a rolled-back request never leaves work behind.
+
+``manage.py run_jobs`` processes the queue; the container entrypoint runs it
+next to the web server. With ``JOBS_EAGER`` enabled (the default under
+``DEBUG`` only) each job is also attempted in-process right after commit,
+i.e. inside the request that enqueued it; failures stay queued for a worker
+to retry. ``enqueue(..., eager=False)`` always leaves a job to the worker.
+
+Several workers may poll the same table: a job only runs in the worker whose
+conditional ``pending -> running`` update changed its row. ``reap_stale``
+requeues jobs left ``running`` by a worker that died, and ``purge_done``
+drops finished jobs; ``run_jobs`` calls both every few minutes.
+"""
+import logging
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from photoalbum.routers import use_primary
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 30
+# A job still running after this long is assumed to have lost its worker
+RUNNING_TIMEOUT = timedelta(minutes=30)
+DONE_RETENTION = timedelta(days=7)
+
+_handlers = {}
+
+
+def job(name):
+    """Register ``func`` as the handler for jobs called ``name``"""
+    def decorator(func):
+        _handlers[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, delay=None, eager=None, **payload):
+    """Schedule a job once the current transaction commits.
+
+    ``eager`` overrides ``JOBS_EAGER`` for this job.
+    """
+    if name not in _handlers:
+        raise KeyError(f'Unknown job "{name}"')
+
+    def create():
+        from .models import Job
+
+        run_after = timezone.now() + delay if delay else timezone.now()
+        created = Job.objects.create(name=name, payload=payload, run_after=run_after)
+        if (getattr(settings, 'JOBS_EAGER', False) if eager is None else eager) and not delay:
+            run_job(created.pk)
+
+    transaction.on_commit(create)
+
+
+def run_job(job_id):
+    """Claim and run a single pending job; returns True if it succeeded"""
+    claimed = _claim(job_id)
+    if claimed is None:
+        return False
+    return _execute(claimed)
+
+
+def run_pending(limit=100):
+    """Run up to ``limit`` due jobs; returns the number processed"""
+    from .models import Job
+
+    processed = 0
+    while processed < limit:
+        with transaction.atomic():
+            queryset = Job.objects.filter(status='pending', run_after__lte=timezone.now())
+            if connection.features.has_select_for_update_skip_locked:
+                queryset = queryset.select_for_update(skip_locked=True)
+            ids = list(queryset.values_list('pk', flat=True)[:min(50, limit - processed)])
+            if not ids:
+                break
+            # Without SKIP LOCKED (SQLite) another worker may have read the same
+            # ids; each row is claimed on its own and only the jobs this
+            # worker's update changed are run here
+            claimed = [job_obj for job_obj in map(_claim, ids) if job_obj is not None]
+        for job_obj in claimed:
+            _execute(job_obj)
+            processed += 1
+    return processed
+
+
+def reap_stale(timeout=RUNNING_TIMEOUT):
+    """Requeue jobs stuck in 'running' for longer than ``timeout``; returns their number.
+
+    Jobs that already used up their attempts are marked failed instead.
+    """
+    from .models import Job
+
+    now = timezone.now()
+    stale = Job.objects.filter(status='running', updated_at__lt=now - timeout)
+    error = f'No result after {timeout}; the worker running it stopped'
+    failed = stale.filter(attempts__gte=MAX_ATTEMPTS).update(status='failed', last_error=error, updated_at=now)
+    requeued = stale.update(status='pending', run_after=now, last_error=error, updated_at=now)
+    if failed or requeued:
+        logger.warning('Reaped %d stale jobs (%d failed)', failed + requeued, failed)
+    return failed + requeued
+
+
+def purge_done(older_than=DONE_RETENTION):
+    """Delete jobs that finished more than ``older_than`` ago; returns their number"""
+    from .models import Job
+
+    deleted, _ = Job.objects.filter(status='done', updated_at__lt=timezone.now() - older_than).delete()
+    return deleted
+
+
+def _claim(job_id):
+    """Mark a pending job as running; returns it, or None if another worker got there first"""
+    from .models import Job
+
+    claimed = Job.objects.filter(pk=job_id, status='pending').update(
+        status='running', attempts=F('attempts') + 1, updated_at=timezone.now(),
+    )
+    if not claimed:
+        return None
+    return Job.objects.get(pk=job_id)
+
+
+def _execute(job_obj):
+    handler = _handlers.get(job_obj.name)
+    try:
+        if handler is None:
+            raise LookupError(f'No handler registered for job "{job_obj.name}"')
+        # Jobs usually act on rows committed a moment ago, which replicas may not have yet
+        with use_primary():
+            handler(**job_obj.payload)
+    except Exception:
+        logger.exception('Job %s failed (attempt %d)', job_obj, job_obj.attempts)
+        job_obj.last_error = traceback.format_exc()[-4000:]
+        if job_obj.attempts >= MAX_ATTEMPTS:
+            job_obj.status = 'failed'
+        else:
+            job_obj.status = 'pending'
+            job_obj.run_after = timezone.now() + timedelta(
+                seconds=RETRY_BASE_SECONDS * 2 ** (job_obj.attempts - 1))
+        job_obj.save(update_fields=['status', 'run_after', 'last_error', 'updated_at'])
+        return False
+    job_obj.status = 'done'
+    job_obj.save(update_fields=['status', 'updated_at'])
+    return True
+
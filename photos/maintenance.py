@@ -0,0 +1,107 @@
+"""Bulk photo maintenance run as background jobs (admin actions, scripts).
+
+An admin action enqueues a single ``photo_action`` job describing the
+selection: the ticked photo ids, or the changelist's filter and search
+parameters after "select all". The job works through the selection in id
+order, ``BATCH_SIZE`` photos at a time, enqueuing itself again for the next
+batch, so the request returns immediately however many photos match and a
+failing batch is retried on its own.
+"""
+import logging
+
+from django.contrib.auth.models import User
+from django.http import HttpRequest, QueryDict
+from PIL import Image
+
+from . import object_cache, renditions
+from .jobs import enqueue, job
+from .models import Photo
+from .storage_gc import schedule_file_deletion
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+
+
+def enqueue_action(action, user, ids=None, params=None, **kwargs):
+    """Run ``action`` over ``ids``, or over the admin changelist ``params`` select, in the background.
+
+    The job always goes to the job worker, never runs in the enqueuing
+    request, whatever ``JOBS_EAGER`` says.
+    """
+    if action not in BATCH_ACTIONS:
+        raise KeyError(f'Unknown photo action "{action}"')
+    enqueue('photo_action', eager=False, action=action, user_id=user.pk, ids=ids, params=params, kwargs=kwargs)
+
+
+@job('photo_action')
+def photo_action(action, user_id, ids=None, params=None, kwargs=None, after=0):
+    photos = Photo.objects.filter(pk__in=ids) if ids is not None else _changelist_queryset(params, user_id)
+    batch = list(photos.filter(pk__gt=after).order_by('pk').values_list('pk', flat=True)[:BATCH_SIZE])
+    if not batch:
+        return
+    BATCH_ACTIONS[action](batch, **(kwargs or {}))
+    if len(batch) == BATCH_SIZE:
+        enqueue('photo_action', eager=False, action=action, user_id=user_id, ids=ids, params=params,
+                kwargs=kwargs, after=batch[-1])
+
+
+def _changelist_queryset(params, user_id):
+    """The photos the admin changelist shows for the query string ``params``"""
+    from django.contrib import admin
+
+    request = HttpRequest()
+    request.method = 'GET'
+    request.GET = QueryDict(params or '')
+    request.user = User.objects.get(pk=user_id)
+    model_admin = admin.site._registry[Photo]
+    return model_admin.get_changelist_instance(request).get_queryset(request)
+
+
+@job('regenerate_renditions')
+def regenerate_renditions(photo_ids):
+    """Render the missing or outdated renditions; the original is left alone"""
+    for photo in Photo.objects.filter(pk__in=photo_ids).exclude(image=''):
+        task = renditions.build_task(photo)
+        if task is None:
+            continue
+        result = renditions.render(task)
+        if result['error']:
+            logger.warning('Cannot render renditions of photo %s: %s', photo.pk, result['error'])
+            continue
+        for field, value in result['fields'].items():
+            setattr(photo, field, value)
+        photo.rendition_versions = {**(photo.rendition_versions or {}), **result['versions']}
+        photo.save(update_fields=[*result['fields'], 'rendition_versions'])
+        # Skipped by the job while the row still references them
+        schedule_file_deletion(result['stale'])
+
+
+@job('recompute_metadata')
+def recompute_metadata(photo_ids):
+    for photo in Photo.objects.filter(pk__in=photo_ids).exclude(image='').only('pk', 'owner', 'image'):
+        try:
+            with photo.image.storage.open(photo.image.name, 'rb') as f:
+                img = Image.open(f)
+                width, height = img.size
+            file_size = photo.image.size
+        except Exception:
+            logger.exception('Cannot read image of photo %s', photo.pk)
+            continue
+        Photo.objects.filter(pk=photo.pk).update(width=width, height=height, file_size=file_size)
+        object_cache.bump_photos([photo])
+
+
+@job('set_photo_privacy')
+def set_photo_privacy(photo_ids, privacy):
+    # Saved one by one so the feed signals fan out or retract each photo
+    for photo in Photo.objects.filter(pk__in=photo_ids).exclude(privacy=privacy):
+        photo.privacy = privacy
+        photo.save(update_fields=['privacy', 'updated_at'])
+
+
+BATCH_ACTIONS = {
+    'regenerate_renditions': regenerate_renditions,
+    'recompute_metadata': recompute_metadata,
+    'set_photo_privacy': set_photo_privacy,
+}
@@ -0,0 +1,24 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from accounts.models import Friendship
+from photos import feed
+
+
+class Command(BaseCommand):
+    help = 'Populate home feeds from existing photos and friendships'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only rebuild this username\'s feed')
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('pk')
+        if options['user']:
+            users = users.filter(username=options['user'])
+        count = 0
+        for user_id in users.values_list('pk', flat=True).iterator():
+            feed.backfill(user_id, user_id)
+            for friend_id in Friendship.objects.friend_ids(user_id):
+                feed.backfill(user_id, friend_id)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {count} feeds'))
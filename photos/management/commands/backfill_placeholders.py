@@ -0,0 +1,66 @@
+import numpy as np
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from photos import imaging, object_cache
+from photos.models import Photo
+
+
+class Command(BaseCommand):
+    help = 'Compute inline placeholders and dominant colours for existing photos'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Number of photos decoded and updated per batch')
+        parser.add_argument('--all', action='store_true',
+                            help='Recompute photos that already have a placeholder')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        photos = Photo.objects.order_by('pk').only('pk', 'owner', 'image', 'thumbnail')
+        if not options['all']:
+            photos = photos.filter(placeholder='')
+
+        updated = failed = 0
+        last_pk = 0
+        while True:
+            batch = list(photos.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            decoded, samples = [], []
+            for photo in batch:
+                img = self._open_source(photo)
+                if img is None:
+                    failed += 1
+                    continue
+                decoded.append(photo)
+                samples.append(imaging.color_sample(img))
+                photo.placeholder = imaging.placeholder_data_uri(img)
+
+            if not decoded:
+                continue
+            # One vectorised pass computes the dominant colour of the whole batch
+            for photo, color in zip(decoded, imaging.dominant_colors(np.stack(samples))):
+                photo.dominant_color = color
+            Photo.objects.bulk_update(decoded, ['placeholder', 'dominant_color'])
+            object_cache.bump_photos(decoded)
+            updated += len(decoded)
+            self.stdout.write(f'Processed {updated} photos (last id {last_pk})')
+
+        self.stdout.write(self.style.SUCCESS(f'Updated {updated} photos, {failed} could not be read.'))
+
+    def _open_source(self, photo):
+        """Open the thumbnail if present, falling back to the original image"""
+        for field in (photo.thumbnail, photo.image):
+            if not field:
+                continue
+            try:
+                with field.storage.open(field.name, 'rb') as f:
+                    img = Image.open(f)
+                    img.load()
+                return img
+            except Exception as e:
+                self.stderr.write(f'Photo {photo.pk}: cannot read {field.name}: {e}')
+        return None
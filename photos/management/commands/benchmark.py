@@ -0,0 +1,235 @@
+import json
+import platform
+import subprocess
+import time
+from datetime import datetime, timezone as dt_timezone
+
+import django
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import URLPattern, reverse
+from django.utils import timezone
+
+from accounts import urls as accounts_urls
+from photos import syndication, urls as photos_urls
+from photos.management.synthetic import encode_jpeg, pick_size, synthetic_image
+from photos.models import Photo, PhotoCategory, PhotoTag
+
+# Routes that change server-side state on GET, or only accept POST, are not benchmarked
+SKIPPED_ROUTES = {
+    'accounts:logout', 'accounts:friend_request', 'accounts:friend_accept',
+    'accounts:friend_remove', 'accounts:friend_block', 'accounts:friend_unblock',
+    'photos:export',  # streams every original of the user
+}
+
+
+class Command(BaseCommand):
+    help = ('Benchmark every photos/accounts route (latency percentiles, queries per request, '
+            'throughput) and the upload pipeline; writes JSON that can be diffed between commits')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help='Timed requests per route')
+        parser.add_argument('--warmup', type=int, default=5, help='Untimed requests per route')
+        parser.add_argument('--uploads', type=int, default=10,
+                            help='Images pushed through the upload view (0 to skip)')
+        parser.add_argument('--user', help='Username for authenticated routes (default: most prolific uploader)')
+        parser.add_argument('--routes', help='Comma-separated route names to run, e.g. photos:home')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--baseline', help='Previous JSON report to compare against')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        self.user = self._benchmark_user(options['user'])
+        self.anonymous = Client(HTTP_HOST=self._host())
+        self.authenticated = Client(HTTP_HOST=self._host())
+        self.authenticated.force_login(self.user)
+
+        params = self._route_params()
+        selected = set(options['routes'].split(',')) if options['routes'] else None
+
+        report = {'meta': self._meta(), 'routes': {}, 'upload': None}
+        for name, pattern in self._routes():
+            if name in SKIPPED_ROUTES or (selected and name not in selected):
+                continue
+            kwargs = {key: params[key] for key in pattern.pattern.converters}
+            url = reverse(name, kwargs=kwargs)
+            client = self.authenticated if self._needs_login(name) else self.anonymous
+            result = self._run_route(client, url, options['warmup'], options['requests'])
+            # The archive routes share a name across their year/month/day patterns
+            report['routes'][name if name not in report['routes'] else f'{name} {url}'] = result
+            self.stdout.write(
+                f"{name:<28} {url:<40} p50 {result['p50_ms']:8.2f}ms  p95 {result['p95_ms']:8.2f}ms  "
+                f"p99 {result['p99_ms']:8.2f}ms  {result['queries_median']:>3} queries  {result['rps']:8.1f} req/s"
+            )
+
+        if options['uploads']:
+            report['upload'] = self._run_uploads(options['uploads'], options['seed'])
+            self.stdout.write(
+                f"upload pipeline: {report['upload']['images_per_sec']:.2f} images/s "
+                f"(p50 {report['upload']['p50_ms']:.0f}ms)"
+            )
+
+        if options['baseline']:
+            self._compare(report, options['baseline'])
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+    def _host(self):
+        for host in settings.ALLOWED_HOSTS:
+            if host and host != '*' and not host.startswith('.'):
+                return host
+        return 'localhost'
+
+    def _benchmark_user(self, username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f'User "{username}" does not exist')
+        user = User.objects.filter(photos__privacy='public').order_by('-photos__created_at').first()
+        if user is None:
+            raise CommandError('No public photos found; run `manage.py seed_dataset` first')
+        return user
+
+    def _route_params(self):
+        photo = Photo.objects.filter(owner=self.user, privacy='public').order_by('-created_at').first()
+        category = PhotoCategory.objects.filter(photos__privacy='public').first() or PhotoCategory.objects.first()
+        tag = PhotoTag.objects.filter(photos__privacy='public').first() or PhotoTag.objects.first()
+        if photo is None or category is None or tag is None:
+            raise CommandError('Dataset needs a public photo, a category and a tag; run seed_dataset')
+        created = timezone.localtime(photo.created_at)
+        return {
+            'photo_id': photo.pk,
+            'category_id': category.pk,
+            'tag_name': tag.name,
+            'user_id': self.user.pk,
+            'username': self.user.username,
+            'year': created.year,
+            'month': created.month,
+            'day': created.day,
+            'shard': photo.pk // syndication.SITEMAP_SHARD_SIZE,
+        }
+
+    def _routes(self):
+        for module in (photos_urls, accounts_urls):
+            for pattern in module.urlpatterns:
+                if isinstance(pattern, URLPattern) and pattern.name:
+                    yield f'{module.app_name}:{pattern.name}', pattern
+
+    def _needs_login(self, name):
+        return name in {
+            'photos:upload', 'photos:edit', 'photos:delete', 'photos:my_photos', 'photos:my_photos_grid',
+            'photos:feed', 'photos:api_feed',
+            'accounts:profile_edit', 'accounts:friends',
+        }
+
+    def _run_route(self, client, url, warmup, requests):
+        for _ in range(warmup):
+            client.get(url, secure=True)
+
+        timings, queries, statuses, sizes = [], [], {}, []
+        started = time.perf_counter()
+        for _ in range(requests):
+            with CaptureQueriesContext(connection) as captured:
+                t0 = time.perf_counter()
+                response = client.get(url, secure=True)
+                body = b''.join(response) if response.streaming else response.content
+                timings.append((time.perf_counter() - t0) * 1000)
+            queries.append(len(captured))
+            sizes.append(len(body))
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        elapsed = time.perf_counter() - started
+
+        return {
+            'url': url,
+            'requests': requests,
+            'statuses': {str(code): count for code, count in sorted(statuses.items())},
+            'p50_ms': _percentile(timings, 50),
+            'p95_ms': _percentile(timings, 95),
+            'p99_ms': _percentile(timings, 99),
+            'mean_ms': round(float(np.mean(timings)), 3),
+            'queries_median': int(np.median(queries)),
+            'queries_max': int(max(queries)),
+            'bytes_median': int(np.median(sizes)),
+            'rps': round(requests / elapsed, 2),
+        }
+
+    def _run_uploads(self, count, seed):
+        rng = np.random.default_rng(seed)
+        payloads = [encode_jpeg(synthetic_image(rng, pick_size(rng))) for _ in range(count)]
+        before = set(Photo.objects.filter(owner=self.user).values_list('pk', flat=True))
+
+        timings = []
+        started = time.perf_counter()
+        # Measures the pipeline itself, so uploads are not rate limited
+        with override_settings(UPLOAD_ADMISSION=False):
+            for i, data in enumerate(payloads):
+                t0 = time.perf_counter()
+                self.authenticated.post(reverse('photos:upload'), {
+                    'title': f'Benchmark upload {i}',
+                    'privacy': 'private',
+                    'image': SimpleUploadedFile(f'bench_{i}.jpg', data, content_type='image/jpeg'),
+                }, secure=True)
+                timings.append((time.perf_counter() - t0) * 1000)
+        elapsed = time.perf_counter() - started
+
+        # Remove the benchmark uploads again; the delete signal cleans up their files
+        for photo in Photo.objects.filter(owner=self.user).exclude(pk__in=before):
+            photo.delete()
+
+        return {
+            'images': count,
+            'mean_bytes': int(np.mean([len(p) for p in payloads])),
+            'images_per_sec': round(count / elapsed, 3),
+            'p50_ms': _percentile(timings, 50),
+            'p95_ms': _percentile(timings, 95),
+            'p99_ms': _percentile(timings, 99),
+        }
+
+    def _meta(self):
+        try:
+            commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                    text=True, cwd=settings.BASE_DIR).stdout.strip() or None
+        except OSError:
+            commit = None
+        return {
+            'commit': commit,
+            'timestamp': datetime.now(dt_timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'photos': Photo.objects.count(),
+            'tags': PhotoTag.objects.count(),
+            'users': User.objects.count(),
+        }
+
+    def _compare(self, report, path):
+        with open(path) as f:
+            baseline = json.load(f)
+        self.stdout.write(f"\nCompared with {path} (commit {baseline['meta'].get('commit')}):")
+        for name, current in report['routes'].items():
+            previous = baseline.get('routes', {}).get(name)
+            if not previous:
+                continue
+            delta = (current['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] * 100 if previous['p95_ms'] else 0
+            style = self.style.ERROR if delta > 10 else self.style.SUCCESS if delta < -10 else str
+            self.stdout.write(style(
+                f"{name:<28} p95 {previous['p95_ms']:8.2f} -> {current['p95_ms']:8.2f}ms ({delta:+.1f}%)  "
+                f"queries {previous['queries_median']} -> {current['queries_median']}"
+            ))
+
+
+def _percentile(values, q):
+    return round(float(np.percentile(values, q)), 3)
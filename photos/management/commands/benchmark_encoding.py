@@ -0,0 +1,96 @@
+import os
+import time
+from collections import Counter
+from io import BytesIO
+
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from photos import imaging, renditions
+from photos.models import ORIGINAL_MAX_SIDE, Photo
+
+BASELINE_ORIGINAL_QUALITY = 90
+BASELINE_THUMBNAIL_QUALITY = 85
+
+
+class Command(BaseCommand):
+    help = ('Compare the adaptive (SSIM-targeted) encoder with the previous fixed-quality '
+            'encoding on a sample of photos: bytes saved against CPU time spent.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=50, help='Number of stored photos to sample')
+        parser.add_argument('--dir', help='Use the images in this directory instead of stored photos')
+
+    def handle(self, *args, **options):
+        corpus = list(self._corpus(options))
+        if not corpus:
+            raise CommandError('No images to benchmark')
+
+        totals = Counter()
+        formats = Counter()
+        for name, opener in corpus:
+            try:
+                with opener() as f:
+                    img = Image.open(f)
+                    img.seek(0)
+                    img.load()
+            except Exception as e:
+                self.stderr.write(f'{name}: {e}')
+                continue
+            if img.width > ORIGINAL_MAX_SIDE or img.height > ORIGINAL_MAX_SIDE:
+                img.thumbnail((ORIGINAL_MAX_SIDE, ORIGINAL_MAX_SIDE), Image.Resampling.LANCZOS)
+            fmt = imaging.format_for_name(name)
+
+            for kind, source, quality, target in (
+                ('original', img, BASELINE_ORIGINAL_QUALITY, imaging.SSIM_TARGET_ORIGINAL),
+                ('thumbnail', self._thumbnail(img), BASELINE_THUMBNAIL_QUALITY, imaging.SSIM_TARGET_THUMBNAIL),
+            ):
+                started = time.process_time()
+                baseline = self._baseline(source, fmt, quality)
+                totals[f'{kind}_baseline_cpu'] += time.process_time() - started
+                totals[f'{kind}_baseline_bytes'] += len(baseline)
+
+                started = time.process_time()
+                encoded = imaging.encode_adaptive(source, target=target)
+                totals[f'{kind}_adaptive_cpu'] += time.process_time() - started
+                totals[f'{kind}_adaptive_bytes'] += len(encoded.data)
+                totals[f'{kind}_score'] += encoded.score
+                formats[f'{kind} {fmt}->{encoded.format}'] += 1
+            totals['images'] += 1
+
+        count = totals['images']
+        self.stdout.write(f'{count} images')
+        for kind in ('original', 'thumbnail'):
+            before, after = totals[f'{kind}_baseline_bytes'], totals[f'{kind}_adaptive_bytes']
+            saved = 1 - after / before if before else 0
+            self.stdout.write(
+                f'{kind:>9}: {before / 1024:,.0f} KiB -> {after / 1024:,.0f} KiB ({saved:.1%} saved), '
+                f'mean SSIM {totals[f"{kind}_score"] / count:.4f}, CPU per image '
+                f'{totals[f"{kind}_baseline_cpu"] / count * 1000:.0f}ms -> '
+                f'{totals[f"{kind}_adaptive_cpu"] / count * 1000:.0f}ms'
+            )
+        for conversion, times in sorted(formats.items()):
+            self.stdout.write(f'  {conversion}: {times}')
+
+    def _corpus(self, options):
+        if options['dir']:
+            for entry in sorted(os.scandir(options['dir']), key=lambda entry: entry.name):
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in Image.registered_extensions():
+                    yield entry.name, lambda path=entry.path: open(path, 'rb')
+            return
+        photos = Photo.objects.exclude(image='').filter(is_animated=False).order_by('?')[:options['limit']]
+        for photo in photos.only('image'):
+            yield photo.image.name, lambda field=photo.image: field.storage.open(field.name, 'rb')
+
+    def _thumbnail(self, img):
+        thumb = img.copy()
+        thumb.thumbnail((renditions.THUMBNAIL_SIZE, renditions.THUMBNAIL_SIZE))
+        return thumb
+
+    def _baseline(self, img, fmt, quality):
+        """What the pipeline did before: same format, fixed quality"""
+        if fmt == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = imaging.to_rgb(img)
+        buffer = BytesIO()
+        img.save(buffer, format=fmt, quality=quality, optimize=True)
+        return buffer.getvalue()
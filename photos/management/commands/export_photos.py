@@ -0,0 +1,39 @@
+import os
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from photos.export import build_archive
+
+
+class Command(BaseCommand):
+    help = "Write a ZIP of a user's originals and manifest.json (see photos/export.py)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--output', help='ZIP file to write; defaults to photos-<username>.zip, "-" for stdout')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue a partially written --output file instead of starting over')
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['username']).first()
+        if user is None:
+            raise CommandError(f'No user named "{options["username"]}"')
+        archive = build_archive(user)
+        output = options['output'] or f'photos-{user.username}.zip'
+
+        if output == '-':
+            for chunk in archive.iter_bytes():
+                sys.stdout.buffer.write(chunk)
+            return
+
+        start = os.path.getsize(output) if options['resume'] and os.path.exists(output) else 0
+        if start > archive.size:
+            raise CommandError(f'{output} is larger than the archive; the photos changed, rerun without --resume')
+        with open(output, 'ab' if start else 'wb') as f:
+            for chunk in archive.iter_bytes(start):
+                f.write(chunk)
+        self.stderr.write(self.style.SUCCESS(
+            f'Wrote {len(archive.entries) - 1} photos, {archive.size / 1024 ** 2:,.1f} MiB to {output}'
+            + (f' (resumed at byte {start})' if start else '')))
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from photoalbum.routers import use_primary
+from photos.storage_gc import delete_files, find_orphans, media_prefixes
+
+
+class Command(BaseCommand):
+    help = 'Delete media files in storage that no database row references any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Storage names checked against the database per query batch')
+        parser.add_argument('--min-age-hours', type=int,
+                            default=getattr(settings, 'MEDIA_GC_MIN_AGE_HOURS', 24),
+                            help='Never delete files modified more recently than this')
+        parser.add_argument('--verbose-names', action='store_true', help='Print every orphaned name')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        self.stdout.write(f"Scanning {', '.join(media_prefixes())}")
+
+        # References must come from the primary, never from a lagging replica
+        with use_primary():
+            self._collect(options, dry_run)
+
+    def _collect(self, options, dry_run):
+        total = 0
+        for orphans in find_orphans(options['batch_size'], options['min_age_hours']):
+            if options['verbose_names'] or dry_run:
+                for name in orphans:
+                    self.stdout.write(f'  {name}')
+            if not dry_run:
+                delete_files(orphans)
+            total += len(orphans)
+
+        if dry_run:
+            self.stdout.write(self.style.WARNING(f'{total} orphaned files would be deleted (dry run)'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Deleted {total} orphaned files'))
@@ -0,0 +1,149 @@
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from photos.management.synthetic import encode_jpeg, pick_size, synthetic_image
+from photos.models import Photo
+
+# Longest an uploader honours Retry-After, so a short run still sees retries
+MAX_BACKOFF = 5.0
+
+
+class Command(BaseCommand):
+    help = ('Time photo_list while one user uploads from several threads at once, with upload '
+            'admission control off and then on, and report latency percentiles for both')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Uploading user (default: the first superuser or user)')
+        parser.add_argument('--uploaders', type=int, default=4, help='Concurrent upload threads')
+        parser.add_argument('--readers', type=int, default=2, help='Concurrent photo_list threads')
+        parser.add_argument('--duration', type=float, default=20.0, help='Seconds per phase')
+        parser.add_argument('--phase', choices=['off', 'on', 'both'], default='both',
+                            help='Run with admission control off, on, or both in turn')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        user = self._user(options['user'])
+        rng = np.random.default_rng(options['seed'])
+        payloads = [encode_jpeg(synthetic_image(rng, pick_size(rng))) for _ in range(4)]
+        host = self._host()
+
+        phases = ['off', 'on'] if options['phase'] == 'both' else [options['phase']]
+        results = {}
+        for phase in phases:
+            before = set(Photo.objects.filter(owner=user).values_list('pk', flat=True))
+            cache.delete_many([f'upload_bucket:user:{user.pk}', 'upload_bucket:global'])
+            try:
+                with override_settings(UPLOAD_ADMISSION=phase == 'on'):
+                    results[phase] = self._run(user, host, payloads, options)
+            finally:
+                # The delete signal cleans up the uploaded files
+                for photo in Photo.objects.filter(owner=user).exclude(pk__in=before):
+                    photo.delete()
+            self._report(phase, results[phase], options['duration'])
+
+        if len(results) == 2 and results['on']['p99_ms']:
+            self.stdout.write(self.style.SUCCESS(
+                f"photo_list p99 {results['off']['p99_ms']:.0f}ms without admission control, "
+                f"{results['on']['p99_ms']:.0f}ms with it"))
+
+    def _host(self):
+        for host in settings.ALLOWED_HOSTS:
+            if host and host != '*' and not host.startswith('.'):
+                return host
+        return 'localhost'
+
+    def _user(self, username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f'User "{username}" does not exist')
+        user = User.objects.order_by('-is_superuser', 'pk').first()
+        if user is None:
+            raise CommandError('No users found; run `manage.py seed_dataset` first')
+        return user
+
+    def _run(self, user, host, payloads, options):
+        stop = threading.Event()
+        lock = threading.Lock()
+        timings, statuses, upload_ms = [], Counter(), []
+
+        def reader():
+            client = Client(HTTP_HOST=host)
+            local = []
+            try:
+                while not stop.is_set():
+                    t0 = time.perf_counter()
+                    client.get(reverse('photos:home'), secure=True)
+                    local.append((time.perf_counter() - t0) * 1000)
+            finally:
+                connections.close_all()
+            with lock:
+                timings.extend(local)
+
+        def uploader(index):
+            client = Client(HTTP_HOST=host)
+            client.force_login(user)
+            local, local_ms = Counter(), []
+            i = 0
+            try:
+                while not stop.is_set():
+                    t0 = time.perf_counter()
+                    response = client.post(reverse('photos:upload'), {
+                        'title': f'Load test upload {index}-{i}',
+                        'privacy': 'private',
+                        'image': SimpleUploadedFile(f'load_{index}_{i}.jpg', payloads[i % len(payloads)],
+                                                    content_type='image/jpeg'),
+                    }, secure=True)
+                    local_ms.append((time.perf_counter() - t0) * 1000)
+                    local[response.status_code] += 1
+                    i += 1
+                    if response.status_code == 429:
+                        stop.wait(min(float(response['Retry-After']), MAX_BACKOFF))
+            finally:
+                connections.close_all()
+            with lock:
+                statuses.update(local)
+                upload_ms.extend(local_ms)
+
+        threads = [threading.Thread(target=reader) for _ in range(options['readers'])]
+        threads += [threading.Thread(target=uploader, args=(n,)) for n in range(options['uploaders'])]
+        for thread in threads:
+            thread.start()
+        stop.wait(options['duration'])
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        return {
+            'requests': len(timings),
+            'p50_ms': _percentile(timings, 50),
+            'p95_ms': _percentile(timings, 95),
+            'p99_ms': _percentile(timings, 99),
+            'uploads': dict(statuses),
+            'upload_p50_ms': _percentile(upload_ms, 50),
+        }
+
+    def _report(self, phase, result, duration):
+        uploads = ', '.join(f'{count} × {status}' for status, count in sorted(result['uploads'].items()))
+        self.stdout.write(
+            f"admission {phase:<3}  photo_list: {result['requests']} requests in {duration:.0f}s, "
+            f"p50 {result['p50_ms']:.0f}ms  p95 {result['p95_ms']:.0f}ms  p99 {result['p99_ms']:.0f}ms"
+        )
+        self.stdout.write(f"               uploads: {uploads or 'none'} (p50 {result['upload_p50_ms']:.0f}ms)")
+
+
+def _percentile(values, q):
+    return round(float(np.percentile(values, q)), 3) if values else 0.0
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from photos import archive
+
+
+class Command(BaseCommand):
+    help = 'Recompute the date archive histogram (photos/archive.py) from the photo table'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            rows = archive.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rows} archive buckets'))
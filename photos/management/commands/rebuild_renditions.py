@@ -0,0 +1,129 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+from photos import object_cache, renditions
+from photos.models import Photo
+from photos.storage_gc import schedule_file_deletion
+
+DEFAULT_CHECKPOINT = '.rebuild_renditions.json'
+RENDITION_FIELDS = ('thumbnail', 'placeholder', 'dominant_color', 'animation', 'video',
+                    'is_animated', 'frame_count', 'duration_ms')
+
+
+class Command(BaseCommand):
+    help = ('Render missing or outdated renditions (see photos/renditions.py) in a process pool. '
+            'Progress is checkpointed; rerun the same command to resume.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--spec', action='append', choices=sorted(renditions.RENDITION_VERSIONS),
+                            help='Only rebuild this spec (repeatable); defaults to every outdated spec')
+        parser.add_argument('--since', help='Only photos uploaded on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--owner', help='Only photos of this username')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT,
+                            help='File recording the last processed photo id')
+        parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint')
+
+    def handle(self, *args, **options):
+        photos = self._queryset(options)
+        filters = {key: options[key] for key in ('spec', 'since', 'owner')}
+        last_pk = 0 if options['restart'] else self._load_checkpoint(options['checkpoint'], filters)
+        if last_pk:
+            self.stdout.write(f'Resuming after photo {last_pk}')
+
+        remaining = photos.filter(pk__gt=last_pk).count()
+        self.stdout.write(f'{remaining} photos to scan with {options["workers"]} workers')
+
+        scanned = rendered = failed = 0
+        started = time.perf_counter()
+        # Workers only touch storage; never let them inherit open DB connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            while True:
+                batch = list(photos.filter(pk__gt=last_pk)[:options['batch_size']])
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+                scanned += len(batch)
+
+                tasks = [task for task in (renditions.build_task(photo, options['spec']) for photo in batch) if task]
+                results = list(pool.map(renditions.render, tasks, chunksize=4))
+                rendered += self._write(batch, results)
+                for result in results:
+                    if result['error']:
+                        failed += 1
+                        self.stderr.write(f'Photo {result["pk"]}: {result["error"]}')
+
+                self._save_checkpoint(options['checkpoint'], filters, last_pk)
+                elapsed = time.perf_counter() - started
+                rate = scanned / elapsed if elapsed else 0
+                eta = (remaining - scanned) / rate if rate else 0
+                self.stdout.write(f'Scanned {scanned}/{remaining}, rendered {rendered}, failed {failed} '
+                                  f'({rate:,.1f} photos/s, ETA {eta / 60:.1f} min, last id {last_pk})')
+
+        if os.path.exists(options['checkpoint']):
+            os.remove(options['checkpoint'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Rendered {rendered} of {scanned} photos in {elapsed:.1f}s, {failed} failed.'))
+
+    def _queryset(self, options):
+        # Every field a result may set is loaded, so bulk_update never refetches
+        photos = Photo.objects.exclude(image='').order_by('pk').only(
+            'pk', 'owner', 'image', 'rendition_versions', *RENDITION_FIELDS)
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError('--since must be a date like 2024-01-31')
+            photos = photos.filter(created_at__gte=timezone.make_aware(since))
+        if options['owner']:
+            owner = User.objects.filter(username=options['owner']).first()
+            if owner is None:
+                raise CommandError(f'No user named "{options["owner"]}"')
+            photos = photos.filter(owner=owner)
+        return photos
+
+    def _write(self, batch, results):
+        """Bulk update the rendered fields; returns the number of photos updated"""
+        by_pk = {photo.pk: photo for photo in batch}
+        updated, fields, stale = [], {'rendition_versions'}, []
+        for result in results:
+            if result['error'] or not result['versions']:
+                continue
+            photo = by_pk[result['pk']]
+            for field, value in result['fields'].items():
+                setattr(photo, field, value)
+            fields.update(result['fields'])
+            photo.rendition_versions = {**(photo.rendition_versions or {}), **result['versions']}
+            updated.append(photo)
+            stale += result['stale']
+        if updated:
+            Photo.objects.bulk_update(updated, sorted(fields))
+            object_cache.bump_photos(updated)
+            schedule_file_deletion(stale)
+        return len(updated)
+
+    def _load_checkpoint(self, path, filters):
+        try:
+            with open(path) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if checkpoint.get('filters') != filters:
+            self.stdout.write(self.style.WARNING('Checkpoint was written with other filters; starting over'))
+            return 0
+        return checkpoint.get('last_pk', 0)
+
+    def _save_checkpoint(self, path, filters, last_pk):
+        with open(path, 'w') as f:
+            json.dump({'filters': filters, 'last_pk': last_pk}, f)
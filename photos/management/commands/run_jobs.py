@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from photos import jobs
+
+# Seconds between sweeps for stale claims and old finished jobs
+MAINTENANCE_INTERVAL = 300
+
+
+class Command(BaseCommand):
+    help = 'Process queued background jobs (media deletion, ...)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=1000, help='Maximum jobs to run per pass')
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new jobs')
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds between polls with --loop')
+
+    def handle(self, *args, **options):
+        last_maintenance = None
+        while True:
+            if last_maintenance is None or time.monotonic() - last_maintenance >= MAINTENANCE_INTERVAL:
+                self._maintain()
+                last_maintenance = time.monotonic()
+            processed = jobs.run_pending(limit=options['limit'])
+            if processed:
+                self.stdout.write(f'Processed {processed} jobs')
+            if not options['loop']:
+                break
+            if processed < options['limit']:
+                time.sleep(options['interval'])
+
+    def _maintain(self):
+        reaped = jobs.reap_stale()
+        if reaped:
+            self.stdout.write(self.style.WARNING(f'Requeued or failed {reaped} stale jobs'))
+        purged = jobs.purge_done()
+        if purged:
+            self.stdout.write(f'Deleted {purged} finished jobs')
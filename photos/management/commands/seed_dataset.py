@@ -0,0 +1,187 @@
+import random
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from accounts.models import UserProfile
+from photos import archive, feed, imaging, renditions, trending
+from photos.management.synthetic import encode_jpeg, pick_size, synthetic_image
+from photos.models import Photo, PhotoCategory, PhotoTag
+
+SEED_PREFIX = 'seed_'
+SEED_MEDIA_DIR = 'seed'
+
+
+class Command(BaseCommand):
+    help = 'Seed a reproducible synthetic dataset of users, tags, categories and photos for benchmarking'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--photos', type=int, default=100000)
+        parser.add_argument('--tags', type=int, default=5000)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--image-pool', type=int, default=50,
+                            help='Distinct generated images; photos reuse them round-robin')
+        parser.add_argument('--max-tags-per-photo', type=int, default=5)
+        parser.add_argument('--days', type=int, default=730,
+                            help='Spread photo creation times over this many days')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--clear', action='store_true',
+                            help='Remove previously seeded data first')
+
+    def handle(self, *args, **options):
+        self.rng = np.random.default_rng(options['seed'])
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        started = time.perf_counter()
+
+        if options['clear']:
+            self._clear()
+
+        users = self._seed_users(options['users'])
+        categories = self._seed_categories(options['categories'])
+        tags = self._seed_tags(options['tags'])
+        pool = self._seed_images(options['image_pool'])
+        self._seed_photos(options['photos'], users, categories, tags, pool,
+                          options['max_tags_per_photo'], options['days'])
+        PhotoTag.objects.recount()
+        self._rebuild_derived(users)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'Seeding finished in {elapsed:.1f}s'))
+
+    def _clear(self):
+        deleted, _ = User.objects.filter(username__startswith=SEED_PREFIX).delete()
+        PhotoTag.objects.filter(name__startswith=SEED_PREFIX).delete()
+        PhotoCategory.objects.filter(name__startswith=SEED_PREFIX).delete()
+        self.stdout.write(f'Removed {deleted} seeded rows')
+
+    def _seed_users(self, count):
+        existing = User.objects.filter(username__startswith=SEED_PREFIX).count()
+        password = make_password(None)
+        users = [
+            User(username=f'{SEED_PREFIX}user{i:06d}', email=f'{SEED_PREFIX}user{i:06d}@example.com',
+                 password=password)
+            for i in range(existing, count)
+        ]
+        # bulk_create skips post_save, so profiles are created explicitly
+        created = User.objects.bulk_create(users, batch_size=self.batch_size)
+        UserProfile.objects.bulk_create([UserProfile(user=u) for u in created], batch_size=self.batch_size)
+        self.stdout.write(f'Users: {len(created)} created')
+        return list(User.objects.filter(username__startswith=SEED_PREFIX).values_list('pk', flat=True))
+
+    def _seed_categories(self, count):
+        categories = [PhotoCategory(name=f'{SEED_PREFIX}category{i:03d}') for i in range(count)]
+        PhotoCategory.objects.bulk_create(categories, ignore_conflicts=True)
+        return list(PhotoCategory.objects.filter(name__startswith=SEED_PREFIX).values_list('pk', flat=True))
+
+    def _seed_tags(self, count):
+        # bulk_create skips PhotoTag.save, so the normalised key is set here
+        tags = [PhotoTag(name=f'{SEED_PREFIX}tag{i:05d}', normalized=f'{SEED_PREFIX}tag{i:05d}')
+                for i in range(count)]
+        PhotoTag.objects.bulk_create(tags, ignore_conflicts=True, batch_size=self.batch_size)
+        self.stdout.write(f'Tags: {count} ensured')
+        return list(PhotoTag.objects.filter(name__startswith=SEED_PREFIX)
+                    .order_by('name').values_list('pk', flat=True))
+
+    def _seed_images(self, count):
+        """Generate and store the image pool with thumbnails and placeholders"""
+        pool = []
+        for i in range(count):
+            size = pick_size(self.rng)
+            img = synthetic_image(self.rng, size)
+            data = encode_jpeg(img)
+            image_name = default_storage.save(f'photos/{SEED_MEDIA_DIR}/{i:04d}.jpg', ContentFile(data))
+
+            # Encoded like an upload's thumbnail, so rebuild_renditions finds it current
+            thumb, encoded = renditions.encode_thumbnail(img)
+            thumb_name = renditions.store(default_storage, renditions.thumbnail_name(image_name, encoded.format),
+                                          encoded.data)
+            pool.append({
+                'image': image_name,
+                'thumbnail': thumb_name,
+                'width': size[0],
+                'height': size[1],
+                'file_size': len(data),
+                'placeholder': imaging.placeholder_data_uri(thumb),
+                'dominant_color': imaging.dominant_color(thumb),
+            })
+            self.stdout.write(f'Image pool: {i + 1}/{count} ({size[0]}x{size[1]}, {len(data) // 1024} KiB)')
+        return pool
+
+    def _seed_photos(self, count, users, categories, tags, pool, max_tags, days):
+        now = timezone.now()
+        # Zipf-like popularity so a few tags and users dominate, as in real data
+        tag_weights = 1 / np.arange(1, len(tags) + 1)
+        tag_weights /= tag_weights.sum()
+        user_weights = 1 / np.arange(1, len(users) + 1) ** 0.8
+        user_weights /= user_weights.sum()
+        privacy = np.array(['public', 'private', 'friends'])
+
+        created = 0
+        while created < count:
+            size = min(self.batch_size, count - created)
+            owners = self.rng.choice(users, size=size, p=user_weights)
+            ages = self.rng.uniform(0, days * 86400, size=size)
+            privacies = self.rng.choice(privacy, size=size, p=[0.7, 0.2, 0.1])
+            views = self.rng.zipf(1.6, size=size).clip(max=1_000_000)
+
+            photos = []
+            for i in range(size):
+                image = pool[(created + i) % len(pool)]
+                photo = Photo(
+                    owner_id=int(owners[i]),
+                    title=f'Photo {created + i}',
+                    description=self.random.choice(['', 'Seeded photo', 'Synthetic benchmark image']),
+                    image=image['image'],
+                    thumbnail=image['thumbnail'],
+                    category_id=self.random.choice(categories) if categories and self.random.random() < 0.8 else None,
+                    privacy=str(privacies[i]),
+                    view_count=int(views[i]),
+                    width=image['width'],
+                    height=image['height'],
+                    file_size=image['file_size'],
+                    placeholder=image['placeholder'],
+                    dominant_color=image['dominant_color'],
+                )
+                photo.rendition_versions = renditions.current_versions(photo)
+                photos.append(photo)
+
+            with transaction.atomic():
+                # bulk_create bypasses Photo.save, so no image is reprocessed
+                photos = Photo.objects.bulk_create(photos)
+                for photo, age in zip(photos, ages):
+                    photo.created_at = photo.updated_at = now - timedelta(seconds=float(age))
+                Photo.objects.bulk_update(photos, ['created_at', 'updated_at'])
+
+                if tags:
+                    Through = Photo.tags.through
+                    links = []
+                    for photo in photos:
+                        n = self.random.randint(0, max_tags)
+                        for tag_id in set(self.rng.choice(tags, size=n, p=tag_weights).tolist()):
+                            links.append(Through(photo_id=photo.pk, phototag_id=tag_id))
+                    Through.objects.bulk_create(links, batch_size=self.batch_size)
+
+            created += size
+            self.stdout.write(f'Photos: {created}/{count}')
+
+    def _rebuild_derived(self, users):
+        """Recompute the rows the Photo signals and jobs maintain, which bulk_create skipped"""
+        buckets = archive.rebuild()
+        self.stdout.write(f'Archive: {buckets} buckets')
+        scored = trending.update_scores(batch_size=self.batch_size)
+        self.stdout.write(f'Trending: {scored} photos scored')
+        # Seeded users have no friends, so each feed holds the user's own photos
+        for user_id in users:
+            feed.backfill(user_id, user_id)
+        self.stdout.write(f'Feeds: {len(users)} backfilled')
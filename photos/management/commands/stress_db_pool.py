@@ -0,0 +1,76 @@
+import statistics
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+
+from photoalbum.db.pool import PoolTimeout, get_pool
+from photos.models import Photo
+
+
+class Command(BaseCommand):
+    help = ('Simulate many concurrent requests against the database and report connection '
+            'checkout times. Run with DB_POOL=1 to exercise the connection pool.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=32)
+        parser.add_argument('--requests', type=int, default=50, help='Requests per thread')
+        parser.add_argument('--queries', type=int, default=3, help='Queries per request')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        alias = options['database']
+        pooled = 'POOL' in settings.DATABASES[alias]
+        if not pooled:
+            self.stdout.write(self.style.WARNING(
+                f'"{alias}" is not pooled (set DB_POOL=1); every request opens a new connection'))
+
+        waits, errors = [], []
+        lock = threading.Lock()
+
+        def worker():
+            connection = connections[alias]
+            local_waits, local_errors = [], []
+            for _ in range(options['requests']):
+                started = time.perf_counter()
+                try:
+                    connection.ensure_connection()
+                    local_waits.append(time.perf_counter() - started)
+                    for _ in range(options['queries']):
+                        list(Photo.objects.using(alias).order_by('-created_at').values_list('pk', flat=True)[:20])
+                except PoolTimeout:
+                    local_errors.append('timeout')
+                except OperationalError as exc:
+                    local_errors.append(str(exc))
+                finally:
+                    # What the request_finished handler does after each request
+                    connection.close()
+            with lock:
+                waits.extend(local_waits)
+                errors.extend(local_errors)
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        total = options['threads'] * options['requests']
+        self.stdout.write(f'{total} requests on {options["threads"]} threads in {elapsed:.2f}s '
+                          f'({total / elapsed:,.0f} req/s), {len(errors)} errors')
+        if waits:
+            waits.sort()
+            self.stdout.write(
+                'Connection checkout: '
+                f'p50 {statistics.median(waits) * 1000:.2f}ms, '
+                f'p99 {waits[int(len(waits) * 0.99) - 1] * 1000:.2f}ms, '
+                f'max {waits[-1] * 1000:.2f}ms'
+            )
+        for message in sorted(set(errors))[:5]:
+            self.stdout.write(self.style.ERROR(f'  {errors.count(message)} × {message}'))
+        if pooled:
+            self.stdout.write(f'Pool: {get_pool(alias, None).stats()}')
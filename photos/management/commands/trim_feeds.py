@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from photos import feed
+from photos.models import FeedEntry
+
+
+class Command(BaseCommand):
+    help = 'Cap every materialised home feed at its newest entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-entries', type=int, default=feed.MAX_ENTRIES)
+
+    def handle(self, *args, **options):
+        limit = options['max_entries']
+        users = (FeedEntry.objects.values('user').annotate(entries=Count('id'))
+                 .filter(entries__gt=limit).values_list('user', flat=True))
+        trimmed = deleted = 0
+        for user_id in users.iterator():
+            deleted += feed.trim(user_id, limit)
+            trimmed += 1
+        self.stdout.write(self.style.SUCCESS(f'Trimmed {trimmed} feeds, deleted {deleted} entries'))
@@ -0,0 +1,62 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from photos import trending
+
+
+class Command(BaseCommand):
+    help = ('Recompute time-decayed trending scores for photos that are new or gained views. '
+            'Run it periodically (e.g. every 10 minutes from Cloud Scheduler or cron).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--reset', action='store_true',
+                            help='Rescore every photo from its view count and upload time')
+        parser.add_argument('--benchmark', type=int, metavar='N',
+                            help='Time the scoring kernel on N synthetic photos instead (no database access)')
+
+    def handle(self, *args, **options):
+        if options['benchmark']:
+            return self._benchmark(options['benchmark'], options['batch_size'])
+
+        started = time.perf_counter()
+        updated = trending.update_scores(
+            batch_size=options['batch_size'],
+            reset=options['reset'],
+            progress=lambda done, last_pk: self.stdout.write(f'Scored {done} photos (last id {last_pk})'),
+        )
+        elapsed = time.perf_counter() - started
+        rate = updated / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(f'Updated {updated} photos in {elapsed:.2f}s ({rate:,.0f}/s)'))
+
+    def _benchmark(self, count, batch_size):
+        rng = np.random.default_rng(42)
+        now = time.time()
+        created = now - rng.uniform(0, 730 * 86400, size=count)
+        views = rng.zipf(1.6, size=count).clip(max=1_000_000).astype(np.float64)
+        scored_views = np.floor(views * rng.uniform(0.5, 1.0, size=count))
+        scores = np.where(rng.random(count) < 0.1, np.nan,
+                          np.log1p(scored_views) + trending.anchored_log_weight(created))
+
+        started = time.perf_counter()
+        result = np.empty(count)
+        for start in range(0, count, batch_size):
+            end = start + batch_size
+            result[start:end] = trending.compute_scores(
+                scores[start:end], created[start:end], views[start:end], scored_views[start:end], now)
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            f'Scored {count:,} synthetic photos in {elapsed * 1000:.1f}ms '
+            f'({count / elapsed:,.0f} photos/s, batches of {batch_size}); '
+            f'top-48 selection took {self._time_top(result) * 1000:.1f}ms'
+        )
+
+    def _time_top(self, scores, limit=48):
+        started = time.perf_counter()
+        # argpartition needs kth < len; with fewer scores every one is in the top
+        if len(scores) > limit:
+            np.argpartition(-scores, limit)[:limit]
+        return time.perf_counter() - started
@@ -0,0 +1,43 @@
+"""Synthetic image generation shared by the seeding and benchmark commands"""
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# Typical camera and phone resolutions, weighted towards phone uploads
+IMAGE_SIZES = [
+    ((4032, 3024), 3),
+    ((3024, 4032), 3),
+    ((1920, 1080), 2),
+    ((1080, 1920), 2),
+    ((1600, 1200), 2),
+    ((1200, 800), 1),
+    ((800, 800), 1),
+]
+
+
+def pick_size(rng):
+    """Pick a realistic ``(width, height)`` using a NumPy generator"""
+    sizes, weights = zip(*IMAGE_SIZES)
+    weights = np.asarray(weights, dtype=float)
+    return sizes[rng.choice(len(sizes), p=weights / weights.sum())]
+
+
+def synthetic_image(rng, size):
+    """Build a photo-like RGB image: smooth colour fields plus sensor noise.
+
+    Pure noise compresses far worse than real photos and flat colours far
+    better, so this mix gives JPEG sizes in the range of real uploads.
+    """
+    width, height = size
+    coarse = rng.integers(0, 256, size=(max(2, height // 128), max(2, width // 128), 3), dtype=np.uint8)
+    img = Image.fromarray(coarse, 'RGB').resize(size, Image.Resampling.BICUBIC)
+    pixels = np.asarray(img, dtype=np.int16)
+    pixels = pixels + rng.normal(0, 6, size=pixels.shape).astype(np.int16)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+
+
+def encode_jpeg(img, quality=90):
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
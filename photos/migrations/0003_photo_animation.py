@@ -0,0 +1,38 @@
+# Generated by Django 4.2 on 2026-10-19 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0002_photo_placeholder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='animation',
+            field=models.FileField(blank=True, null=True, upload_to='animations/%Y/%m/%d/'),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='duration_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='frame_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='is_animated',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='video',
+            field=models.FileField(blank=True, null=True, upload_to='videos/%Y/%m/%d/'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2 on 2026-10-19 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0005_feedentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='trending_score',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='trending_views',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['privacy', '-trending_score'], name='photos_phot_privacy_d4faa7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['category', 'privacy', '-trending_score'], name='photos_phot_categor_570d50_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2 on 2026-10-19 12:42
+
+import unicodedata
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_tags(apps, schema_editor):
+    PhotoTag = apps.get_model('photos', 'PhotoTag')
+    tags = list(PhotoTag.objects.annotate(photos_total=Count('photos')))
+    for tag in tags:
+        tag.normalized = unicodedata.normalize('NFKC', tag.name).casefold().strip()
+        tag.photo_count = tag.photos_total
+    PhotoTag.objects.bulk_update(tags, ['normalized', 'photo_count'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0006_trending_score'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='phototag',
+            name='normalized',
+            field=models.CharField(default='', editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='phototag',
+            name='photo_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='phototag',
+            index=models.Index(fields=['normalized'], name='phototag_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.RunPython(populate_tags, migrations.RunPython.noop),
+    ]
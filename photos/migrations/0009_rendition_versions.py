@@ -0,0 +1,38 @@
+# Generated by Django 4.2 on 2026-10-19 12:53
+
+from itertools import product
+
+from django.db import migrations, models
+
+
+def record_existing_versions(apps, schema_editor):
+    """Existing renditions were built with version 1 of each spec"""
+    Photo = apps.get_model('photos', 'Photo')
+    no_thumbnail = models.Q(thumbnail='') | models.Q(thumbnail__isnull=True)
+    no_animation = models.Q(is_animated=True) & (models.Q(animation='') | models.Q(animation__isnull=True))
+    # One UPDATE per combination of present renditions
+    for thumbnail, placeholder, animation in product((True, False), repeat=3):
+        queryset = Photo.objects.filter(~no_thumbnail if thumbnail else no_thumbnail)
+        queryset = queryset.exclude(placeholder='') if placeholder else queryset.filter(placeholder='')
+        queryset = queryset.exclude(no_animation) if animation else queryset.filter(no_animation)
+        versions = {
+            spec: 1 for spec, present in
+            (('thumbnail', thumbnail), ('placeholder', placeholder), ('animation', animation)) if present
+        }
+        queryset.update(rendition_versions=versions)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0008_photo_title_trgm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='rendition_versions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.RunPython(record_existing_versions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.2 on 2026-10-19 13:04
+
+from collections import Counter
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+def count_existing_photos(apps, schema_editor):
+    Photo = apps.get_model('photos', 'Photo')
+    ArchiveBucket = apps.get_model('photos', 'ArchiveBucket')
+    counts = Counter()
+    for owner_id, created_at in Photo.objects.filter(privacy='public').values_list('owner_id', 'created_at').iterator():
+        local = timezone.localtime(created_at)
+        for key in ((local.year, 0, 0), (local.year, local.month, 0), (local.year, local.month, local.day)):
+            counts[(None, *key)] += 1
+            counts[(owner_id, *key)] += 1
+    ArchiveBucket.objects.bulk_create(
+        [ArchiveBucket(owner_id=owner, year=y, month=m, day=d, count=n) for (owner, y, m, d), n in counts.items()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('photos', '0009_rendition_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField()),
+                ('month', models.PositiveSmallIntegerField(default=0)),
+                ('day', models.PositiveSmallIntegerField(default=0)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('owner', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Archive Bucket',
+                'verbose_name_plural': 'Archive Buckets',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='archivebucket',
+            constraint=models.UniqueConstraint(condition=models.Q(('owner__isnull', False)), fields=('owner', 'year', 'month', 'day'), name='unique_archive_bucket'),
+        ),
+        migrations.AddConstraint(
+            model_name='archivebucket',
+            constraint=models.UniqueConstraint(condition=models.Q(('owner__isnull', True)), fields=('year', 'month', 'day'), name='unique_global_archive_bucket'),
+        ),
+        migrations.RunPython(count_existing_photos, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,27 @@
-from django.db import models
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from django.db import connections, models, router
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 from django.core.validators import FileExtensionValidator
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from PIL import Image
+import logging
 import os
-from io import BytesIO
+import unicodedata
 from django.core.files.base import ContentFile
+from accounts.models import Friendship
+from photoalbum.instrumentation import image_stage
+from . import imaging, renditions
+from .storage_gc import schedule_file_deletion
+
+logger = logging.getLogger(__name__)
+
+# Originals are downscaled to fit this box, and re-encoded in place only when
+# that saves at least this fraction of the uploaded size
+ORIGINAL_MAX_SIDE = 2000
+ORIGINAL_MIN_SAVING = 0.1
 
 
 class PhotoCategory(models.Model):
@@ -28,22 +44,74 @@ class PhotoCategory(models.Model):
         return self.name
 
 
+def normalize_tag(name):
+    """Matching key for a tag: NFKC-folded (full-width to half-width) and casefolded"""
+    return unicodedata.normalize('NFKC', name).casefold().strip()
+
+
+class PhotoTagManager(models.Manager):
+    def get_or_create_normalized(self, name):
+        """Reuse an existing tag differing only in case or width, else create it"""
+        existing = self.filter(normalized=normalize_tag(name)).order_by('-photo_count', 'pk').first()
+        if existing is not None:
+            return existing, False
+        return self.get_or_create(name=name)
+
+    def recount(self):
+        """Recompute ``photo_count`` for every tag in one statement (after bulk loads)"""
+        through = Photo.tags.through.objects.filter(phototag_id=models.OuterRef('pk'))
+        counts = through.values('phototag_id').annotate(total=models.Count('*')).values('total')
+        return self.update(photo_count=Coalesce(models.Subquery(counts), 0))
+
+
 class PhotoTag(models.Model):
     """Tag for tagging photos"""
     name = models.CharField(max_length=100, unique=True)
+    normalized = models.CharField(max_length=100, default='', editable=False)
+    photo_count = models.PositiveIntegerField(default=0, editable=False)  # kept by photos/signals.py
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = PhotoTagManager()
+
     class Meta:
         verbose_name = _('Photo Tag')
         verbose_name_plural = _('Photo Tags')
         ordering = ['name']
         indexes = [
             models.Index(fields=['name']),
+            # Serves `normalized LIKE 'prefix%'` (the opclass only applies on PostgreSQL)
+            models.Index(fields=['normalized'], name='phototag_prefix_idx',
+                         opclasses=['varchar_pattern_ops']),
         ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.normalized = normalize_tag(self.name)
+        super().save(*args, **kwargs)
+
+
+class PhotoQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        """Photos ``user`` may see: public ones, their own and their friends'.
+
+        Friends-only photos are resolved with a correlated EXISTS on the
+        (owner -> viewer) friendship edge, so the whole check stays a single
+        indexed query however many friends the viewer has.
+        """
+        public = models.Q(privacy='public')
+        if user is None or not user.is_authenticated:
+            return self.filter(public)
+        friends = Friendship.objects.filter(
+            from_user=models.OuterRef('owner_id'), to_user=user.pk, status=Friendship.ACCEPTED,
+        )
+        return self.filter(
+            public
+            | models.Q(owner_id=user.pk)
+            | models.Q(privacy='friends') & models.Exists(friends)
+        )
+
 
 class Photo(models.Model):
     """Model for storing user-uploaded photos"""
@@ -87,6 +155,26 @@ class Photo(models.Model):
     height = models.PositiveIntegerField(null=True, blank=True)
     file_size = models.PositiveIntegerField(null=True, blank=True)  # in bytes
 
+    # Animated uploads (GIF/WebP) are transcoded into compact renditions
+    is_animated = models.BooleanField(default=False)
+    frame_count = models.PositiveIntegerField(null=True, blank=True)
+    duration_ms = models.PositiveIntegerField(null=True, blank=True)
+    animation = models.FileField(upload_to='animations/%Y/%m/%d/', blank=True, null=True)  # animated WebP
+    video = models.FileField(upload_to='videos/%Y/%m/%d/', blank=True, null=True)  # muted MP4
+
+    # Lazy-loading placeholders
+    placeholder = models.TextField(blank=True, default='')  # tiny WebP data URI
+    dominant_color = models.CharField(max_length=7, blank=True, default='')  # #rrggbb
+
+    # Time-decayed popularity, maintained by `manage.py update_trending`
+    trending_score = models.FloatField(null=True, blank=True, editable=False)
+    trending_views = models.PositiveIntegerField(default=0, editable=False)  # view_count already scored
+
+    # Spec name -> version each rendition was built with (see photos/renditions.py)
+    rendition_versions = models.JSONField(default=dict, blank=True, editable=False)
+
+    objects = PhotoQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('Photo')
         verbose_name_plural = _('Photos')
@@ -97,90 +185,227 @@ class Photo(models.Model):
             models.Index(fields=['category']),
             models.Index(fields=['-view_count']),
             models.Index(fields=['-created_at']),
+            models.Index(fields=['privacy', '-trending_score']),
+            models.Index(fields=['category', 'privacy', '-trending_score']),
         ]
 
     def __str__(self):
         return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Lets the feed signals notice privacy changes on save
+        instance._loaded_privacy = instance.__dict__.get('privacy')
+        # Lets save() skip the image pipeline when the image is unchanged
+        instance._loaded_image = instance.__dict__.get('image')
+        return instance
+
+    def is_visible_to(self, user, friend_ids=None):
+        """In-memory counterpart of ``visible_to`` for an already loaded photo.
+
+        ``friend_ids`` is the viewer's cached friend set; it is only fetched
+        when the photo is friends-only and not owned by the viewer.
+        """
+        if self.privacy == 'public':
+            return True
+        if user is None or not user.is_authenticated:
+            return False
+        if self.owner_id == user.pk:
+            return True
+        if self.privacy != 'friends':
+            return False
+        if friend_ids is None:
+            friend_ids = Friendship.objects.friend_ids(user.pk)
+        return self.owner_id in friend_ids
+
     def save(self, *args, **kwargs):
         """Override save to generate thumbnail and optimize images"""
-        # Store file size
-        if self.image:
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'image' not in update_fields:
+            # e.g. a privacy change: the image pipeline has nothing to redo
+            return super().save(*args, **kwargs)
+
+        # Only a new or replaced image needs the pipeline, not e.g. a title edit
+        image_changed = bool(self.image) and self.image.name != getattr(self, '_loaded_image', None)
+        if image_changed:
             self.file_size = self.image.size
-        
-        super().save(*args, **kwargs)
-        
-        # Generate thumbnail and optimize image (only if not using cloud storage or if local path available)
-        if self.image:
-            try:
-                self._generate_thumbnail()
-                self._optimize_image()
-                self._extract_image_info()
-            except (OSError, AttributeError) as e:
-                # GCS and other cloud storage backends don't support .path or save to local filesystem
-                # Fall back to just extracting metadata from the file
-                try:
-                    self._extract_image_info_from_file()
-                except Exception as extract_err:
-                    print(f"Warning: Could not extract image info: {extract_err}")
-
-    def _generate_thumbnail(self):
-        """Generate a thumbnail from the original image"""
+            # process_image() saves the row again; its save invalidates the
+            # cached snapshot, once the renditions are in place
+            self._defer_snapshot_bump = True
+        try:
+            super().save(*args, **kwargs)
+        finally:
+            self._defer_snapshot_bump = False
+
+        if image_changed:
+            self.process_image()
+        self._loaded_image = self.image.name if self.image else None
+
+    def process_image(self):
+        """Generate thumbnail, optimise, extract metadata and build the renditions.
+
+        Each stage only sets attributes, so the row is written (and its
+        signals fire) once, after which replaced files are deleted.
+        """
+        fields, stale = set(), []
+        # Every stage reads through the storage API, so cloud backends work too
+        for stage in (self._generate_thumbnail, self._optimize_image, self._extract_image_info,
+                      self._process_animation, self._generate_placeholder):
+            fields.update(stage(stale))
+        self.rendition_versions = renditions.current_versions(self)
+        super().save(update_fields=sorted(fields | {'rendition_versions'}))
+        schedule_file_deletion(stale)
+
+    def _generate_thumbnail(self, stale):
+        """Generate a thumbnail from the original image (works with cloud storage)"""
         try:
-            img = Image.open(self.image.path)
-            img.thumbnail((300, 300))
-            
-            # Create thumbnail filename
-            thumb_path = self.image.path.replace('photos', 'thumbnails')
-            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
-            
-            # Save thumbnail
-            img.save(thumb_path, quality=85, optimize=True)
-            
-            # Update thumbnail field
-            self.thumbnail.name = self.image.name.replace('photos', 'thumbnails')
-        except Exception as e:
-            print(f"Error generating thumbnail: {e}")
-
-    def _optimize_image(self):
-        """Optimize the original image"""
+            with image_stage('decode'), self.image.storage.open(self.image.name, 'rb') as f:
+                img = Image.open(f)
+                img.seek(0)  # animated images get a static first-frame thumbnail
+                renditions.draft(img)
+                img.load()
+            with image_stage('encode'):
+                _thumb, encoded = renditions.encode_thumbnail(img)
+            previous = self.thumbnail.name
+            with image_stage('storage_write'):
+                self.thumbnail.name = renditions.store(
+                    self.thumbnail.storage, renditions.thumbnail_name(self.image.name, encoded.format), encoded.data)
+            if previous and previous != self.thumbnail.name:
+                stale.append(previous)
+            return ['thumbnail']
+        except Exception:
+            logger.exception('Error generating thumbnail for photo %s', self.pk)
+            return []
+
+    def _optimize_image(self, stale):
+        """Re-encode the original as small as it can be without visible loss"""
         try:
-            img = Image.open(self.image.path)
-            
-            # Resize if too large
-            max_width = 2000
-            max_height = 2000
-            if img.width > max_width or img.height > max_height:
-                img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
-                img.save(self.image.path, quality=90, optimize=True)
-        except Exception as e:
-            print(f"Error optimizing image: {e}")
-
-    def _extract_image_info(self):
-        """Extract width and height from image (local file)"""
+            with image_stage('decode'), self.image.storage.open(self.image.name, 'rb') as f:
+                img = Image.open(f)
+                # Counting frames reads the file, so it happens before it is closed.
+                # Animated originals are kept as uploaded; resizing here would
+                # keep only the first frame. Compact renditions are made by
+                # _process_animation instead.
+                if imaging.is_animated(img):
+                    return []
+                img.load()
+
+            resized = img.width > ORIGINAL_MAX_SIDE or img.height > ORIGINAL_MAX_SIDE
+            if resized:
+                with image_stage('resize'):
+                    img.thumbnail((ORIGINAL_MAX_SIDE, ORIGINAL_MAX_SIDE), Image.Resampling.LANCZOS)
+            with image_stage('encode'):
+                encoded = imaging.encode_adaptive(img, target=imaging.SSIM_TARGET_ORIGINAL)
+            if not resized and len(encoded.data) > self.image.size * (1 - ORIGINAL_MIN_SAVING):
+                return []  # not worth a generation of loss
+
+            previous = self.image.name
+            name = os.path.splitext(previous)[0] + imaging.EXTENSIONS[encoded.format]
+            with image_stage('storage_write'):
+                self.image.name = renditions.store(self.image.storage, name, encoded.data)
+            self.file_size = len(encoded.data)
+            if self.image.name != previous:
+                stale.append(previous)
+            return ['image', 'file_size']
+        except Exception:
+            logger.exception('Error optimizing image for photo %s', self.pk)
+            return []
+
+    def _extract_image_info(self, stale):
+        """Extract width and height from the image (works with cloud storage)"""
         try:
-            img = Image.open(self.image.path)
+            with image_stage('decode'), self.image.storage.open(self.image.name, 'rb') as f:
+                img = Image.open(f)
             self.width = img.width
             self.height = img.height
-            super().save(update_fields=['width', 'height'])
-        except Exception as e:
-            print(f"Error extracting image info: {e}")
+            return ['width', 'height']
+        except Exception:
+            logger.exception('Error extracting image info for photo %s', self.pk)
+            return []
+
+    def _process_animation(self, stale):
+        """Transcode animated GIF/WebP uploads into animated WebP (and MP4 when ffmpeg exists).
 
-    def _extract_image_info_from_file(self):
-        """Extract width and height from image (file-like object, works with cloud storage)"""
+        Runs for every new image: the renditions of the image it replaces
+        are handed to ``stale``, and a static image clears the fields.
+        """
+        previous = [field.name for field in (self.animation, self.video) if field]
         try:
-            # Read from the file object directly (works with GCS, S3, etc.)
-            img = Image.open(self.image.file)
-            self.width = img.width
-            self.height = img.height
-            super().save(update_fields=['width', 'height'])
-        except Exception as e:
-            print(f"Error extracting image info from file object: {e}")
+            with image_stage('decode'), self.image.storage.open(self.image.name, 'rb') as f:
+                img = Image.open(f)
+                frames = durations = None
+                if imaging.is_animated(img):
+                    frames, durations = imaging.animation_frames(img)
+
+            if frames is None:
+                if not previous and not self.is_animated:
+                    return []
+                self.animation = self.video = None
+                self.is_animated = False
+                self.frame_count = self.duration_ms = None
+            else:
+                with image_stage('encode'):
+                    webp = imaging.encode_animated_webp(frames, durations)
+                video = None
+                if settings.ANIMATION_MP4_ENABLED:
+                    with image_stage('encode_video'):
+                        video = imaging.encode_mp4(frames, durations)
+
+                base = os.path.splitext(os.path.basename(self.image.name))[0]
+                with image_stage('storage_write'):
+                    self.animation.save(f'{base}.webp', ContentFile(webp), save=False)
+                    if video:
+                        self.video.save(f'{base}.mp4', ContentFile(video), save=False)
+                    else:
+                        self.video = None
+                self.is_animated = True
+                self.frame_count = len(frames)
+                self.duration_ms = sum(durations)
+            stale.extend(previous)
+            return ['is_animated', 'frame_count', 'duration_ms', 'animation', 'video']
+        except Exception:
+            logger.exception('Error transcoding animation for photo %s', self.pk)
+            return []
+
+    def _generate_placeholder(self, stale):
+        """Compute the inline placeholder and dominant colour (works with cloud storage)"""
+        source = self.thumbnail if self.thumbnail else self.image
+        try:
+            with image_stage('decode'), source.storage.open(source.name, 'rb') as f:
+                img = Image.open(f)
+                img.load()
+            with image_stage('placeholder'):
+                self.placeholder = imaging.placeholder_data_uri(img)
+                self.dominant_color = imaging.dominant_color(img)
+            return ['placeholder', 'dominant_color']
+        except Exception:
+            logger.exception('Error generating placeholder for photo %s', self.pk)
+            return []
 
     def increment_view_count(self):
-        """Increment the view count"""
-        self.view_count += 1
-        self.save(update_fields=['view_count'])
+        """Increment the view count and load the stored total into ``view_count``"""
+        # Atomic UPDATE: going through save() would rerun the image pipeline.
+        # RETURNING reads the total in the same statement, so a photo loaded
+        # from a cached snapshot still shows its current count.
+        connection = connections[router.db_for_write(Photo)]
+        if connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert:
+            table = connection.ops.quote_name(Photo._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'UPDATE {table} SET view_count = view_count + 1 WHERE id = %s RETURNING view_count',
+                    [self.pk],
+                )
+                row = cursor.fetchone()
+            if row is not None:
+                self.view_count = row[0]
+            return
+        Photo.objects.filter(pk=self.pk).update(view_count=models.F('view_count') + 1)
+        self.view_count = Photo.objects.filter(pk=self.pk).values_list('view_count', flat=True).first() or 0
+
+    async def aincrement_view_count(self):
+        """Async variant of increment_view_count"""
+        await sync_to_async(self.increment_view_count)()
 
     @property
     def aspect_ratio(self):
@@ -188,3 +413,84 @@ class Photo(models.Model):
         if self.width and self.height:
             return (self.width / self.height) * 100
         return None
+
+
+class Job(models.Model):
+    """A unit of background work, see photos/jobs.py"""
+
+    STATUS_CHOICES = [
+        ('pending', _('Pending')),
+        ('running', _('Running')),
+        ('done', _('Done')),
+        ('failed', _('Failed')),
+    ]
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _('Background Job')
+        verbose_name_plural = _('Background Jobs')
+        ordering = ['run_after', 'id']
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
+
+    def __str__(self):
+        return f'{self.name} #{self.pk} ({self.status})'
+
+
+class FeedEntry(models.Model):
+    """A photo in a user's materialised home feed, see photos/feed.py"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    photo = models.ForeignKey(Photo, on_delete=models.CASCADE, related_name='+')
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField()  # copy of photo.created_at, the feed sort key
+
+    class Meta:
+        verbose_name = _('Feed Entry')
+        verbose_name_plural = _('Feed Entries')
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'photo'], name='unique_feed_entry'),
+        ]
+        indexes = [
+            # A feed page is one range scan of this index
+            models.Index(fields=['user', '-created_at', '-photo'], name='feed_page_idx'),
+            models.Index(fields=['user', 'owner'], name='feed_owner_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id}: {self.photo_id}'
+
+
+class ArchiveBucket(models.Model):
+    """Number of public photos uploaded in a year, month or day, see photos/archive.py.
+
+    ``month`` is 0 on a year's row and ``day`` is 0 on a month's row. Rows
+    without an owner count every user's photos.
+    """
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField(default=0)
+    day = models.PositiveSmallIntegerField(default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = _('Archive Bucket')
+        verbose_name_plural = _('Archive Buckets')
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'year', 'month', 'day'], name='unique_archive_bucket',
+                                    condition=models.Q(owner__isnull=False)),
+            models.UniqueConstraint(fields=['year', 'month', 'day'], name='unique_global_archive_bucket',
+                                    condition=models.Q(owner__isnull=True)),
+        ]
+
+    def __str__(self):
+        period = '-'.join(str(part) for part in (self.year, self.month, self.day) if part)
+        return f'{self.owner_id or "*"} {period}: {self.count}'
@@ -0,0 +1,225 @@
+"""Two-tier read-through cache of the objects behind ``photo_detail``.
+
+Hot photos are served from compact snapshots (tuples of column values, not
+pickled model instances) kept in two tiers: a small LRU in each process in
+front of the shared Django cache. Each snapshot is stamped with the version
+tokens it depends on:
+
+* ``photo:<id>`` -- the photo row, its category and its tags;
+* ``owner:<id>`` -- the owner's name and avatar URL and their newest photos,
+  from which the "related photos" block is picked;
+* ``taxonomy`` -- category and tag names.
+
+A lookup reads the current tokens in one ``get_many`` and only uses an entry
+of either tier whose stamp matches. The signals in photos/signals.py delete
+tokens (``bump``) once a write commits, and a missing token is replaced by
+a fresh random one, so stale entries are never matched again. Snapshots are
+built from the primary database: a lagging replica could otherwise be
+cached under the new token.
+
+A miss is built once. Threads of a process wait on a per-key lock, and
+other processes wait up to ``BUILD_WAIT`` seconds for the builder holding
+the key's cache lock before building it themselves.
+"""
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, namedtuple
+from functools import partial
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+
+from photoalbum.instrumentation import record_cache
+from photoalbum.routers import use_primary
+
+from .models import Photo, PhotoCategory, PhotoTag
+
+LOCAL_MAX_ENTRIES = 1024
+OBJECT_CACHE_TIMEOUT = 24 * 60 * 60
+BUILD_LOCK_TIMEOUT = 10
+BUILD_WAIT = 1.0
+BUILD_POLL_INTERVAL = 0.05
+# Newest photos kept per owner for "related photos"; enough for 4 in the usual case
+RELATED_CANDIDATES = 12
+
+PHOTO_FIELDS = (
+    'id', 'owner_id', 'category_id', 'title', 'description', 'image', 'thumbnail', 'animation',
+    'video', 'privacy', 'view_count', 'created_at', 'updated_at', 'width', 'height', 'file_size',
+    'placeholder', 'dominant_color',
+)
+RELATED_FIELDS = (
+    'id', 'owner_id', 'title', 'image', 'thumbnail', 'privacy', 'width', 'height', 'placeholder',
+    'dominant_color', 'created_at',
+)
+
+PhotoDetail = namedtuple('PhotoDetail', 'photo avatar_url related related_complete')
+
+
+class LocalLRU:
+    """A thread-safe, size-bounded ``key -> (stamp, value)`` map for this process"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, stamp, value):
+        with self._lock:
+            self._entries[key] = (stamp, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_local = LocalLRU(LOCAL_MAX_ENTRIES)
+# Striped rather than one lock per key, so nothing has to be cleaned up
+_build_locks = [threading.Lock() for _ in range(64)]
+
+
+def _version_key(name):
+    return f'objver:{name}'
+
+
+def bump(*names):
+    """Invalidate every snapshot depending on ``names`` once the transaction commits"""
+    keys = [_version_key(name) for name in names]
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def bump_photos(photos):
+    """``bump`` the snapshots of ``photos`` (instances with ``owner_id`` loaded) and of their owners"""
+    bump(*{f'photo:{photo.pk}' for photo in photos}, *{f'owner:{photo.owner_id}' for photo in photos})
+
+
+def _stamp(names):
+    """The current version tokens of ``names``, creating missing ones"""
+    keys = [_version_key(name) for name in names]
+    tokens = cache.get_many(keys)
+    missing = [key for key in keys if key not in tokens]
+    if missing:
+        for key in missing:
+            cache.add(key, uuid.uuid4().hex, None)
+        tokens.update(cache.get_many(missing))  # another process may have added first
+    return tuple(tokens.get(key) for key in keys)
+
+
+def get_or_build(key, depends_on, build):
+    """``build()``'s result for ``key``, reused until one of ``depends_on`` is bumped"""
+    stamp = _stamp(depends_on)
+    if None in stamp:
+        return build()  # the cache backend keeps nothing (e.g. DummyCache)
+
+    entry = _local.get(key)
+    record_cache('object_local', entry is not None and entry[0] == stamp)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+
+    with _build_locks[zlib.crc32(key.encode()) % len(_build_locks)]:
+        entry = _local.get(key)  # built by another thread while this one waited
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        value = _shared_or_build(key, stamp, build)
+        _local.set(key, stamp, value)
+        return value
+
+
+def _shared_or_build(key, stamp, build):
+    entry = cache.get(key)
+    record_cache('object_shared', entry is not None and entry[0] == stamp)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+
+    lock_key = f'{key}:building'
+    locked = cache.add(lock_key, 1, BUILD_LOCK_TIMEOUT)
+    if not locked:
+        deadline = time.monotonic() + BUILD_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(BUILD_POLL_INTERVAL)
+            entry = cache.get(key)
+            if entry is not None and entry[0] == stamp:
+                return entry[1]
+    try:
+        value = build()
+        cache.set(key, (stamp, value), OBJECT_CACHE_TIMEOUT)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+    return value
+
+
+def _build_photo(photo_id):
+    with use_primary():
+        row = (Photo.objects.filter(pk=photo_id)
+               .values_list(*PHOTO_FIELDS, 'category__name', 'category__icon').first())
+        if row is None:
+            return None  # cached too: creating the photo bumps its version
+        tags = list(PhotoTag.objects.filter(photos=photo_id).values_list('id', 'name'))
+    photo, category_name, category_icon = row[:-2], row[-2], row[-1]
+    category = (photo[2], category_name, category_icon) if photo[2] else None
+    return {'photo': photo, 'category': category, 'tags': tags}
+
+
+def _build_owner(owner_id):
+    with use_primary():
+        user = User.objects.select_related('profile').filter(pk=owner_id).first()
+        if user is None:
+            return None
+        photos = list(Photo.objects.filter(owner_id=owner_id).values_list(*RELATED_FIELDS)[:RELATED_CANDIDATES])
+    profile = getattr(user, 'profile', None)
+    return {
+        'user': (user.id, user.username, user.first_name, user.last_name),
+        'avatar_url': profile.avatar_medium_url if profile and profile.avatar else '',
+        'photos': photos,
+    }
+
+
+def _instance(model, fields, values):
+    # from_db() takes the values in the model's field order
+    by_name = dict(zip(fields, values))
+    names = [field.attname for field in model._meta.concrete_fields if field.attname in by_name]
+    return model.from_db(None, names, [by_name[name] for name in names])
+
+
+def photo_detail(photo_id):
+    """The ``PhotoDetail`` of a photo, or ``None`` if it does not exist.
+
+    ``photo`` has its owner, category and tags attached (no lazy queries).
+    ``related`` holds the owner's newest other photos, of any privacy, and
+    ``related_complete`` whether that is all of them.
+    """
+    snapshot = get_or_build(f'photo:{photo_id}', [f'photo:{photo_id}', 'taxonomy'],
+                            partial(_build_photo, photo_id))
+    if snapshot is None:
+        return None
+    owner_id = snapshot['photo'][1]
+    owner = get_or_build(f'owner:{owner_id}', [f'owner:{owner_id}'], partial(_build_owner, owner_id))
+    if owner is None:
+        return None
+
+    photo = _instance(Photo, PHOTO_FIELDS, snapshot['photo'])
+    photo.owner = _instance(User, ('id', 'username', 'first_name', 'last_name'), owner['user'])
+    photo.category = _instance(PhotoCategory, ('id', 'name', 'icon'), snapshot['category']) \
+        if snapshot['category'] else None
+    tags = photo.tags.all()
+    tags._result_cache = [_instance(PhotoTag, ('id', 'name'), tag) for tag in snapshot['tags']]
+    tags._prefetch_done = True
+    photo._prefetched_objects_cache = {'tags': tags}
+
+    related = [_instance(Photo, RELATED_FIELDS, row) for row in owner['photos'] if row[0] != photo.pk]
+    for other in related:
+        other.owner = photo.owner
+    return PhotoDetail(photo, owner['avatar_url'], related, len(owner['photos']) < RELATED_CANDIDATES)
@@ -0,0 +1,167 @@
+"""Versioned rendition specs, rendered outside the request cycle.
+
+Each derived file or value a photo carries is a *spec* with a version number
+in ``RENDITION_VERSIONS``. ``Photo.rendition_versions`` records which version
+each photo was rendered with, so after changing the thumbnail size or adding
+a format, bump the spec's version and run ``manage.py rebuild_renditions``:
+only photos holding an older version of that spec are reprocessed.
+
+``render`` runs in worker processes: it touches storage only, never the
+database, and returns the field values for the caller to write in bulk.
+"""
+import hashlib
+import os
+import re
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+from . import imaging
+
+THUMBNAIL_SIZE = 300
+VERSION_DIGEST_LENGTH = 10
+_VERSION_RE = re.compile(r'\.[0-9a-f]{%d}$' % VERSION_DIGEST_LENGTH)
+
+RENDITION_VERSIONS = {
+    'thumbnail': 2,     # 2: adaptive format and quality (imaging.encode_adaptive)
+    'placeholder': 1,   # inline placeholder and dominant colour
+    'animation': 1,     # animated WebP (and MP4) of animated uploads
+}
+
+
+def thumbnail_name(image_name, fmt):
+    base = os.path.splitext(image_name.replace('photos', 'thumbnails'))[0]
+    return base + imaging.EXTENSIONS[fmt]
+
+
+def draft(img):
+    """Let JPEG decoding downscale by up to 8x, as only a thumbnail is needed"""
+    img.draft('RGB', (THUMBNAIL_SIZE * 2, THUMBNAIL_SIZE * 2))
+
+
+def encode_thumbnail(img):
+    """Downscale ``img`` and encode it adaptively; returns ``(thumbnail, Encoded)``"""
+    thumb = img.copy()
+    thumb.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    return thumb, imaging.encode_adaptive(thumb, target=imaging.SSIM_TARGET_THUMBNAIL)
+
+
+def versioned_name(name, data):
+    """``name`` with a digest of ``data`` before the extension (replacing an earlier one)"""
+    root, extension = os.path.splitext(name)
+    root = _VERSION_RE.sub('', root)
+    return f'{root}.{hashlib.sha1(data).hexdigest()[:VERSION_DIGEST_LENGTH]}{extension}'
+
+
+def store(storage, name, data):
+    """Write ``data`` under a new, versioned name derived from ``name``; returns it.
+
+    The file a row currently references is never overwritten, so its URL
+    keeps working (and concurrent renders never delete each other's files)
+    until the row is switched to the new name. Callers hand the previous
+    name to ``schedule_file_deletion``.
+    """
+    name = versioned_name(name, data)
+    if storage.exists(name):
+        return name  # these exact bytes are already stored
+    return storage.save(name, ContentFile(data))
+
+
+def current_versions(photo):
+    """Versions to record for the renditions ``photo`` currently has"""
+    present = {
+        'thumbnail': bool(photo.thumbnail),
+        'placeholder': bool(photo.placeholder),
+        'animation': bool(photo.animation) or not photo.is_animated,
+    }
+    return {spec: version for spec, version in RENDITION_VERSIONS.items() if present[spec]}
+
+
+def outdated_specs(photo):
+    """Specs the photo is missing or holds an older version of"""
+    versions = photo.rendition_versions or {}
+    specs = [spec for spec, version in RENDITION_VERSIONS.items() if versions.get(spec) != version]
+    if 'animation' in specs and not photo.is_animated:
+        specs.remove('animation')
+    return specs
+
+
+def build_task(photo, only_specs=None):
+    """The ``render`` task for ``photo``'s outdated specs (within ``only_specs``), or ``None``"""
+    specs = outdated_specs(photo)
+    if only_specs:
+        specs = [spec for spec in specs if spec in only_specs]
+    if not specs:
+        return None
+    return {
+        'pk': photo.pk,
+        'specs': specs,
+        'image': photo.image.name,
+        'thumbnail': photo.thumbnail.name or None,
+        'animation': photo.animation.name or None,
+        'video': photo.video.name or None,
+    }
+
+
+def render(task):
+    """Render ``task['specs']`` for one photo.
+
+    Returns ``{'pk', 'fields', 'versions', 'stale', 'error'}``: the model
+    fields to update, the spec versions produced, and storage names that are
+    no longer referenced once the fields are written.
+    """
+    result = {'pk': task['pk'], 'fields': {}, 'versions': {}, 'stale': [], 'error': None}
+    try:
+        _render(task, result)
+    except Exception as exc:
+        result['error'] = f'{type(exc).__name__}: {exc}'
+    return result
+
+
+def _render(task, result):
+    storage = default_storage
+    specs, fields = set(task['specs']), result['fields']
+    with storage.open(task['image'], 'rb') as f:
+        img = Image.open(f)
+        frames = durations = None
+        if 'animation' in specs and imaging.is_animated(img):
+            frames, durations = imaging.animation_frames(img)
+        img.seek(0)  # animated images get a static first-frame thumbnail
+        if frames is None:
+            draft(img)
+        img.load()
+
+    thumb = None
+    if 'thumbnail' in specs:
+        thumb, encoded = encode_thumbnail(img)
+        fields['thumbnail'] = store(storage, thumbnail_name(task['image'], encoded.format), encoded.data)
+        if task['thumbnail'] and task['thumbnail'] != fields['thumbnail']:
+            result['stale'].append(task['thumbnail'])
+        result['versions']['thumbnail'] = RENDITION_VERSIONS['thumbnail']
+
+    if 'placeholder' in specs:
+        source = thumb or img
+        fields['placeholder'] = imaging.placeholder_data_uri(source)
+        fields['dominant_color'] = imaging.dominant_color(source)
+        result['versions']['placeholder'] = RENDITION_VERSIONS['placeholder']
+
+    if 'animation' in specs:
+        if frames:
+            from .models import Photo
+
+            base = os.path.splitext(os.path.basename(task['image']))[0]
+            webp = imaging.encode_animated_webp(frames, durations)
+            fields['animation'] = _save_for_field(Photo, 'animation', f'{base}.webp', webp)
+            video = imaging.encode_mp4(frames, durations) if settings.ANIMATION_MP4_ENABLED else None
+            if video:
+                fields['video'] = _save_for_field(Photo, 'video', f'{base}.mp4', video)
+            fields.update(is_animated=True, frame_count=len(frames), duration_ms=sum(durations))
+            result['stale'] += [name for name in (task['animation'], task['video']) if name]
+        result['versions']['animation'] = RENDITION_VERSIONS['animation']
+
+
+def _save_for_field(model, field_name, filename, data):
+    field = model._meta.get_field(field_name)
+    return field.storage.save(field.generate_filename(None, filename), ContentFile(data))
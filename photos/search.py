@@ -0,0 +1,200 @@
+"""Photo search with combinable filters and facet counts.
+
+A search narrows ``photo_list`` by free text (``?q=``) and any of the
+filters in ``FILTER_KEYS``, e.g. ``?q=sunset&category=3&date=2024-05``.
+
+Facet counts (top categories, tags, owners and year or month buckets) are
+counted in Python over the newest ``FACET_MAX_CANDIDATES`` matches, which
+the joined ``icontains`` query fetches once (one row more tells whether
+there were more); only the tag links of those ids are read separately.
+Results are cached per viewer scope and normalized query string, and on
+PostgreSQL the queries run under ``FACET_TIME_BUDGET_MS``; past that the
+page is shown without facets.
+"""
+import hashlib
+import logging
+import re
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from photoalbum.instrumentation import record_cache
+
+from .models import Photo, PhotoCategory, PhotoTag
+
+logger = logging.getLogger(__name__)
+
+FILTER_KEYS = ('category', 'tag', 'owner', 'date')
+FACET_LABELS = {'category': '分類', 'tag': '標籤', 'owner': '上傳者', 'date': '日期'}
+FACET_LIMIT = 8
+FACET_MAX_CANDIDATES = 5000
+FACET_TIME_BUDGET_MS = 300
+FACET_CACHE_TIMEOUT = 2 * 60
+
+_DATE_RE = re.compile(r'(\d{4})(?:-(\d{2}))?')
+
+
+def normalize_query(q):
+    """Canonical form of a search, used for both the query and the cache key:
+    casefolded, whitespace collapsed"""
+    return ' '.join(q.casefold().split())
+
+
+def search(queryset, q):
+    """Photos whose title, description, owner, category or tag contains ``q``"""
+    return queryset.filter(
+        Q(title__icontains=q)
+        | Q(description__icontains=q)
+        | Q(owner__username__icontains=q)
+        | Q(category__name__icontains=q)
+        | Q(tags__name__icontains=q)
+    ).distinct()
+
+
+def parse_filters(params):
+    """The valid filters in ``params`` (a QueryDict), normalized"""
+    filters = {}
+    if params.get('category', '').isdigit():
+        filters['category'] = int(params['category'])
+    for key in ('tag', 'owner'):
+        value = params.get(key, '').strip()
+        if value:
+            filters[key] = value
+    match = _DATE_RE.fullmatch(params.get('date', ''))
+    if match and (match.group(2) is None or 1 <= int(match.group(2)) <= 12):
+        filters['date'] = match.group(0)
+    return filters
+
+
+def apply_filters(queryset, filters):
+    if 'category' in filters:
+        queryset = queryset.filter(category_id=filters['category'])
+    if 'tag' in filters:
+        queryset = queryset.filter(tags__name=filters['tag'])
+    if 'owner' in filters:
+        queryset = queryset.filter(owner__username=filters['owner'])
+    if 'date' in filters:
+        year, _, month = filters['date'].partition('-')
+        queryset = queryset.filter(created_at__year=int(year))
+        if month:
+            queryset = queryset.filter(created_at__month=int(month))
+    return queryset
+
+
+def facet_counts(queryset, user, q, filters):
+    """Cached facet counts for the photos of ``queryset``, a search for ``q``.
+
+    ``q`` must already be in ``normalize_query`` form, as the cache key and
+    the search have to agree on it.
+
+    Returns ``{'total', 'truncated', 'facets'}`` where ``facets`` maps each
+    filter key to ``[(value, label, count), ...]``, or ``None`` when the
+    time budget ran out. ``total`` is exact unless ``truncated``, in which
+    case more than ``FACET_MAX_CANDIDATES`` photos match.
+    """
+    scope = user.pk if user.is_authenticated else 'anon'
+    raw = f'{scope}|{q}|{sorted(filters.items())}'
+    key = 'facets:' + hashlib.md5(raw.encode()).hexdigest()
+    result = cache.get(key)
+    record_cache('search_facets', result is not None)
+    if result is None:
+        try:
+            result = _compute_facets(queryset, filters)
+        except DatabaseError:
+            logger.warning('Facet counts for %r exceeded the time budget', q)
+            result = {'timed_out': True}
+        cache.set(key, result, FACET_CACHE_TIMEOUT)
+    return None if result.get('timed_out') else result
+
+
+def _top(counter):
+    """The ``FACET_LIMIT`` most common ``(key, count)`` pairs, ties by key"""
+    return sorted(counter.items(), key=lambda item: (-item[1], item[0]))[:FACET_LIMIT]
+
+
+def _compute_facets(queryset, filters):
+    # Everything runs on the connection the search itself would use (a
+    # replica, usually), so the time budget applies to these queries
+    db = queryset.db
+    # Narrowed to a year, bucket by month; otherwise by year
+    by_month = 'date' in filters
+    with transaction.atomic(using=db):
+        connection = connections[db]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL statement_timeout = %s', [FACET_TIME_BUDGET_MS])
+        rows = list(queryset.order_by('-created_at', '-id')
+                    .values_list('id', 'category_id', 'owner_id', 'created_at')[:FACET_MAX_CANDIDATES + 1])
+        truncated = len(rows) > FACET_MAX_CANDIDATES
+        rows = rows[:FACET_MAX_CANDIDATES]
+
+        categories, owners, buckets = Counter(), Counter(), Counter()
+        for _pk, category_id, owner_id, created_at in rows:
+            if category_id is not None:
+                categories[category_id] += 1
+            owners[owner_id] += 1
+            local = timezone.localtime(created_at)
+            buckets[(local.year, local.month if by_month else 0)] += 1
+
+        tags = Counter()
+        ids = [row[0] for row in rows]
+        step = connection.features.max_query_params or len(ids) or 1
+        for start in range(0, len(ids), step):
+            tags.update(Photo.tags.through.objects.using(db).filter(photo_id__in=ids[start:start + step])
+                        .values_list('phototag_id', flat=True))
+
+        top_categories, top_owners, top_tags = _top(categories), _top(owners), _top(tags)
+        category_names = dict(PhotoCategory.objects.using(db)
+                              .filter(pk__in=[pk for pk, _ in top_categories]).values_list('pk', 'name'))
+        tag_names = dict(
+            PhotoTag.objects.using(db).filter(pk__in=[pk for pk, _ in top_tags]).values_list('pk', 'name'))
+        usernames = dict(
+            User.objects.using(db).filter(pk__in=[pk for pk, _ in top_owners]).values_list('pk', 'username'))
+
+    facets = {
+        'category': [(pk, category_names[pk], n) for pk, n in top_categories if pk in category_names],
+        'tag': [(tag_names[pk], tag_names[pk], n) for pk, n in top_tags if pk in tag_names],
+        'owner': [(usernames[pk], usernames[pk], n) for pk, n in top_owners if pk in usernames],
+        'date': [
+            (f'{year}-{month:02d}', f'{year} 年 {month} 月', n) if by_month
+            else (str(year), f'{year} 年', n)
+            for (year, month), n in sorted(buckets.items(), reverse=True)
+        ],
+    }
+    return {'total': len(rows), 'truncated': truncated, 'facets': facets}
+
+
+def facet_links(params, facet_result, filters, category_names=None):
+    """Template data: facet groups whose values link to their filter toggled,
+    and the active filters, each linking to its removal"""
+    def url(key, value=None):
+        query = params.copy()
+        query.pop('cursor', None)
+        if value is None or filters.get(key) == value:
+            query.pop(key, None)
+        else:
+            query[key] = str(value)
+        return '?' + query.urlencode()
+
+    facets = facet_result['facets'] if facet_result else {}
+    groups = [
+        {
+            'label': FACET_LABELS[key],
+            'values': [
+                {'label': label, 'count': count, 'active': filters.get(key) == value, 'url': url(key, value)}
+                for value, label, count in facets[key]
+            ],
+        }
+        for key in FILTER_KEYS if facets.get(key)
+    ]
+    active = []
+    for key, value in filters.items():
+        label = next((label for v, label, _ in facets.get(key, ()) if v == value), None)
+        if label is None:
+            label = (category_names or {}).get(value, value) if key == 'category' else value
+        active.append({'label': f'{FACET_LABELS[key]}：{label}', 'url': url(key)})
+    return groups, active
@@ -0,0 +1,159 @@
+from django.contrib.auth.models import User
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from accounts.models import Friendship, UserProfile
+
+from . import archive, object_cache
+from . import feed, maintenance  # noqa: F401 (registers their jobs)
+from .jobs import enqueue
+from .models import Photo, PhotoCategory, PhotoTag
+from .storage_gc import schedule_file_deletion
+from .tag_index import tag_index
+
+PHOTO_FILE_FIELDS = ('image', 'thumbnail', 'animation', 'video')
+
+
+@receiver(post_delete, sender=Photo)
+def delete_photo_files(sender, instance, **kwargs):
+    """Remove a deleted photo's files from storage after the delete commits"""
+    schedule_file_deletion(getattr(instance, field).name for field in PHOTO_FILE_FIELDS)
+
+
+@receiver(post_delete, sender=Photo)
+def uncount_archive_photo(sender, instance, **kwargs):
+    if instance.privacy == 'public':
+        archive.adjust(instance.owner_id, instance.created_at, -1)
+
+
+@receiver(post_save, sender=Photo)
+def update_feeds_for_photo(sender, instance, created, update_fields=None, **kwargs):
+    """Fan out newly shared photos and retract ones that became private.
+
+    Fan-out writes a row per friend, so it is always left to the job worker
+    rather than run inside the upload request, even with ``JOBS_EAGER``.
+    """
+    if not created and update_fields is not None and 'privacy' not in update_fields:
+        return
+    previous = None if created else getattr(instance, '_loaded_privacy', None)
+    shared = instance.privacy != 'private'
+    if shared and (created or previous == 'private'):
+        enqueue('feed_fanout', eager=False, photo_id=instance.pk)
+    elif not shared and previous not in (None, 'private'):
+        enqueue('feed_retract', photo_id=instance.pk)
+
+
+@receiver(post_save, sender=Photo)
+def count_archive_photo(sender, instance, created, update_fields=None, **kwargs):
+    """Keep the archive histogram in step as photos become public or stop being public"""
+    if not created and update_fields is not None and 'privacy' not in update_fields:
+        return
+    was_public = not created and getattr(instance, '_loaded_privacy', None) == 'public'
+    is_public = instance.privacy == 'public'
+    if is_public != was_public:
+        archive.adjust(instance.owner_id, instance.created_at, 1 if is_public else -1)
+
+
+@receiver(post_save, sender=Photo)
+def remember_privacy(sender, instance, **kwargs):
+    # Connected after the receivers above, which compare with the loaded privacy
+    instance._loaded_privacy = instance.privacy
+
+
+@receiver([post_save, post_delete], sender=Photo)
+def bump_photo_snapshot(sender, instance, **kwargs):
+    """Drop the cached detail snapshot, and the owner's related photos"""
+    if getattr(instance, '_defer_snapshot_bump', False):
+        return  # Photo.save(): the image pipeline's save follows
+    object_cache.bump_photos([instance])
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=UserProfile)
+def bump_owner_snapshot(sender, instance, update_fields=None, **kwargs):
+    if sender is User and update_fields is not None and set(update_fields) <= {'last_login'}:
+        return  # every login saves the user
+    object_cache.bump(f'owner:{instance.pk if sender is User else instance.user_id}')
+
+
+@receiver([post_save, post_delete], sender=PhotoCategory)
+@receiver([post_save, post_delete], sender=PhotoTag)
+def bump_taxonomy(sender, instance, created=False, **kwargs):
+    # A new category or tag is in no snapshot yet
+    if not created:
+        object_cache.bump('taxonomy')
+
+
+@receiver(m2m_changed, sender=Photo.tags.through)
+def bump_tagged_photos(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        object_cache.bump(f'photo:{instance.pk}')
+    elif pk_set:
+        object_cache.bump(*(f'photo:{pk}' for pk in pk_set))
+    else:
+        object_cache.bump('taxonomy')  # tag.photos.clear(): the photos are not known
+
+
+@receiver(post_save, sender=Friendship)
+def update_feeds_for_friendship(sender, instance, **kwargs):
+    a, b = instance.from_user_id, instance.to_user_id
+    if instance.status == Friendship.ACCEPTED:
+        enqueue('feed_backfill', eager=False, user_id=a, owner_id=b)
+        enqueue('feed_backfill', eager=False, user_id=b, owner_id=a)
+    elif instance.status == Friendship.BLOCKED:
+        enqueue('feed_unlink', user_id=a, owner_id=b)
+        enqueue('feed_unlink', user_id=b, owner_id=a)
+
+
+@receiver(post_delete, sender=Friendship)
+def unlink_feeds(sender, instance, **kwargs):
+    if instance.status == Friendship.ACCEPTED:
+        enqueue('feed_unlink', user_id=instance.from_user_id, owner_id=instance.to_user_id)
+
+
+@receiver(post_save, sender=PhotoTag)
+def index_tag(sender, instance, created, **kwargs):
+    if created:
+        tag_index.add(instance.name, instance.photo_count)
+    else:
+        tag_index.invalidate()  # the name may have changed
+
+
+@receiver(post_delete, sender=PhotoTag)
+def unindex_tag(sender, instance, **kwargs):
+    tag_index.remove(instance.name)
+
+
+def _count_tags(tag_ids, delta):
+    """Adjust ``PhotoTag.photo_count`` in the database and the autocomplete index"""
+    if not tag_ids or not delta:
+        return
+    tags = PhotoTag.objects.filter(pk__in=tag_ids)
+    tags.update(photo_count=Greatest(F('photo_count') + delta, 0))
+    tag_index.adjust(tags.values_list('name', flat=True), delta)
+
+
+@receiver(m2m_changed, sender=Photo.tags.through)
+def count_tag_photos(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        if reverse:
+            _count_tags([instance.pk], -instance.photos.count())
+        else:
+            _count_tags(list(instance.tags.values_list('pk', flat=True)), -1)
+    elif action in ('post_add', 'post_remove') and pk_set:
+        sign = 1 if action == 'post_add' else -1
+        if reverse:
+            # tag.photos.add(...): pk_set holds photo ids
+            _count_tags([instance.pk], sign * len(pk_set))
+        else:
+            _count_tags(pk_set, sign)
+
+
+@receiver(pre_delete, sender=Photo)
+def uncount_photo_tags(sender, instance, **kwargs):
+    # The through rows are removed without m2m_changed signals
+    _count_tags(list(instance.tags.values_list('pk', flat=True)), -1)
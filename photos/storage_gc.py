@@ -0,0 +1,130 @@
+"""Removal of media files that are no longer referenced by any row.
+
+Deleting or replacing a file-backed row calls ``schedule_file_deletion``,
+which enqueues a ``delete_media`` job after the transaction commits, so a
+rolled-back delete never loses a file. ``manage.py gc_media`` reconciles the
+storage listing with the database to catch anything the hooks missed.
+"""
+import logging
+from datetime import timedelta
+
+from django.apps import apps
+from django.core.files.storage import default_storage
+from django.db import models
+from django.utils import timezone
+
+from .jobs import enqueue, job
+
+logger = logging.getLogger(__name__)
+
+DELETE_BATCH_SIZE = 100
+
+
+def schedule_file_deletion(names):
+    """Delete the given storage names once the current transaction commits"""
+    names = sorted({name for name in names if name})
+    for start in range(0, len(names), DELETE_BATCH_SIZE):
+        enqueue('delete_media', names=names[start:start + DELETE_BATCH_SIZE])
+
+
+@job('delete_media')
+def delete_media(names):
+    # A name may have been reused by a newer row in the meantime
+    live = referenced_names(names)
+    delete_files([name for name in names if name not in live])
+
+
+def delete_files(names, storage=None):
+    """Bulk delete storage files, returns the number of names processed"""
+    storage = storage or default_storage
+    names = list(names)
+    if not names:
+        return 0
+
+    bucket = getattr(storage, 'bucket', None)
+    if bucket is not None and hasattr(bucket, 'delete_blobs'):
+        # Google Cloud Storage: one batched request instead of one per file
+        normalize = getattr(storage, '_normalize_name', lambda name: name)
+        bucket.delete_blobs([normalize(name) for name in names], on_error=lambda blob: None)
+    else:
+        for name in names:
+            storage.delete(name)
+    logger.info('Deleted %d media files', len(names))
+    return len(names)
+
+
+def file_fields():
+    """Every ``(model, field)`` pair that stores a file in the default storage"""
+    for model in apps.get_models():
+        for field in model._meta.get_fields():
+            if isinstance(field, models.FileField) and field.storage is default_storage:
+                yield model, field
+
+
+def media_prefixes():
+    """Top-level storage directories that uploads are written to"""
+    prefixes = set()
+    for _model, field in file_fields():
+        upload_to = field.upload_to if isinstance(field.upload_to, str) else ''
+        top = upload_to.split('/', 1)[0]
+        if top and '%' not in top:
+            prefixes.add(top)
+    return sorted(prefixes)
+
+
+def referenced_names(names):
+    """Subset of ``names`` still referenced by some FileField"""
+    names = list(names)
+    found = set()
+    for model, field in file_fields():
+        remaining = [name for name in names if name not in found]
+        if not remaining:
+            break
+        found.update(
+            model._default_manager.filter(**{f'{field.name}__in': remaining})
+            .values_list(field.name, flat=True)
+        )
+    return found
+
+
+def walk_storage(prefix, storage=None):
+    """Yield every file name below ``prefix``, one directory at a time"""
+    storage = storage or default_storage
+    try:
+        directories, files = storage.listdir(prefix)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    for name in files:
+        yield f'{prefix}/{name}'
+    for directory in directories:
+        yield from walk_storage(f'{prefix}/{directory}', storage)
+
+
+def find_orphans(batch_size=1000, min_age_hours=24, storage=None):
+    """Yield batches of unreferenced files older than ``min_age_hours``"""
+    storage = storage or default_storage
+    cutoff = timezone.now() - timedelta(hours=min_age_hours)
+    batch = []
+    for prefix in media_prefixes():
+        for name in walk_storage(prefix, storage):
+            batch.append(name)
+            if len(batch) >= batch_size:
+                yield _orphans_in(batch, cutoff, storage)
+                batch = []
+    if batch:
+        yield _orphans_in(batch, cutoff, storage)
+
+
+def _orphans_in(batch, cutoff, storage):
+    live = referenced_names(batch)
+    orphans = []
+    for name in batch:
+        if name in live:
+            continue
+        try:
+            modified = storage.get_modified_time(name)
+        except (NotImplementedError, OSError):
+            modified = None
+        if modified is None or modified < cutoff:
+            orphans.append(name)
+    return orphans
@@ -0,0 +1,207 @@
+"""Sitemaps and Atom feeds of public photos.
+
+``sitemap.xml`` is an index of shards covering ``SITEMAP_SHARD_SIZE`` photo
+ids each, so a shard's content only changes when a photo in its id range is
+added, edited, deleted or changes privacy. A shard is cached together with
+the ``(count, last updated_at)`` fingerprint of its range and regenerated
+only when that fingerprint changes. Per-user, per-tag and per-category Atom
+feeds hold the newest ``FEED_ENTRIES`` public photos.
+
+Bodies are streamed from keyset batches of ``values_list`` rows, so no
+response ever holds model instances for a whole shard, and every response
+carries ``Last-Modified``/``ETag`` for conditional GET.
+"""
+import hashlib
+from xml.sax.saxutils import escape, quoteattr
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import Count, F, Max
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils import timezone
+from django.utils.html import escape as escape_html
+from django.utils.http import http_date, quote_etag
+
+from photoalbum.instrumentation import record_cache
+
+from .aio import aget_object_or_404, run_io
+from .models import Photo, PhotoCategory, PhotoTag
+
+SITEMAP_SHARD_SIZE = 5000        # photo ids per shard; keeps a cached shard well under 1 MB
+SITEMAP_BATCH_SIZE = 1000
+SITEMAP_INDEX_CACHE_TIMEOUT = 5 * 60
+SITEMAP_SHARD_CACHE_TIMEOUT = 24 * 60 * 60
+FEED_ENTRIES = 50
+
+SITEMAP_XMLNS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+
+def public_photos():
+    return Photo.objects.filter(privacy='public')
+
+
+def keyset_batches(queryset, fields, size):
+    """Yield lists of ``values_list(*fields)`` rows in ascending pk order, one query per batch"""
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', *fields)[:size])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1][0]
+
+
+def shard_fingerprints():
+    """``{shard: (count, last updated_at)}`` for every non-empty shard, in one GROUP BY"""
+    rows = (
+        public_photos()
+        .annotate(shard=F('id') / SITEMAP_SHARD_SIZE)
+        .values('shard').annotate(count=Count('id'), lastmod=Max('updated_at'))
+        .order_by('shard').values_list('shard', 'count', 'lastmod')
+    )
+    return {shard: (count, lastmod) for shard, count, lastmod in rows}
+
+
+def shard_fingerprint(shard):
+    start = shard * SITEMAP_SHARD_SIZE
+    result = public_photos().filter(id__gte=start, id__lt=start + SITEMAP_SHARD_SIZE).aggregate(
+        count=Count('id'), lastmod=Max('updated_at'))
+    return result['count'], result['lastmod']
+
+
+def _etag(*parts):
+    return quote_etag(hashlib.md5(repr(parts).encode(), usedforsecurity=False).hexdigest())
+
+
+def _conditional(request, content_type, lastmod, etag, body):
+    """A 304 when the client's copy is current, else ``body`` (bytes or an async iterator)"""
+    not_modified = get_conditional_response(
+        request, etag=etag, last_modified=lastmod.timestamp() if lastmod else None)
+    if not_modified is not None:
+        return not_modified
+    if isinstance(body, bytes):
+        response = HttpResponse(body, content_type=content_type)
+    else:
+        response = StreamingHttpResponse(body, content_type=content_type)
+    response['ETag'] = etag
+    if lastmod:
+        response['Last-Modified'] = http_date(lastmod.timestamp())
+    return response
+
+
+def robots_txt(request):
+    sitemap_url = request.build_absolute_uri(reverse('photos:sitemap_index'))
+    return HttpResponse(f'User-agent: *\nAllow: /\n\nSitemap: {sitemap_url}\n', content_type='text/plain')
+
+
+async def sitemap_index(request):
+    """Index of the sitemap shards, each with its last modification"""
+    fingerprints = await cache.aget('sitemap:index')
+    record_cache('sitemap_index', fingerprints is not None)
+    if fingerprints is None:
+        fingerprints = await sync_to_async(shard_fingerprints)()
+        await cache.aset('sitemap:index', fingerprints, SITEMAP_INDEX_CACHE_TIMEOUT)
+
+    lastmod = max((lastmod for _, lastmod in fingerprints.values()), default=None)
+    lines = [f'<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="{SITEMAP_XMLNS}">\n']
+    for shard, (_, shard_lastmod) in fingerprints.items():
+        loc = request.build_absolute_uri(reverse('photos:sitemap', args=[shard]))
+        lines.append(f'<sitemap><loc>{escape(loc)}</loc><lastmod>{shard_lastmod.isoformat()}</lastmod></sitemap>\n')
+    lines.append('</sitemapindex>\n')
+    return _conditional(request, 'application/xml', lastmod, _etag(sorted(fingerprints.items())),
+                        ''.join(lines).encode())
+
+
+async def sitemap(request, shard):
+    """One shard: the public photos with ids in ``[shard * size, (shard + 1) * size)``"""
+    count, lastmod = await sync_to_async(shard_fingerprint)(shard)
+    if not count:
+        raise Http404('No such sitemap.')
+    etag = _etag(shard, count, lastmod)
+    key = f'sitemap:shard:{shard}'
+    cached = await cache.aget(key)
+    record_cache('sitemap_shard', cached is not None and cached[0] == etag)
+    if cached is not None and cached[0] == etag:
+        return _conditional(request, 'application/xml', lastmod, etag, cached[1])
+
+    start = shard * SITEMAP_SHARD_SIZE
+    photos = public_photos().filter(id__gte=start, id__lt=start + SITEMAP_SHARD_SIZE)
+    # reverse() once rather than per row
+    url_prefix, url_suffix = request.build_absolute_uri(reverse('photos:detail', args=[0])).rsplit('0', 1)
+
+    async def body():
+        chunks = []
+        chunks.append(f'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{SITEMAP_XMLNS}">\n'.encode())
+        yield chunks[-1]
+        batches = keyset_batches(photos, ['updated_at'], SITEMAP_BATCH_SIZE)
+        while (batch := await sync_to_async(next)(batches, None)) is not None:
+            chunks.append(''.join(
+                f'<url><loc>{escape(url_prefix)}{pk}{escape(url_suffix)}</loc>'
+                f'<lastmod>{updated_at.isoformat()}</lastmod></url>\n'
+                for pk, updated_at in batch
+            ).encode())
+            yield chunks[-1]
+        chunks.append(b'</urlset>\n')
+        yield chunks[-1]
+        # Only a shard streamed to the end is cached
+        await cache.aset(key, (etag, b''.join(chunks)), SITEMAP_SHARD_CACHE_TIMEOUT)
+
+    return _conditional(request, 'application/xml', lastmod, etag, body())
+
+
+async def _atom_feed(request, photos, title, html_url):
+    photos = photos.order_by('-created_at', '-id')
+    totals = await photos.aaggregate(count=Count('id'), lastmod=Max('updated_at'))
+    lastmod = totals['lastmod']
+    etag = _etag(request.path, totals['count'], lastmod)
+
+    self_url = request.build_absolute_uri()
+    rows = photos.values_list('pk', 'title', 'description', 'owner__username', 'created_at', 'updated_at',
+                              'thumbnail')[:FEED_ENTRIES]
+    storage = Photo._meta.get_field('thumbnail').storage
+
+    async def body():
+        updated = (lastmod or timezone.now()).isoformat()
+        yield (
+            '<?xml version="1.0" encoding="UTF-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n'
+            f'<title>{escape(title)}</title>\n<id>{escape(self_url)}</id>\n<updated>{updated}</updated>\n'
+            f'<link rel="self" href={quoteattr(self_url)}/>\n'
+            f'<link rel="alternate" type="text/html" href={quoteattr(request.build_absolute_uri(html_url))}/>\n'
+        ).encode()
+        async for pk, photo_title, description, username, created_at, updated_at, thumbnail in rows:
+            url = request.build_absolute_uri(reverse('photos:detail', args=[pk]))
+            content = f'<p>{escape_html(description)}</p>' if description else ''
+            if thumbnail:
+                thumb_url = request.build_absolute_uri(await run_io(storage.url, thumbnail))
+                content = f'<p><img src="{escape_html(thumb_url)}" alt=""></p>' + content
+            yield (
+                f'<entry><title>{escape(photo_title)}</title><id>{escape(url)}</id>'
+                f'<link rel="alternate" type="text/html" href={quoteattr(url)}/>'
+                f'<published>{created_at.isoformat()}</published><updated>{updated_at.isoformat()}</updated>'
+                f'<author><name>{escape(username)}</name></author>'
+                f'<content type="html">{escape(content)}</content></entry>\n'
+            ).encode()
+        yield b'</feed>\n'
+
+    return _conditional(request, 'application/atom+xml; charset=utf-8', lastmod, etag, body())
+
+
+async def user_feed(request, username):
+    owner = await aget_object_or_404(User, username=username)
+    return await _atom_feed(request, public_photos().filter(owner=owner), f'{owner.username} 的照片',
+                            reverse('photos:user_archive', args=[owner.username]))
+
+
+async def tag_feed(request, tag_name):
+    tag = await aget_object_or_404(PhotoTag, name=tag_name)
+    return await _atom_feed(request, public_photos().filter(tags=tag), f'標籤 #{tag.name}',
+                            reverse('photos:tag', args=[tag.name]))
+
+
+async def category_feed(request, category_id):
+    category = await aget_object_or_404(PhotoCategory, pk=category_id)
+    return await _atom_feed(request, public_photos().filter(category=category), f'分類：{category.name}',
+                            reverse('photos:category', args=[category.pk]))
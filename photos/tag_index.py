@@ -0,0 +1,169 @@
+"""In-memory prefix index for tag autocomplete.
+
+Tags are kept as a sorted array of normalised keys, so the tags matching a
+prefix form one contiguous slice found with two ``bisect`` calls. Keys are
+compared as Python strings (code points), so CJK prefixes match exactly like
+Latin ones. Top matches of broad prefixes (hundreds of tags or more) are
+memoised until the index changes.
+
+Each process builds its index lazily and keeps it current with the PhotoTag
+signals in photos/signals.py, applied once their transaction commits. It is
+rebuilt every ``REBUILD_SECONDS`` to pick up changes made by other workers.
+Builds run in a background thread, never in the request that noticed the
+index was due: meanwhile lookups use the stale index, or before the first
+build an indexed ``LIKE 'prefix%'`` query, which orders matches the same way.
+"""
+import heapq
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.db import connections, transaction
+
+from .models import PhotoTag, normalize_tag
+
+logger = logging.getLogger(__name__)
+
+REBUILD_SECONDS = 10 * 60
+MAX_RESULTS = 20
+MEMO_MIN_MATCHES = 256
+MEMO_MAX_PREFIXES = 10000
+_PREFIX_END = '\U0010ffff'
+
+
+class TagIndex:
+    def __init__(self):
+        self._keys = []      # sorted (normalized, name) pairs
+        self._counts = {}    # name -> photo_count
+        self._memo = {}
+        self._built_at = None
+        self._building = False
+        self._generation = 0  # bumped by invalidate() so a build in flight is not trusted
+        self._lock = threading.Lock()
+
+    # Lookups -------------------------------------------------------------
+
+    def suggest(self, prefix, limit=10):
+        """Top ``limit`` ``(name, photo_count)`` pairs whose key starts with ``prefix``"""
+        prefix = normalize_tag(prefix)
+        limit = max(1, min(limit, MAX_RESULTS))
+        if not prefix:
+            return []
+        if not self._ensure_built():
+            return self._suggest_from_db(prefix, limit)
+
+        with self._lock:
+            start = bisect_left(self._keys, (prefix,))
+            end = bisect_left(self._keys, (prefix + _PREFIX_END,), start)
+            if end - start <= limit * 4:
+                memo = False
+            else:
+                memo = end - start >= MEMO_MIN_MATCHES
+                if memo and prefix in self._memo:
+                    return self._memo[prefix][:limit]
+            counts = self._counts
+            # Same order as the database fallback: most used first, then by name
+            matches = heapq.nsmallest(
+                MAX_RESULTS if memo else limit,
+                ((-counts[name], name) for _key, name in self._keys[start:end]),
+            )
+            results = [(name, -count) for count, name in matches]
+            if memo:
+                if len(self._memo) >= MEMO_MAX_PREFIXES:
+                    self._memo.clear()
+                self._memo[prefix] = results
+        return results[:limit]
+
+    def _suggest_from_db(self, prefix, limit):
+        return list(
+            PhotoTag.objects.filter(normalized__startswith=prefix)
+            .order_by('-photo_count', 'name').values_list('name', 'photo_count')[:limit]
+        )
+
+    # Maintenance ---------------------------------------------------------
+
+    def _ensure_built(self):
+        """True if the index can serve lookups; starts a background build when it is due"""
+        fresh = self._built_at is not None and time.monotonic() - self._built_at < REBUILD_SECONDS
+        if fresh:
+            return True
+        with self._lock:
+            if not self._building:
+                self._building = True
+                threading.Thread(target=self._rebuild_in_background, name='tag-index', daemon=True).start()
+            return self._built_at is not None
+
+    def _rebuild_in_background(self):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception('Error rebuilding the tag index')
+        finally:
+            with self._lock:
+                self._building = False
+            # The thread opened its own connections; nothing else will close them
+            connections.close_all()
+
+    def rebuild(self):
+        generation = self._generation
+        rows = list(PhotoTag.objects.values_list('normalized', 'name', 'photo_count').iterator(chunk_size=10000))
+        keys = sorted((normalized or normalize_tag(name), name) for normalized, name, _count in rows)
+        counts = {name: count for _normalized, name, count in rows}
+        with self._lock:
+            self._keys, self._counts, self._memo = keys, counts, {}
+            self._built_at = time.monotonic()
+            if generation != self._generation:
+                # Invalidated while reading: serve it, but build again on the next lookup
+                self._built_at -= REBUILD_SECONDS
+
+    def invalidate(self):
+        """Force a rebuild on the next lookup (e.g. after a rename)"""
+        with self._lock:
+            self._built_at = None
+            self._generation += 1
+
+    # add/remove/adjust are called from model signals: they apply once the
+    # transaction commits, so a rolled-back change leaves the index alone
+
+    def add(self, name, count=0):
+        transaction.on_commit(lambda: self._add(name, count))
+
+    def _add(self, name, count):
+        with self._lock:
+            if self._built_at is None:
+                return
+            if name not in self._counts:
+                insort(self._keys, (normalize_tag(name), name))
+            self._counts[name] = count
+            self._memo.clear()
+
+    def remove(self, name):
+        transaction.on_commit(lambda: self._remove(name))
+
+    def _remove(self, name):
+        with self._lock:
+            if self._built_at is None or name not in self._counts:
+                return
+            key = (normalize_tag(name), name)
+            index = bisect_left(self._keys, key)
+            if index < len(self._keys) and self._keys[index] == key:
+                del self._keys[index]
+            del self._counts[name]
+            self._memo.clear()
+
+    def adjust(self, names, delta):
+        names = list(names)
+        transaction.on_commit(lambda: self._adjust(names, delta))
+
+    def _adjust(self, names, delta):
+        with self._lock:
+            if self._built_at is None:
+                return
+            for name in names:
+                if name in self._counts:
+                    self._counts[name] = max(0, self._counts[name] + delta)
+            self._memo.clear()
+
+
+tag_index = TagIndex()
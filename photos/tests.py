@@ -1,3 +1,1159 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import date, datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from accounts.models import Friendship
+
+from . import archive, export, feed, imaging, jobs, maintenance, object_cache, renditions, search, syndication, trending
+from .admission import BUSY_RETRY_AFTER, admit_upload
+from .jobs import enqueue
+from .models import ArchiveBucket, FeedEntry, Job, Photo, PhotoCategory, PhotoTag
+from .pagination import InvalidCursor, cursor_page, decode_cursor
+from .tag_index import REBUILD_SECONDS, TagIndex, tag_index
+
+
+def image_bytes(size=(64, 48), color=(200, 40, 40), fmt='PNG'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def animated_gif_bytes(colors=((200, 40, 40), (40, 200, 40), (40, 40, 200))):
+    frames = [Image.new('RGB', (32, 24), color) for color in colors]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, 'GIF', save_all=True, append_images=frames[1:], duration=100, loop=0)
+    return buffer.getvalue()
+
+
+def image_upload(name='photo.png'):
+    return SimpleUploadedFile(name, image_bytes(), content_type='image/png')
+
+
+async def read_streaming(response):
+    return b''.join([chunk async for chunk in response.streaming_content])
+
+
+class MediaTestCase(TestCase):
+    """Runs with an empty cache and a throwaway MEDIA_ROOT"""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=media_root, SECURE_SSL_REDIRECT=False)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        cache.clear()
+        self.owner = User.objects.create_user('owner', password='pw')
+        self.other = User.objects.create_user('other', password='pw')
+
+    def make_photo(self, title='photo', privacy='public', image=False, **kwargs):
+        kwargs.setdefault('owner', self.owner)
+        photo = Photo(title=title, privacy=privacy, **kwargs)
+        if image:
+            photo.image.save(f'{title}.png', ContentFile(image_bytes()), save=False)
+        photo.save()
+        return photo
+
+
+class PlaceholderTests(MediaTestCase):
+    def assertColorNear(self, value, expected, tolerance=4):
+        """Renditions are lossy, so channels may drift by a few units"""
+        channels = [(int(value[i:i + 2], 16), int(expected[i:i + 2], 16)) for i in (1, 3, 5)]
+        self.assertTrue(all(abs(a - b) <= tolerance for a, b in channels), f'{value} is not near {expected}')
+
+    def test_upload_stores_placeholder_and_dominant_color(self):
+        photo = self.make_photo(image=True)
+        photo.refresh_from_db()
+        self.assertTrue(photo.placeholder.startswith('data:image/webp;base64,'))
+        self.assertColorNear(photo.dominant_color, '#c82828')
+
+    def test_dominant_colors_of_a_batch(self):
+        red = Image.new('RGB', (40, 40), (200, 40, 40))
+        # Mostly blue with a red stripe: the larger bucket wins
+        blue = Image.new('RGB', (40, 40), (20, 60, 220))
+        blue.paste((200, 40, 40), (0, 0, 40, 10))
+        samples = np.stack([imaging.color_sample(red), imaging.color_sample(blue)])
+        self.assertEqual(imaging.dominant_colors(samples), ['#c82828', '#143cdc'])
+        self.assertEqual(imaging.dominant_colors(np.empty((0, 4, 3), dtype=np.uint8)), [])
+
+    def test_grid_card_reserves_space_and_paints_the_placeholder(self):
+        photo = self.make_photo(image=True)
+        photo.refresh_from_db()
+        response = self.client.get(reverse('photos:home'))
+        self.assertContains(response, f'width="{photo.width}" height="{photo.height}"')
+        self.assertContains(response, f'background-color: {photo.dominant_color};')
+        self.assertContains(response, 'background-image: url(data:image/webp;base64,')
+
+    def test_backfill_fills_missing_placeholders(self):
+        filled = self.make_photo('filled', image=True)
+        missing = self.make_photo('missing', image=True)
+        unreadable = self.make_photo('unreadable')
+        Photo.objects.filter(pk__in=[missing.pk, unreadable.pk]).update(placeholder='', dominant_color='')
+        Photo.objects.filter(pk=filled.pk).update(dominant_color='#000000')
+
+        out = io.StringIO()
+        call_command('backfill_placeholders', batch_size=1, stdout=out, stderr=io.StringIO())
+        self.assertIn('Updated 1 photos, 1 could not be read.', out.getvalue())
+        missing.refresh_from_db()
+        self.assertTrue(missing.placeholder.startswith('data:image/webp;base64,'))
+        self.assertColorNear(missing.dominant_color, '#c82828')
+        # Photos that already had a placeholder are left alone
+        self.assertEqual(Photo.objects.get(pk=filled.pk).dominant_color, '#000000')
+
+        call_command('backfill_placeholders', '--all', stdout=out, stderr=io.StringIO())
+        self.assertColorNear(Photo.objects.get(pk=filled.pk).dominant_color, '#c82828')
+
+
+class CursorPaginationTests(MediaTestCase):
+    def test_pages_cover_every_photo_once_in_order(self):
+        now = timezone.now()
+        # Photos sharing a timestamp are ordered by id, also across pages
+        for minutes in (0, 0, 1, 1, 1, 2, 3):
+            photo = self.make_photo()
+            Photo.objects.filter(pk=photo.pk).update(created_at=now - timedelta(minutes=minutes))
+        expected = list(Photo.objects.order_by('-created_at', '-id').values_list('pk', flat=True))
+
+        seen, cursor = [], None
+        while True:
+            page = cursor_page(Photo.objects.all(), cursor, limit=3)
+            seen += [photo.pk for photo in page]
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(seen, expected)
+
+    def test_last_page_has_no_cursor(self):
+        self.make_photo()
+        page = cursor_page(Photo.objects.all(), limit=1)
+        self.assertEqual(len(page), 1)
+        self.assertIsNone(page.next_cursor)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            decode_cursor('not-a-cursor')
+
+    def test_invalid_cursor_in_a_grid_is_a_404(self):
+        self.assertEqual(self.client.get(reverse('photos:home'), {'cursor': '!!!'}).status_code, 404)
+
+    def test_grid_fragment_sends_next_cursor(self):
+        for i in range(13):
+            self.make_photo(f'p{i}', image=True)
+        response = self.client.get(reverse('photos:home_grid'))
+        self.assertEqual(response.status_code, 200)
+        cursor = response['X-Next-Cursor']
+        response = self.client.get(reverse('photos:home_grid'), {'cursor': cursor})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Next-Cursor', response)
+
+
+class ApiTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.photo = self.make_photo('public photo')
+        self.private = self.make_photo('private photo', privacy='private')
+
+    def item_url(self, photo):
+        return reverse('photos:api_photo', args=[photo.pk])
+
+    def test_list_only_shows_public_photos(self):
+        response = self.client.get(reverse('photos:api_photos'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p['id'] for p in response.json()['results']], [self.photo.pk])
+
+    def test_list_rejects_bad_parameters(self):
+        url = reverse('photos:api_photos')
+        for params in ({'fields': 'id,nope'}, {'limit': 'x'}, {'cursor': '!!!'}):
+            with self.subTest(params=params):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('detail', response.json())
+
+    def test_private_photo_is_hidden_from_others(self):
+        self.assertEqual(self.client.get(self.item_url(self.private)).status_code, 404)
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(self.item_url(self.private)).status_code, 404)
+
+    def test_edit_requires_login_and_ownership(self):
+        body = json.dumps({'title': 'changed'})
+        response = self.client.patch(self.item_url(self.photo), body, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+        self.client.force_login(self.other)
+        response = self.client.patch(self.item_url(self.photo), body, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.delete(self.item_url(self.photo)).status_code, 403)
+        self.photo.refresh_from_db()
+        self.assertEqual(self.photo.title, 'public photo')
+
+    def test_partial_json_edit(self):
+        self.client.force_login(self.owner)
+        response = self.client.patch(self.item_url(self.photo), json.dumps({'title': 'changed', 'tags': ['a', 'b']}),
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['title'], 'changed')
+        self.photo.refresh_from_db()
+        self.assertEqual(self.photo.privacy, 'public')
+        self.assertEqual(sorted(tag.name for tag in self.photo.tags.all()), ['a', 'b'])
+
+    def test_edit_rejects_bad_bodies(self):
+        self.client.force_login(self.owner)
+        url = self.item_url(self.photo)
+        self.assertEqual(self.client.patch(url, '{', content_type='application/json').status_code, 400)
+        self.assertEqual(self.client.patch(url, '[]', content_type='application/json').status_code, 400)
+        response = self.client.patch(url, json.dumps({'privacy': 'everyone'}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('privacy', response.json()['errors'])
+
+    def test_delete(self):
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.delete(self.item_url(self.photo)).status_code, 204)
+        self.assertFalse(Photo.objects.filter(pk=self.photo.pk).exists())
+
+    def test_upload(self):
+        self.assertEqual(self.client.post(reverse('photos:api_photos'), {'title': 'x'}).status_code, 401)
+        self.client.force_login(self.owner)
+        response = self.client.post(reverse('photos:api_photos'), {'title': 'x'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('image', response.json()['errors'])
+        response = self.client.post(reverse('photos:api_photos'), {
+            'title': 'new', 'privacy': 'public', 'image': image_upload(),
+        })
+        self.assertEqual(response.status_code, 201)
+        photo = Photo.objects.get(pk=response.json()['id'])
+        self.assertEqual((photo.width, photo.height), (64, 48))
+
+    def test_method_not_allowed(self):
+        response = self.client.put(reverse('photos:api_photos'))
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response['Allow'], 'GET, POST')
+
+    def test_category_filter(self):
+        category = PhotoCategory.objects.create(name='風景')
+        Photo.objects.filter(pk=self.photo.pk).update(category=category)
+        response = self.client.get(reverse('photos:api_photos'), {'category': category.pk})
+        self.assertEqual([p['id'] for p in response.json()['results']], [self.photo.pk])
+        response = self.client.get(reverse('photos:api_photos'), {'category': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_form_encoded_edit(self):
+        self.client.force_login(self.owner)
+        response = self.client.patch(self.item_url(self.photo), 'title=form+title',
+                                     content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 200)
+        self.photo.refresh_from_db()
+        self.assertEqual(self.photo.title, 'form title')
+
+    def test_unsupported_body(self):
+        self.client.force_login(self.owner)
+        response = self.client.patch(self.item_url(self.photo), 'title', content_type='text/plain')
+        self.assertEqual(response.status_code, 415)
+
+    def test_list_includes_the_callers_own_photos(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('photos:api_photos'))
+        self.assertEqual({p['id'] for p in response.json()['results']}, {self.photo.pk, self.private.pk})
+        self.client.force_login(self.other)
+        response = self.client.get(reverse('photos:api_photos'))
+        self.assertEqual([p['id'] for p in response.json()['results']], [self.photo.pk])
+
+
+class SeedDatasetTests(MediaTestCase):
+    def test_seed_rebuilds_derived_rows(self):
+        call_command('seed_dataset', users=3, photos=20, tags=5, categories=2, image_pool=2, days=30,
+                     stdout=io.StringIO())
+        photos = Photo.objects.filter(owner__username__startswith='seed_')
+        self.assertEqual(photos.count(), 20)
+        self.assertFalse(photos.filter(trending_score__isnull=True).exists())
+        self.assertFalse(photos.exclude(rendition_versions=renditions.current_versions(photos[0])).exists())
+        public = photos.filter(privacy='public').count()
+        self.assertEqual(sum(ArchiveBucket.objects.filter(owner__isnull=True, month=0)
+                             .values_list('count', flat=True)), public)
+        self.assertEqual(FeedEntry.objects.count(), photos.exclude(privacy='private').count())
+
+
+@override_settings(ANIMATION_MP4_ENABLED=False, JOBS_EAGER=True)
+class AnimationTests(MediaTestCase):
+    def replace_image(self, photo, name, data):
+        photo.image.save(name, ContentFile(data), save=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            photo.save()
+        photo.refresh_from_db()
+
+    def test_animated_upload_gets_an_animated_webp(self):
+        photo = self.make_photo()
+        self.replace_image(photo, 'moving.gif', animated_gif_bytes())
+        self.assertTrue(photo.is_animated)
+        self.assertEqual((photo.frame_count, photo.duration_ms), (3, 300))
+        with photo.animation.open('rb') as f:
+            self.assertEqual(Image.open(f).n_frames, 3)
+
+    def test_static_replacement_clears_the_animation(self):
+        photo = self.make_photo()
+        self.replace_image(photo, 'moving.gif', animated_gif_bytes())
+        old_animation = photo.animation.name
+
+        self.replace_image(photo, 'still.png', image_bytes())
+        self.assertFalse(photo.is_animated)
+        self.assertFalse(photo.animation)
+        self.assertIsNone(photo.frame_count)
+        self.assertFalse(photo.animation.storage.exists(old_animation))
+
+    def test_animated_replacement_is_transcoded_again(self):
+        photo = self.make_photo()
+        self.replace_image(photo, 'first.gif', animated_gif_bytes())
+        old_animation = photo.animation.name
+
+        self.replace_image(photo, 'second.gif', animated_gif_bytes(((0, 0, 0), (255, 255, 255))))
+        self.assertEqual(photo.frame_count, 2)
+        self.assertNotEqual(photo.animation.name, old_animation)
+        self.assertFalse(photo.animation.storage.exists(old_animation))
+
+
+class FeedTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.stranger = User.objects.create_user('stranger')
+        self.befriend(self.owner, self.other)
+
+    def befriend(self, a, b):
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.send_request(a, b)
+            Friendship.objects.accept(a, b)
+        jobs.run_pending()
+
+    def publish(self, title='photo', privacy='public'):
+        with self.captureOnCommitCallbacks(execute=True):
+            photo = self.make_photo(title, privacy)
+        jobs.run_pending()
+        return photo
+
+    def feed_ids(self, user):
+        return [photo.pk for photo in feed.feed_page(user)]
+
+    def test_shared_photos_fan_out_to_the_owner_and_friends(self):
+        public = self.publish('public')
+        friends = self.publish('friends', privacy='friends')
+        self.publish('private', privacy='private')
+        self.assertEqual(self.feed_ids(self.owner), [friends.pk, public.pk])
+        self.assertEqual(self.feed_ids(self.other), [friends.pk, public.pk])
+        self.assertEqual(self.feed_ids(self.stranger), [])
+
+    def test_fan_out_waits_for_the_worker(self):
+        with self.captureOnCommitCallbacks(execute=True), override_settings(JOBS_EAGER=True):
+            self.make_photo()
+        self.assertFalse(FeedEntry.objects.exists())
+
+    def test_making_a_photo_private_retracts_it(self):
+        photo = self.publish()
+        photo.privacy = 'private'
+        with self.captureOnCommitCallbacks(execute=True):
+            photo.save(update_fields=['privacy'])
+        jobs.run_pending()
+        self.assertFalse(FeedEntry.objects.filter(photo=photo).exists())
+
+    def test_new_friend_is_backfilled_and_unfriending_unlinks(self):
+        photo = self.publish()
+        self.befriend(self.stranger, self.owner)
+        self.assertEqual(self.feed_ids(self.stranger), [photo.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.remove(self.stranger, self.owner)
+        jobs.run_pending()
+        self.assertFalse(FeedEntry.objects.filter(user=self.stranger).exists())
+
+    def test_heavy_owners_are_pulled_at_read_time(self):
+        with mock.patch.object(feed, 'FANOUT_MAX_FOLLOWERS', 0):
+            cache.delete(feed.HEAVY_OWNERS_CACHE_KEY)  # computed by the backfill in setUp
+            photo = self.publish()
+            self.assertFalse(FeedEntry.objects.filter(user=self.other).exists())
+            self.assertEqual(self.feed_ids(self.other), [photo.pk])
+
+    def test_feed_pages_follow_the_cursor(self):
+        photos = [self.publish(f'p{i}') for i in range(5)]
+        first = feed.feed_page(self.other, limit=3)
+        second = feed.feed_page(self.other, first.next_cursor, limit=3)
+        self.assertEqual([p.pk for p in first] + [p.pk for p in second], [p.pk for p in reversed(photos)])
+        self.assertIsNone(second.next_cursor)
+
+    def test_trim_keeps_the_newest_entries(self):
+        photos = [self.publish(f'p{i}') for i in range(4)]
+        self.assertEqual(feed.trim(self.other.pk, max_entries=2), 2)
+        self.assertEqual(self.feed_ids(self.other), [photos[3].pk, photos[2].pk])
+
+
+class TrendingTests(MediaTestCase):
+    def test_new_views_are_added_at_the_current_time(self):
+        created, now = 1_000_000.0, 1_000_000.0 + 3 * 86400
+        first = trending.compute_scores([np.nan], [created], [0], [0], created)
+        updated = trending.compute_scores(first, [created], [3], [0], now)
+        expected = np.logaddexp(trending.anchored_log_weight(created),
+                                np.log(3) + trending.anchored_log_weight(now))
+        np.testing.assert_allclose(updated, expected)
+        # Without new views the stored score is kept as is
+        np.testing.assert_allclose(trending.compute_scores(updated, [created], [3], [3], now), updated)
+
+    def test_recent_uploads_outrank_older_popular_ones(self):
+        now = timezone.now()
+        old = self.make_photo('old', view_count=50)
+        new = self.make_photo('new', view_count=2)
+        hidden = self.make_photo('hidden', privacy='private', view_count=1000)
+        Photo.objects.filter(pk=old.pk).update(created_at=now - timedelta(days=7))
+
+        self.assertEqual(trending.update_scores(now=now), 3)
+        self.assertEqual([photo.pk for photo in trending.trending()], [new.pk, old.pk])
+        self.assertNotIn(hidden.pk, [photo.pk for photo in trending.trending()])
+
+    def test_only_new_or_viewed_photos_are_rescored(self):
+        photo = self.make_photo()
+        trending.update_scores()
+        self.assertEqual(trending.update_scores(), 0)
+        photo.increment_view_count()
+        self.assertEqual(trending.update_scores(), 1)
+
+    def test_page(self):
+        self.make_photo(image=True)
+        trending.update_scores()
+        self.assertEqual(self.client.get(reverse('photos:trending')).status_code, 200)
+
+    def test_benchmark_with_fewer_photos_than_the_top(self):
+        out = io.StringIO()
+        call_command('update_trending', benchmark=10, stdout=out)
+        self.assertIn('Scored 10 synthetic photos', out.getvalue())
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class TagIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for name, count in (('Cat', 5), ('cathedral', 2), ('ＣＡＴＳ', 9), ('dog', 7), ('台北', 3)):
+            PhotoTag.objects.create(name=name, photo_count=count)
+        self.index = TagIndex()
+        # Builds would run in a thread with its own connection, which cannot
+        # see this test's uncommitted rows; tests start them by hand instead
+        patcher = mock.patch('photos.tag_index.threading.Thread')
+        self.thread = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_build(self):
+        call = self.thread.call_args_list[-1]
+        with mock.patch('photos.tag_index.connections.close_all'):
+            call.kwargs['target']()
+
+    def test_most_used_matches_first_ignoring_case_and_width(self):
+        self.index.rebuild()
+        self.assertEqual(self.index.suggest('ca'), [('ＣＡＴＳ', 9), ('Cat', 5), ('cathedral', 2)])
+        self.assertEqual(self.index.suggest('ｃａｔｈ'), [('cathedral', 2)])
+        self.assertEqual(self.index.suggest('台'), [('台北', 3)])
+        self.assertEqual(self.index.suggest('ca', limit=1), [('ＣＡＴＳ', 9)])
+
+    def test_first_lookups_use_the_database_while_building(self):
+        expected = [('ＣＡＴＳ', 9), ('Cat', 5), ('cathedral', 2)]
+        self.assertEqual(self.index.suggest('ca'), expected)
+        self.assertEqual(self.index.suggest('ca'), expected)
+        self.thread.assert_called_once()
+
+        self.run_build()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.index.suggest('ca'), expected)
+
+    def test_stale_index_is_served_while_rebuilding(self):
+        self.index.rebuild()
+        PhotoTag.objects.filter(name='dog').update(photo_count=1)
+        self.index._built_at -= REBUILD_SECONDS
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.index.suggest('do'), [('dog', 7)])
+        self.thread.assert_called_once()
+        self.run_build()
+        self.assertEqual(self.index.suggest('do'), [('dog', 1)])
+        self.assertFalse(self.index._building)
+
+    def test_invalidated_build_is_redone(self):
+        values_list = PhotoTag.objects.values_list
+
+        def racing_read(*fields):
+            self.index.invalidate()  # e.g. a rename committed while the tags are read
+            return values_list(*fields)
+
+        self.index.suggest('ca')
+        with mock.patch.object(PhotoTag.objects, 'values_list', racing_read):
+            self.run_build()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.index.suggest('ca'), [('ＣＡＴＳ', 9), ('Cat', 5), ('cathedral', 2)])
+        self.assertEqual(self.thread.call_count, 2)
+
+    def test_signals_update_the_built_index(self):
+        self.addCleanup(tag_index.invalidate)
+        tag_index.rebuild()
+        with self.captureOnCommitCallbacks(execute=True):
+            PhotoTag.objects.create(name='catnip', photo_count=4)
+            PhotoTag.objects.get(name='cathedral').delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(tag_index.suggest('cat'), [('ＣＡＴＳ', 9), ('Cat', 5), ('catnip', 4)])
+
+    def test_autocomplete_api(self):
+        self.addCleanup(tag_index.invalidate)
+        tag_index.rebuild()
+        response = self.client.get(reverse('photos:api_tag_autocomplete'), {'q': 'CA', 'limit': 2})
+        self.assertEqual(response.json()['results'], [{'name': 'ＣＡＴＳ', 'count': 9}, {'name': 'Cat', 'count': 5}])
+
+
+class AdminActionTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser('admin', password='pw')
+        self.client.force_login(self.admin)
+        self.url = reverse('admin:photos_photo_changelist')
+
+    def run_action(self, action, query='', **data):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'{self.url}{query}', {'action': action, **data})
+        self.assertEqual(response.status_code, 302)
+        return response
+
+    def run_jobs(self):
+        # Each batch enqueues the next one when the test's transaction "commits"
+        while True:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                jobs.run_pending()
+            if not callbacks:
+                break
+
+    def test_ticked_photos_are_one_job(self):
+        photos = [self.make_photo(f'p{i}') for i in range(3)]
+        self.run_action('make_private', _selected_action=[photos[0].pk, photos[1].pk])
+        self.assertEqual(Job.objects.filter(name='photo_action').count(), 1)
+        self.assertTrue(Photo.objects.filter(privacy='public').exists())  # nothing ran in the request
+
+        self.run_jobs()
+        privacy = dict(Photo.objects.values_list('pk', 'privacy'))
+        self.assertEqual([privacy[photo.pk] for photo in photos], ['private', 'private', 'public'])
+
+    def test_select_all_applies_the_changelist_filters_in_batches(self):
+        featured = [self.make_photo(f'f{i}', is_featured=True) for i in range(5)]
+        other = self.make_photo('other')
+        with mock.patch.object(maintenance, 'BATCH_SIZE', 2):
+            self.run_action('make_friends_only', '?is_featured__exact=1',
+                            select_across='1', _selected_action=[featured[0].pk])
+            self.assertEqual(Job.objects.filter(name='photo_action').count(), 1)
+            self.run_jobs()
+
+        self.assertEqual(set(Photo.objects.filter(privacy='friends').values_list('pk', flat=True)),
+                         {photo.pk for photo in featured})
+        self.assertEqual(Photo.objects.get(pk=other.pk).privacy, 'public')
+        # Batches of 2, and the last one finds nothing left
+        self.assertEqual(Job.objects.filter(name='photo_action', status='done').count(), 3)
+
+
+class RenditionTests(MediaTestCase):
+    def test_versioned_names_follow_the_content(self):
+        name = renditions.versioned_name('thumbnails/cat.jpg', b'one')
+        self.assertRegex(name, r'^thumbnails/cat\.[0-9a-f]{10}\.jpg$')
+        # A new version replaces the digest rather than stacking another one
+        self.assertEqual(renditions.versioned_name(name, b'one'), name)
+        self.assertEqual(renditions.versioned_name(name, b'two'), renditions.versioned_name('thumbnails/cat.jpg', b'two'))
+
+    def test_store_never_overwrites(self):
+        storage = Photo._meta.get_field('thumbnail').storage
+        first = renditions.store(storage, 'thumbnails/cat.jpg', b'one')
+        self.assertEqual(renditions.store(storage, 'thumbnails/cat.jpg', b'one'), first)
+        second = renditions.store(storage, first, b'two')
+        self.assertNotEqual(second, first)
+        with storage.open(first) as f:
+            self.assertEqual(f.read(), b'one')
+
+    def test_upload_records_current_versions(self):
+        photo = self.make_photo(image=True)
+        photo.refresh_from_db()
+        self.assertEqual(photo.rendition_versions, renditions.RENDITION_VERSIONS)
+        self.assertEqual(renditions.outdated_specs(photo), [])
+
+    @override_settings(JOBS_EAGER=True)
+    def test_rebuild_renders_outdated_specs_and_deletes_replaced_files(self):
+        photo = self.make_photo(image=True)
+        old_thumbnail = photo.thumbnail.name
+        checkpoint = photo.image.storage.path('checkpoint.json')
+        versions = {**renditions.RENDITION_VERSIONS, 'thumbnail': renditions.RENDITION_VERSIONS['thumbnail'] + 1}
+
+        with mock.patch.object(renditions, 'RENDITION_VERSIONS', versions), \
+                mock.patch.object(renditions, 'THUMBNAIL_SIZE', 20), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(renditions.outdated_specs(photo), ['thumbnail'])
+            call_command('rebuild_renditions', workers=1, checkpoint=checkpoint, stdout=io.StringIO())
+
+        photo.refresh_from_db()
+        self.assertEqual(photo.rendition_versions['thumbnail'], versions['thumbnail'])
+        self.assertNotEqual(photo.thumbnail.name, old_thumbnail)
+        self.assertTrue(photo.thumbnail.storage.exists(photo.thumbnail.name))
+        self.assertFalse(photo.thumbnail.storage.exists(old_thumbnail))
+        self.assertFalse(os.path.exists(checkpoint))
+
+
+def photo_like_bytes(size=(400, 300), noise=0.5):
+    """A smooth gradient with some noise, which lossy formats compress well"""
+    rng = np.random.default_rng(0)
+    x, y = np.meshgrid(np.linspace(0, 255, size[0]), np.linspace(0, 255, size[1]))
+    pixels = np.stack([x, y, (x + y) / 2], axis=-1) + rng.normal(0, noise, (size[1], size[0], 3))
+    buffer = io.BytesIO()
+    Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class AdaptiveEncodingTests(MediaTestCase):
+    def test_encoding_reaches_the_ssim_target(self):
+        img = Image.open(io.BytesIO(photo_like_bytes()))
+        encoded = imaging.encode_adaptive(img, target=imaging.SSIM_TARGET_ORIGINAL)
+        self.assertIn(encoded.format, ('JPEG', 'WEBP'))
+        with Image.open(io.BytesIO(encoded.data)) as decoded:
+            self.assertGreaterEqual(imaging.ssim(imaging.luma(img), imaging.luma(decoded)), imaging.SSIM_TARGET_ORIGINAL)
+
+    def test_noisy_images_at_high_quality(self):
+        # Large enough to overflow Pillow's optimised JPEG buffer at quality 90+
+        img = Image.open(io.BytesIO(photo_like_bytes(noise=16)))
+        encoded = imaging.encode_adaptive(img)
+        self.assertGreaterEqual(encoded.score, imaging.SSIM_TARGET_ORIGINAL)
+        self.assertLess(len(encoded.data), img.width * img.height * 3)
+
+    def test_graphics_may_stay_lossless(self):
+        img = Image.new('RGB', (200, 200), (255, 255, 255))
+        img.paste((0, 0, 0), (50, 50, 150, 150))
+        self.assertEqual(imaging.encode_adaptive(img).format, 'PNG')
+
+    def test_photo_originals_are_reencoded_smaller(self):
+        data = photo_like_bytes()
+        photo = Photo(owner=self.owner, title='photo')
+        photo.image.save('photo.png', ContentFile(data), save=False)
+        photo.save()
+        photo.refresh_from_db()
+        self.assertNotEqual(os.path.splitext(photo.image.name)[1], '.png')
+        self.assertLess(photo.file_size, len(data))
+        self.assertEqual(photo.file_size, photo.image.storage.size(photo.image.name))
+        self.assertEqual((photo.width, photo.height), (400, 300))
+
+    def test_animated_originals_are_kept_without_errors(self):
+        photo = Photo(owner=self.owner, title='moving')
+        photo.image.save('moving.gif', ContentFile(animated_gif_bytes()), save=False)
+        with self.assertNoLogs('photos.models', 'ERROR'):
+            photo.save()
+        self.assertTrue(photo.image.name.endswith('.gif'))
+        self.assertTrue(photo.thumbnail)
+
+
+class SearchFacetTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.landscape = PhotoCategory.objects.create(name='風景')
+        self.sea = PhotoTag.objects.create(name='sea')
+        for title, owner, category in (('beach one', self.owner, self.landscape),
+                                       ('beach two', self.owner, None),
+                                       ('beach three', self.other, self.landscape)):
+            self.make_photo(title, image=True, owner=owner, category=category).tags.add(self.sea)
+        self.make_photo('mountain', image=True, category=self.landscape)
+        self.make_photo('beach hidden', privacy='private', owner=self.other)
+
+    def facets(self, q='beach', filters=None):
+        queryset = search.search(Photo.objects.visible_to(self.owner), q)
+        return search.facet_counts(queryset, self.owner, q, filters or {})
+
+    def test_counts(self):
+        result = self.facets()
+        year = timezone.localtime().year
+        self.assertEqual((result['total'], result['truncated']), (3, False))
+        self.assertEqual(result['facets'], {
+            'category': [(self.landscape.pk, '風景', 2)],
+            'tag': [('sea', 'sea', 3)],
+            'owner': [('owner', 'owner', 2), ('other', 'other', 1)],
+            'date': [(str(year), f'{year} 年', 3)],
+        })
+
+    def test_month_buckets_once_narrowed_to_a_year(self):
+        now = timezone.localtime()
+        result = self.facets(filters={'date': str(now.year)})
+        self.assertEqual(result['facets']['date'], [(f'{now.year}-{now.month:02d}', f'{now.year} 年 {now.month} 月', 3)])
+
+    def test_past_the_cap_only_the_newest_are_counted(self):
+        with mock.patch.object(search, 'FACET_MAX_CANDIDATES', 2):
+            result = self.facets()
+        self.assertEqual((result['total'], result['truncated']), (2, True))
+        self.assertEqual(result['facets']['tag'], [('sea', 'sea', 2)])
+
+    def test_the_search_runs_once(self):
+        # Candidates, their tag links, the names of the top categories, tags and
+        # owners, and the savepoint around them
+        with self.assertNumQueries(7):
+            self.facets()
+        with self.assertNumQueries(0):
+            self.facets()
+
+    def test_page(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('photos:home'), {'q': 'Beach'})
+        self.assertContains(response, '找到 <strong>3</strong> 筆結果', html=False)
+        self.assertContains(response, '風景')
+
+        cache.clear()
+        with mock.patch.object(search, 'FACET_MAX_CANDIDATES', 2):
+            response = self.client.get(reverse('photos:home'), {'q': 'beach'})
+        self.assertContains(response, '找到 <strong>2+</strong> 筆結果', html=False)
+
+    def test_page_without_facets(self):
+        with mock.patch.object(search, '_compute_facets', side_effect=DatabaseError):
+            response = self.client.get(reverse('photos:home'), {'q': 'beach'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, '筆結果')
+
+
+class ArchiveTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = timezone.localtime()
+
+    def counts(self, owner_id=None):
+        now = self.now
+        return [archive.period_count(owner_id, now.year), archive.period_count(owner_id, now.year, now.month),
+                archive.period_count(owner_id, now.year, now.month, now.day)]
+
+    def test_buckets_follow_uploads_privacy_and_deletes(self):
+        photo = self.make_photo()
+        self.make_photo('private', privacy='private')
+        self.make_photo('other', owner=self.other)
+        self.assertEqual(self.counts(), [2, 2, 2])
+        self.assertEqual(self.counts(self.owner.pk), [1, 1, 1])
+
+        photo.privacy = 'friends'
+        photo.save()
+        self.assertEqual(self.counts(self.owner.pk), [0, 0, 0])
+        photo.privacy = 'public'
+        photo.save()
+        self.assertEqual(self.counts(self.owner.pk), [1, 1, 1])
+        photo.title = 'renamed'
+        photo.save(update_fields=['title'])
+        self.assertEqual(self.counts(self.owner.pk), [1, 1, 1])
+
+        photo.delete()
+        self.assertEqual(self.counts(), [1, 1, 1])
+        self.assertEqual(self.counts(self.owner.pk), [0, 0, 0])
+
+    def test_rebuild_matches_the_incremental_counts(self):
+        for title in ('a', 'b'):
+            self.make_photo(title)
+        self.make_photo('c', owner=self.other)
+        self.make_photo('private', privacy='private')
+        incremental = set(ArchiveBucket.objects.filter(count__gt=0).values_list('owner', 'year', 'month', 'day', 'count'))
+
+        ArchiveBucket.objects.update(count=0)
+        out = io.StringIO()
+        call_command('rebuild_archive', stdout=out)
+        self.assertIn('Rebuilt 9 archive buckets', out.getvalue())
+        self.assertEqual(set(ArchiveBucket.objects.values_list('owner', 'year', 'month', 'day', 'count')), incremental)
+
+    def test_timeline_and_days(self):
+        old = self.make_photo('old')
+        Photo.objects.filter(pk=old.pk).update(created_at=timezone.make_aware(datetime(2020, 3, 14, 12)))
+        self.make_photo('new')
+        archive.rebuild()
+
+        self.assertEqual(archive.timeline(), [
+            {'year': self.now.year, 'count': 1, 'months': [{'month': self.now.month, 'count': 1}]},
+            {'year': 2020, 'count': 1, 'months': [{'month': 3, 'count': 1}]},
+        ])
+        self.assertEqual(archive.days(self.owner.pk, 2020, 3), [(14, 1)])
+        self.assertEqual(archive.timeline(self.other.pk), [])
+
+    def test_period_range(self):
+        start, end = archive.period_range(2020, 12)
+        self.assertEqual((start.date(), end.date()), (date(2020, 12, 1), date(2021, 1, 1)))
+        self.assertEqual(start.utcoffset(), timedelta(hours=8))  # midnight in TIME_ZONE
+        with self.assertRaises(ValueError):
+            archive.period_range(2021, 2, 29)
+
+    def test_pages(self):
+        old = self.make_photo('old-photo', image=True)
+        Photo.objects.filter(pk=old.pk).update(created_at=timezone.make_aware(datetime(2020, 3, 14, 12)))
+        self.make_photo('new-photo', image=True)
+        self.make_photo('private-photo', privacy='private', image=True)
+        archive.rebuild()
+
+        response = self.client.get(reverse('photos:archive'))
+        self.assertContains(response, 'new-photo')
+        self.assertContains(response, 'old-photo')
+        self.assertNotContains(response, 'private-photo')
+
+        response = self.client.get(reverse('photos:archive', args=[2020, 3]))
+        self.assertContains(response, 'old-photo')
+        self.assertNotContains(response, 'new-photo')
+        self.assertContains(response, reverse('photos:archive', args=[2020, 3, 14]))
+        self.assertEqual(response.context['period_count'], 1)
+
+        response = self.client.get(reverse('photos:user_archive_grid', args=['owner', 2020]))
+        self.assertContains(response, 'old-photo')
+        self.assertEqual(self.client.get(reverse('photos:user_archive', args=['other', 2020])).context['period_count'], 0)
+
+        self.assertEqual(self.client.get(reverse('photos:archive', args=[2021, 2, 29])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('photos:user_archive', args=['nobody'])).status_code, 404)
+
+
+class SyndicationTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tag = PhotoTag.objects.create(name='sea')
+        self.category = PhotoCategory.objects.create(name='風景')
+        self.photos = [self.make_photo(f'photo {i}', category=self.category) for i in range(3)]
+        self.hidden = self.make_photo('hidden', privacy='friends', category=self.category)
+        for photo in (*self.photos, self.hidden):
+            photo.tags.add(self.tag)
+
+    def get(self, url, **headers):
+        response = self.client.get(url, **headers)
+        if response.streaming:
+            return response, async_to_sync(read_streaming)(response).decode()
+        return response, response.content.decode()
+
+    def test_robots_txt_points_at_the_sitemap(self):
+        _, body = self.get(reverse('photos:robots_txt'))
+        self.assertIn('Sitemap: http://testserver/sitemap.xml', body)
+
+    def test_sitemap_shards_hold_public_photos_only(self):
+        pks = [photo.pk for photo in self.photos]
+        with mock.patch.object(syndication, 'SITEMAP_SHARD_SIZE', 2):
+            _, index = self.get(reverse('photos:sitemap_index'))
+            shards = sorted({pk // 2 for pk in pks})
+            for shard in shards:
+                self.assertIn(f'<loc>http://testserver/sitemap-{shard}.xml</loc>', index)
+            self.assertEqual(index.count('<sitemap>'), len(shards))
+
+            listed = []
+            for shard in shards:
+                response, body = self.get(reverse('photos:sitemap', args=[shard]))
+                self.assertEqual(response['Content-Type'], 'application/xml')
+                listed += [pk for pk in (*pks, self.hidden.pk)
+                           if f'<loc>http://testserver{reverse("photos:detail", args=[pk])}</loc>' in body]
+            self.assertEqual(sorted(listed), pks)
+            self.assertEqual(self.client.get(reverse('photos:sitemap', args=[shards[-1] + 1])).status_code, 404)
+
+    def test_shard_is_cached_until_its_range_changes(self):
+        url = reverse('photos:sitemap', args=[0])
+        self.get(url)
+        with mock.patch.object(syndication, 'keyset_batches', side_effect=AssertionError):
+            _, cached = self.get(url)
+        self.assertEqual(cached.count('<url>'), 3)
+
+        self.photos[0].privacy = 'private'
+        self.photos[0].save()
+        _, body = self.get(url)
+        self.assertEqual(body.count('<url>'), 2)
+
+    def test_conditional_get(self):
+        for url in (reverse('photos:sitemap_index'), reverse('photos:sitemap', args=[0]),
+                    reverse('photos:user_feed', args=['owner'])):
+            with self.subTest(url=url):
+                response, _ = self.get(url)
+                self.assertTrue(response['Last-Modified'])
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_atom_feeds(self):
+        self.photos[1].title = 'fish & <chips>'
+        self.photos[1].save()
+        feeds = (
+            reverse('photos:user_feed', args=['owner']),
+            reverse('photos:tag_feed', args=['sea']),
+            reverse('photos:category_feed', args=[self.category.pk]),
+        )
+        for url in feeds:
+            with self.subTest(url=url):
+                response, body = self.get(url)
+                self.assertEqual(response['Content-Type'], 'application/atom+xml; charset=utf-8')
+                self.assertEqual(body.count('<entry>'), 3)
+                self.assertIn('<title>fish &amp; &lt;chips&gt;</title>', body)
+                self.assertNotIn('hidden', body)
+                # Newest first
+                self.assertLess(body.index('photo 2'), body.index('photo 0'))
+
+    def test_feed_entries_are_capped_and_link_thumbnails(self):
+        photo = self.make_photo('with image', image=True)
+        with mock.patch.object(syndication, 'FEED_ENTRIES', 1):
+            _, body = self.get(reverse('photos:user_feed', args=['owner']))
+        self.assertEqual(body.count('<entry>'), 1)
+        self.assertIn(f'http://testserver{reverse("photos:detail", args=[photo.pk])}', body)
+        self.assertIn(f'&lt;img src="http://testserver{photo.thumbnail.url}"', body)
+
+    def test_unknown_feeds(self):
+        for url in (reverse('photos:user_feed', args=['nobody']), reverse('photos:tag_feed', args=['nothing']),
+                    reverse('photos:category_feed', args=[self.category.pk + 1])):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class ExportTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.photos = [self.make_photo(f'photo {i}', image=True) for i in range(3)]
+        self.client.force_login(self.owner)
+        self.url = reverse('photos:export')
+
+    def download(self, **headers):
+        response = self.client.get(self.url, **headers)
+        return response, async_to_sync(read_streaming)(response)
+
+    def test_full_download_is_a_valid_zip(self):
+        response, data = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(response['Content-Length']), len(data))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip())
+            manifest = json.loads(archive.read('manifest.json'))
+            self.assertEqual([entry['id'] for entry in manifest['photos']], [p.pk for p in self.photos])
+            for photo, entry in zip(self.photos, manifest['photos']):
+                with photo.image.open('rb') as f:
+                    self.assertEqual(archive.read(entry['file']), f.read())
+
+    def test_range_requests(self):
+        response, data = self.download()
+        etag = response['ETag']
+
+        response, part = self.download(HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(data)}')
+        self.assertEqual(part, data[100:200])
+
+        response, part = self.download(HTTP_RANGE='bytes=-50', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(part, data[-50:])
+
+        response, part = self.download(HTTP_RANGE='bytes=1000-', HTTP_IF_RANGE=etag)
+        self.assertEqual(part, data[1000:])
+
+    def test_unsatisfiable_range(self):
+        response, data = self.download()
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(data)}')
+
+    def test_stale_if_range_sends_the_whole_archive(self):
+        response, data = self.download(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data), int(response['Content-Length']))
+
+    def test_requires_login(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    def test_sizes_come_from_storage(self):
+        Photo.objects.filter(pk=self.photos[0].pk).update(file_size=1)
+        response, data = self.download()
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip())
+        self.photos[0].refresh_from_db()
+        self.assertEqual(self.photos[0].file_size, self.photos[0].image.size)
+
+    def test_range_before_a_descriptor_skips_its_crc(self):
+        cache.clear()
+        archive = export.build_archive(self.owner)
+        entry = archive.entries[1]
+        stop = entry.offset + len(entry.local_header()) + 10
+        with mock.patch.object(export.PhotoArchive, '_ensure_crc') as ensure_crc:
+            b''.join(archive.iter_bytes(0, stop))
+        self.assertNotIn(mock.call(entry), ensure_crc.call_args_list)
+
+
+@override_settings(UPLOAD_ADMISSION=True, UPLOAD_USER_BURST=1, UPLOAD_USER_RATE_PER_MINUTE=1,
+                   UPLOAD_GLOBAL_BURST=100, UPLOAD_GLOBAL_RATE_PER_MINUTE=100, UPLOAD_MAX_CONCURRENT=1)
+class AdmissionTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.owner)
+
+    def upload(self, url=None, **data):
+        return self.client.post(url or reverse('photos:upload'),
+                                {'title': 'upload', 'privacy': 'private', 'image': image_upload(), **data})
+
+    def test_over_budget_upload_is_rejected(self):
+        self.assertEqual(self.upload().status_code, 302)
+        response = self.upload()
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+        self.assertEqual(Photo.objects.count(), 1)
+
+    def test_api_rejection(self):
+        self.assertEqual(self.upload(reverse('photos:api_photos')).status_code, 201)
+        response = self.upload(reverse('photos:api_photos'))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json()['retry_after'], int(response['Retry-After']))
+
+    def test_busy_when_every_slot_is_taken(self):
+        with admit_upload(self.other):
+            response = self.upload()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], str(BUSY_RETRY_AFTER))
+        self.assertEqual(self.upload().status_code, 302)
+
+    @override_settings(UPLOAD_ADMISSION=False)
+    def test_disabled(self):
+        for _ in range(3):
+            self.assertEqual(self.upload().status_code, 302)
+
+    def test_invalid_upload_costs_no_tokens(self):
+        response = self.client.post(reverse('photos:upload'), {'title': 'no image', 'privacy': 'private'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.upload().status_code, 302)
+
+
+class ObjectCacheTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        object_cache._local.clear()
+        self.photo = self.make_photo('cached')
+
+    def detail(self):
+        return object_cache.photo_detail(self.photo.pk)
+
+    def test_snapshot_is_reused(self):
+        self.detail()
+        with self.assertNumQueries(0):
+            detail = self.detail()
+        self.assertEqual(detail.photo.title, 'cached')
+        self.assertEqual(detail.photo.owner.username, 'owner')
+
+    def test_edit_invalidates(self):
+        self.detail()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.photo.title = 'edited'
+            self.photo.save()
+        self.assertEqual(self.detail().photo.title, 'edited')
+
+    def test_uncommitted_edit_keeps_the_snapshot(self):
+        self.detail()
+        self.photo.title = 'edited'
+        self.photo.save()
+        self.assertEqual(self.detail().photo.title, 'cached')
+
+    def test_tagging_invalidates(self):
+        self.detail()
+        tag = PhotoTag.objects.create(name='sea')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.photo.tags.add(tag)
+        self.assertEqual([t.name for t in self.detail().photo.tags.all()], ['sea'])
+
+    def test_taxonomy_rename_invalidates(self):
+        category = PhotoCategory.objects.create(name='old')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.photo.category = category
+            self.photo.save()
+        self.assertEqual(self.detail().photo.category.name, 'old')
+        with self.captureOnCommitCallbacks(execute=True):
+            category.name = 'new'
+            category.save()
+        self.assertEqual(self.detail().photo.category.name, 'new')
+
+    def test_owner_change_invalidates(self):
+        self.detail()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.owner.first_name = 'Ada'
+            self.owner.save()
+        self.assertEqual(self.detail().photo.owner.first_name, 'Ada')
+
+    def test_new_photo_shows_in_related(self):
+        self.detail()
+        with self.captureOnCommitCallbacks(execute=True):
+            other = self.make_photo('sibling')
+        self.assertEqual([p.pk for p in self.detail().related], [other.pk])
+
+    def test_delete_invalidates(self):
+        self.detail()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.photo.delete()
+        self.assertIsNone(object_cache.photo_detail(self.photo.pk))
+
+    def test_upload_bumps_once(self):
+        with mock.patch.object(object_cache, 'bump_photos') as bump:
+            photo = self.make_photo('uploaded', image=True)
+        self.assertEqual(bump.call_count, 1)
+        self.assertTrue(photo.thumbnail)
+        self.assertTrue(photo.placeholder)
+
+
+class JobTests(TestCase):
+    @override_settings(JOBS_EAGER=True)
+    def test_eager_false_always_queues(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue('delete_media', eager=False, names=[])
+        self.assertTrue(Job.objects.filter(name='delete_media', status='pending').exists())
+
+    def test_job_claimed_by_another_worker_is_not_run(self):
+        handler = mock.Mock()
+        first, second = (Job.objects.create(name='probe') for _ in range(2))
+        claim = jobs._claim
+
+        def race(job_id):
+            if job_id == first.pk:
+                # Another worker read the same ids and claimed this one first
+                Job.objects.filter(pk=job_id).update(status='running')
+            return claim(job_id)
+
+        with mock.patch.dict(jobs._handlers, {'probe': handler}), mock.patch.object(jobs, '_claim', race):
+            self.assertEqual(jobs.run_pending(), 1)
+        handler.assert_called_once_with()
+        self.assertEqual(Job.objects.get(pk=second.pk).status, 'done')
+        self.assertEqual(Job.objects.get(pk=first.pk).status, 'running')
+
+    def test_reap_stale_requeues_or_fails_lost_jobs(self):
+        old = timezone.now() - jobs.RUNNING_TIMEOUT - timedelta(minutes=1)
+        lost = Job.objects.create(name='probe', status='running', attempts=1)
+        exhausted = Job.objects.create(name='probe', status='running', attempts=jobs.MAX_ATTEMPTS)
+        busy = Job.objects.create(name='probe', status='running', attempts=1)
+        Job.objects.filter(pk__in=[lost.pk, exhausted.pk]).update(updated_at=old)
+
+        self.assertEqual(jobs.reap_stale(), 2)
+        statuses = dict(Job.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {lost.pk: 'pending', exhausted.pk: 'failed', busy.pk: 'running'})
+
+    def test_purge_done_keeps_recent_and_unfinished_jobs(self):
+        old = timezone.now() - jobs.DONE_RETENTION - timedelta(days=1)
+        expired = Job.objects.create(name='probe', status='done')
+        failed = Job.objects.create(name='probe', status='failed')
+        recent = Job.objects.create(name='probe', status='done')
+        Job.objects.filter(pk__in=[expired.pk, failed.pk]).update(updated_at=old)
+
+        self.assertEqual(jobs.purge_done(), 1)
+        self.assertEqual(set(Job.objects.values_list('pk', flat=True)), {failed.pk, recent.pk})
+
+
+class GcMediaTests(MediaTestCase):
+    def test_deletes_only_unreferenced_files(self):
+        photo = self.make_photo(image=True)
+        storage = photo.image.storage
+        orphan = storage.save('photos/orphan.png', ContentFile(image_bytes()))
+
+        out = io.StringIO()
+        call_command('gc_media', '--dry-run', min_age_hours=0, stdout=out)
+        self.assertIn(orphan, out.getvalue())
+        self.assertTrue(storage.exists(orphan))
+
+        call_command('gc_media', min_age_hours=0, stdout=io.StringIO())
+        self.assertFalse(storage.exists(orphan))
+        self.assertTrue(storage.exists(photo.image.name))
+        self.assertTrue(storage.exists(photo.thumbnail.name))
+
+    def test_recent_files_are_kept(self):
+        orphan = Photo._meta.get_field('image').storage.save('photos/orphan.png', ContentFile(image_bytes()))
+        call_command('gc_media', stdout=io.StringIO())
+        self.assertTrue(Photo._meta.get_field('image').storage.exists(orphan))
@@ -0,0 +1,101 @@
+"""Time-decayed "trending" scores.
+
+A photo's score is the sum of its views, each weighted by
+``0.5 ** (age / HALF_LIFE)``. Because every weight decays at the same rate,
+scores are stored anchored to the fixed ``EPOCH`` and in log space::
+
+    trending_score = log(sum(views_i * 2 ** ((t_i - EPOCH) / HALF_LIFE)))
+
+Ordering by this column equals ordering by the decayed score at any moment,
+so existing scores never need rewriting as time passes: a batch only touches
+photos that gained views since the last run (or were never scored), adding
+the new views at the current time with ``logaddexp``. The upload itself
+counts as ``UPLOAD_WEIGHT`` views, so new photos start near the top and sink
+unless they keep being viewed. View timestamps are not recorded, so views
+found on a photo's first scoring are attributed to its upload time.
+"""
+import math
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.db.models import F, Q
+
+from .models import Photo
+
+EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+HALF_LIFE = timedelta(hours=24)
+UPLOAD_WEIGHT = 1.0
+
+# log(2) / half-life, per second
+_RATE = math.log(2) / HALF_LIFE.total_seconds()
+
+
+def anchored_log_weight(timestamps):
+    """``log(2 ** ((t - EPOCH) / HALF_LIFE))`` for an array of epoch seconds"""
+    return (np.asarray(timestamps, dtype=np.float64) - EPOCH.timestamp()) * _RATE
+
+
+def compute_scores(scores, created, views, scored_views, now):
+    """Vectorised score update for one batch.
+
+    ``scores`` holds the current log scores (``NaN`` when never scored),
+    ``created`` upload times as epoch seconds, ``views`` the current view
+    counts and ``scored_views`` the counts already included in ``scores``.
+    Returns the new log scores.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    views = np.asarray(views, dtype=np.float64)
+    scored_views = np.asarray(scored_views, dtype=np.float64)
+
+    fresh = np.isnan(scores)
+    # Never scored: the upload plus every view so far, at upload time
+    base = np.where(
+        fresh,
+        np.log(UPLOAD_WEIGHT + views) + anchored_log_weight(created),
+        scores,
+    )
+    # Already scored: new views since the last run, at the current time
+    delta = np.where(fresh, 0.0, views - scored_views)
+    with np.errstate(divide='ignore'):
+        added = np.log(np.maximum(delta, 0.0)) + anchored_log_weight(now)
+    return np.logaddexp(base, added)
+
+
+def update_scores(batch_size=5000, reset=False, now=None, progress=None):
+    """Score every photo that is new or gained views; returns rows updated"""
+    now = (now or datetime.now(dt_timezone.utc)).timestamp()
+    photos = Photo.objects.order_by('pk')
+    if not reset:
+        photos = photos.filter(Q(trending_score__isnull=True) | Q(view_count__gt=F('trending_views')))
+
+    updated = 0
+    last_pk = 0
+    while True:
+        rows = list(photos.filter(pk__gt=last_pk).values_list(
+            'pk', 'created_at', 'view_count', 'trending_views', 'trending_score')[:batch_size])
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+
+        pks, created, views, scored_views, scores = zip(*rows)
+        scores = [None if reset else score for score in scores]
+        new_scores = compute_scores(
+            np.array(scores, dtype=np.float64),
+            [c.timestamp() for c in created], views, scored_views, now,
+        )
+        Photo.objects.bulk_update(
+            [Photo(pk=pk, trending_score=float(score), trending_views=view_count)
+             for pk, score, view_count in zip(pks, new_scores, views)],
+            ['trending_score', 'trending_views'],
+        )
+        updated += len(rows)
+        if progress:
+            progress(updated, last_pk)
+    return updated
+
+
+def trending(queryset=None, limit=48):
+    """Top ``limit`` public photos by trending score (an indexed top-N read)"""
+    queryset = Photo.objects.all() if queryset is None else queryset
+    return (queryset.filter(privacy='public', trending_score__isnull=False)
+            .order_by('-trending_score')[:limit])
@@ -1,15 +1,50 @@
 from django.urls import path
-from . import views
+from . import api, export, syndication, views
 
 app_name = 'photos'
 
+ARCHIVE_PERIODS = ('', '<int:year>/', '<int:year>/<int:month>/', '<int:year>/<int:month>/<int:day>/')
+
 urlpatterns = [
     path('', views.photo_list, name='home'),
+    path('grid/', views.photo_list, {'fragment': True}, name='home_grid'),
     path('upload/', views.photo_upload, name='upload'),
     path('<int:photo_id>/', views.photo_detail, name='detail'),
     path('<int:photo_id>/edit/', views.photo_edit, name='edit'),
     path('<int:photo_id>/delete/', views.photo_delete, name='delete'),
+    path('<int:photo_id>/image/', views.photo_media, name='media'),
+    path('<int:photo_id>/thumbnail/', views.photo_media, {'variant': 'thumbnail'}, name='media_thumbnail'),
+    path('trending/', views.trending_photos, name='trending'),
+    path('feed/', views.feed, name='feed'),
     path('my-photos/', views.my_photos, name='my_photos'),
+    path('my-photos/grid/', views.my_photos, {'fragment': True}, name='my_photos_grid'),
+    path('my-photos/export.zip', export.download, name='export'),
     path('category/<int:category_id>/', views.category_photos, name='category'),
+    path('category/<int:category_id>/grid/', views.category_photos, {'fragment': True}, name='category_grid'),
     path('tag/<str:tag_name>/', views.tag_photos, name='tag'),
+    path('tag/<str:tag_name>/grid/', views.tag_photos, {'fragment': True}, name='tag_grid'),
+
+    # Sitemaps and Atom feeds
+    path('robots.txt', syndication.robots_txt, name='robots_txt'),
+    path('sitemap.xml', syndication.sitemap_index, name='sitemap_index'),
+    path('sitemap-<int:shard>.xml', syndication.sitemap, name='sitemap'),
+    path('user/<str:username>/feed.atom', syndication.user_feed, name='user_feed'),
+    path('tag/<str:tag_name>/feed.atom', syndication.tag_feed, name='tag_feed'),
+    path('category/<int:category_id>/feed.atom', syndication.category_feed, name='category_feed'),
+
+    # JSON API
+    path('api/photos/', api.photo_collection, name='api_photos'),
+    path('api/photos/<int:photo_id>/', api.photo_item, name='api_photo'),
+    path('api/feed/', api.feed, name='api_feed'),
+    path('api/tags/', api.tag_list, name='api_tags'),
+    path('api/tags/autocomplete/', api.tag_autocomplete, name='api_tag_autocomplete'),
+    path('api/categories/', api.category_list, name='api_categories'),
 ]
+
+# Date archive: archive/[<year>/[<month>/[<day>/]]], globally or per user
+for prefix, name in (('archive/', 'archive'), ('user/<str:username>/archive/', 'user_archive')):
+    for period in ARCHIVE_PERIODS:
+        urlpatterns += [
+            path(prefix + period, views.photo_archive, name=name),
+            path(prefix + period + 'grid/', views.photo_archive, {'fragment': True}, name=f'{name}_grid'),
+        ]
@@ -1,98 +1,229 @@
+import hashlib
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.core.paginator import Paginator
-from django.http import Http404
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
+from photoalbum.instrumentation import record_cache
+from . import archive, object_cache, search
+from .admission import UploadRejected, admit_upload
+from .aio import aget_object_or_404, alogin_required, arender, get_user, stream_file
+from .feed import feed_page
 from .models import Photo, PhotoCategory, PhotoTag
+from .pagination import InvalidCursor, cursor_page
+from .trending import trending
 from .forms import PhotoUploadForm, PhotoEditForm
-from django.db.models import Q
+
+GRID_PAGE_SIZE = 12
+# Anonymous viewers all see the same public photos, so their fragments are shared
+GRID_FRAGMENT_CACHE_TIMEOUT = 60
+
+
+async def _grid_page(request, photos):
+    """The cursor page of ``photos`` that ``?cursor=`` points at"""
+    try:
+        return await sync_to_async(cursor_page)(photos, request.GET.get('cursor'), GRID_PAGE_SIZE)
+    except InvalidCursor:
+        raise Http404('無效的分頁。')
+
+
+def _grid_context(request, page, fragment_url, card=None):
+    """Context for a photo grid page and its "load more" link"""
+    query = request.GET.copy()
+    query['cursor'] = page.next_cursor or ''
+    return {'page': page, 'card': card, 'fragment_url': fragment_url, 'next_query': query.urlencode()}
 
 
-def photo_list(request):
-    """Display all public photos and handle optional search queries."""
-    q = request.GET.get('q', '').strip()
+async def _grid_fragment(request, photos, card=None):
+    """Only the cards of the page after ``?cursor=``, for infinite scroll.
 
-    # Base queryset: only public photos
-    photos_qs = Photo.objects.filter(privacy='public')
+    The next cursor is sent in the ``X-Next-Cursor`` header (absent on the
+    last page). Fragments for anonymous viewers are cached per URL.
+    """
+    user = await get_user(request)
+    key = cached = None
+    if not user.is_authenticated:
+        key = 'grid_fragment:' + hashlib.md5(request.get_full_path().encode()).hexdigest()
+        cached = await cache.aget(key)
+        record_cache('grid_fragment', cached is not None)
+    if cached is None:
+        page = await _grid_page(request, photos)
+        html = await sync_to_async(render_to_string)(
+            'photos/includes/photo_grid.html', {'page': page, 'card': card}, request)
+        cached = (html, page.next_cursor)
+        if key:
+            await cache.aset(key, cached, GRID_FRAGMENT_CACHE_TIMEOUT)
+
+    html, next_cursor = cached
+    response = HttpResponse(html)
+    if next_cursor:
+        response['X-Next-Cursor'] = next_cursor
+    return response
+
+
+async def photo_list(request, fragment=False):
+    """Display all public photos and handle optional search queries and filters."""
+    q = search.normalize_query(request.GET.get('q', ''))
+    filters = search.parse_filters(request.GET)
+    user = await get_user(request)
+
+    # Base queryset: public photos plus the viewer's own and friends' photos
+    photos_qs = Photo.objects.visible_to(user)
 
     if q:
         # Search by title, description, owner username, category name, or tag name
-        photos_qs = photos_qs.filter(
-            Q(title__icontains=q)
-            | Q(description__icontains=q)
-            | Q(owner__username__icontains=q)
-            | Q(category__name__icontains=q)
-            | Q(tags__name__icontains=q)
-        ).distinct()
+        photos_qs = search.search(photos_qs, q)
+    photos_qs = search.apply_filters(photos_qs, filters)
 
-    photos = photos_qs.order_by('-created_at')
+    photos = photos_qs.select_related('owner').prefetch_related('tags')
+    if fragment:
+        return await _grid_fragment(request, photos, card='explore')
 
-    # Pagination
-    paginator = Paginator(photos, 12)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page = await _grid_page(request, photos)
 
     # Get categories
-    categories = PhotoCategory.objects.all()
+    categories = [category async for category in PhotoCategory.objects.all()]
+
+    facets = search_count = None
+    if q:
+        facets = await sync_to_async(search.facet_counts)(photos_qs, user, q, filters)
+        # Shown as "5000+" past the cap, and left out when the time budget ran out
+        if facets:
+            search_count = f"{facets['total']}+" if facets['truncated'] else facets['total']
+    facet_groups, active_filters = search.facet_links(
+        request.GET, facets, filters, {category.pk: category.name for category in categories})
 
     context = {
-        'page_obj': page_obj,
+        **_grid_context(request, page, reverse('photos:home_grid'), card='explore'),
         'categories': categories,
         'search_query': q,
-        'search_count': photos.count() if q else None,
+        'search_count': search_count,
+        'facet_groups': facet_groups,
+        'active_filters': active_filters,
     }
 
-    return render(request, 'photos/photo_list.html', context)
+    return await arender(request, 'photos/photo_list.html', context)
 
 
-@login_required(login_url='accounts:login')
-def photo_upload(request):
+@alogin_required
+async def photo_upload(request):
     """Upload a new photo"""
     if request.method == 'POST':
-        form = PhotoUploadForm(request.POST, request.FILES)
-        if form.is_valid():
-            photo = form.save(commit=False)
-            photo.owner = request.user
-            photo.save()
-            form.save_m2m()
+        # Parsing the upload, image processing and storage writes all block,
+        # so the whole finalisation step runs in a worker thread.
+        try:
+            form, photo = await sync_to_async(_finalise_upload)(request)
+        except UploadRejected as e:
+            messages.error(request, f'上傳太頻繁，請於 {e.retry_after} 秒後再試。')
+            response = await arender(request, 'photos/photo_upload.html', {'form': PhotoUploadForm()}, status=429)
+            response['Retry-After'] = str(e.retry_after)
+            return response
+        if photo is not None:
             messages.success(request, '照片已成功上傳！')
             return redirect('photos:detail', photo_id=photo.id)
-        else:
-            for field, errors in form.errors.items():
-                for error in errors:
-                    messages.error(request, f'{field}: {error}')
+        for field, errors in form.errors.items():
+            for error in errors:
+                messages.error(request, f'{field}: {error}')
     else:
         form = PhotoUploadForm()
-    
-    return render(request, 'photos/photo_upload.html', {'form': form})
 
+    return await arender(request, 'photos/photo_upload.html', {'form': form})
 
-def photo_detail(request, photo_id):
-    """View photo details"""
-    photo = get_object_or_404(Photo, pk=photo_id)
-    
-    # Check privacy settings
-    if photo.privacy == 'private' and photo.owner != request.user:
-        raise Http404('此照片不公開。')
-    elif photo.privacy == 'friends' and photo.owner != request.user:
-        # TODO: Implement friend check
+
+def _finalise_upload(request):
+    """Validate and save an uploaded photo, returning ``(form, photo or None)``.
+
+    Raises ``UploadRejected`` before a valid upload is processed when over
+    budget; an invalid one is returned with its errors and costs no tokens.
+    """
+    with admit_upload(request.user) as charge:
+        form = PhotoUploadForm(request.POST, request.FILES)
+        if not form.is_valid():
+            return form, None
+        charge()
+        form.instance.owner = request.user
+        return form, form.save()
+
+
+async def _get_viewable_photo(request, photo_id, queryset=None):
+    """Fetch a photo and enforce its privacy setting"""
+    photo = await aget_object_or_404(Photo if queryset is None else queryset, pk=photo_id)
+    await _ensure_visible(request, photo)
+    return photo
+
+
+async def _ensure_visible(request, photo):
+    user = await get_user(request)
+
+    # Check privacy settings (the friend set is cached, so this rarely queries)
+    if photo.privacy == 'public' or await sync_to_async(photo.is_visible_to)(user):
+        return
+    if photo.privacy == 'friends':
         raise Http404('此照片僅限朋友查看。')
-    
+    raise Http404('此照片不公開。')
+
+
+def _related_photos(detail, user):
+    """Up to four other photos of the owner that ``user`` may see"""
+    related = [photo for photo in detail.related if photo.is_visible_to(user)][:4]
+    if len(related) < 4 and not detail.related_complete:
+        # Older photos than the cached ones may be visible
+        related = list(Photo.objects.visible_to(user).filter(owner_id=detail.photo.owner_id)
+                       .exclude(id=detail.photo.id)[:4])
+    return related
+
+
+async def photo_detail(request, photo_id):
+    """View photo details"""
+    # Photo, owner, category and tags come from the object cache
+    detail = await sync_to_async(object_cache.photo_detail)(photo_id)
+    if detail is None:
+        raise Http404('找不到此照片。')
+    photo = detail.photo
+    await _ensure_visible(request, photo)
+
     # Increment view count
-    photo.increment_view_count()
-    
-    # Get related photos
-    related_photos = Photo.objects.filter(
-        owner=photo.owner,
-        privacy='public'
-    ).exclude(id=photo.id)[:4]
-    
+    await photo.aincrement_view_count()
+
+    user = await get_user(request)
     context = {
         'photo': photo,
-        'related_photos': related_photos,
+        'avatar_url': detail.avatar_url,
+        'related_photos': await sync_to_async(_related_photos)(detail, user),
     }
-    
-    return render(request, 'photos/photo_detail.html', context)
+
+    return await arender(request, 'photos/photo_detail.html', context)
+
+
+async def photo_media(request, photo_id, variant='image'):
+    """Stream a photo's original or thumbnail from storage, honouring privacy"""
+    photo = await _get_viewable_photo(request, photo_id)
+    field = photo.thumbnail if variant == 'thumbnail' and photo.thumbnail else photo.image
+    if not field:
+        raise Http404
+
+    response = StreamingHttpResponse(stream_file(field), content_type=_content_type(field.name))
+    if photo.privacy == 'public':
+        response['Cache-Control'] = 'public, max-age=86400'
+    else:
+        response['Cache-Control'] = 'private, max-age=3600'
+    return response
+
+
+def _content_type(name):
+    extension = name.rsplit('.', 1)[-1].lower()
+    return {
+        'jpg': 'image/jpeg',
+        'jpeg': 'image/jpeg',
+        'png': 'image/png',
+        'gif': 'image/gif',
+        'webp': 'image/webp',
+    }.get(extension, 'application/octet-stream')
 
 
 @login_required(login_url='accounts:login')
@@ -139,61 +270,142 @@ def photo_delete(request, photo_id):
     return render(request, 'photos/photo_delete.html', {'photo': photo})
 
 
-@login_required(login_url='accounts:login')
-def my_photos(request):
+async def trending_photos(request):
+    """Public photos ranked by time-decayed popularity"""
+    photos = Photo.objects.select_related('owner')
+    category = tag = None
+    if request.GET.get('category', '').isdigit():
+        category = await aget_object_or_404(PhotoCategory, pk=request.GET['category'])
+        photos = photos.filter(category=category)
+    if request.GET.get('tag'):
+        tag = await aget_object_or_404(PhotoTag, name=request.GET['tag'])
+        photos = photos.filter(tags=tag)
+
+    context = {
+        'photos': [photo async for photo in trending(photos)],
+        'categories': [c async for c in PhotoCategory.objects.all()],
+        'category': category,
+        'tag': tag,
+    }
+    return await arender(request, 'photos/trending.html', context)
+
+
+def _archive_url(owner, *period, fragment=False):
+    name = ('photos:user_archive' if owner else 'photos:archive') + ('_grid' if fragment else '')
+    return reverse(name, args=([owner.username] if owner else []) + [part for part in period if part])
+
+
+async def photo_archive(request, year=None, month=None, day=None, username=None, fragment=False):
+    """Public photos by upload date, of everyone or of one user"""
+    owner = await aget_object_or_404(User, username=username) if username else None
+    photos = Photo.objects.filter(privacy='public').select_related('owner')
+    if owner:
+        photos = photos.filter(owner=owner)
+    if year is not None:
+        try:
+            start, end = archive.period_range(year, month, day)
+        except ValueError:
+            raise Http404('無效的日期。')
+        # A range read on the (privacy | owner, -created_at) index
+        photos = photos.filter(created_at__gte=start, created_at__lt=end)
+    if fragment:
+        return await _grid_fragment(request, photos)
+
+    page = await _grid_page(request, photos)
+
+    owner_id = owner.pk if owner else None
+    timeline = await sync_to_async(archive.timeline)(owner_id)
+    for entry in timeline:
+        entry['url'] = _archive_url(owner, entry['year'])
+        for month_entry in entry['months']:
+            month_entry['url'] = _archive_url(owner, entry['year'], month_entry['month'])
+    days = []
+    if month:
+        days = [
+            {'day': d, 'count': count, 'url': _archive_url(owner, year, month, d)}
+            for d, count in await sync_to_async(archive.days)(owner_id, year, month)
+        ]
+
+    context = {
+        **_grid_context(request, page, _archive_url(owner, year, month, day, fragment=True)),
+        'archive_owner': owner,
+        'archive_url': _archive_url(owner),
+        'year': year,
+        'month': month,
+        'day': day,
+        'period_count': await sync_to_async(archive.period_count)(owner_id, year, month, day) if year else None,
+        'timeline': timeline,
+        'days': days,
+    }
+    return await arender(request, 'photos/archive.html', context)
+
+
+@alogin_required
+async def feed(request):
+    """Photos from the user and their friends, newest first"""
+    user = await get_user(request)
+    try:
+        page = await sync_to_async(feed_page)(user, request.GET.get('cursor'), 12)
+    except InvalidCursor:
+        raise Http404('無效的分頁。')
+    return await arender(request, 'photos/feed.html', {'page': page})
+
+
+@alogin_required
+async def my_photos(request, fragment=False):
     """View user's own photos"""
-    photos = request.user.photos.order_by('-created_at')
-    
-    # Pagination
-    paginator = Paginator(photos, 12)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-    
+    user = await get_user(request)
+    photos = user.photos.all()
+    if fragment:
+        return await _grid_fragment(request, photos, card='owner')
+
+    page = await _grid_page(request, photos)
+
     context = {
-        'page_obj': page_obj,
+        **_grid_context(request, page, reverse('photos:my_photos_grid'), card='owner'),
+        'photo_count': await photos.acount(),
         'is_owner': True,
     }
-    
-    return render(request, 'photos/my_photos.html', context)
+
+    return await arender(request, 'photos/my_photos.html', context)
 
 
-def category_photos(request, category_id):
+async def category_photos(request, category_id, fragment=False):
     """View photos in a specific category"""
-    category = get_object_or_404(PhotoCategory, pk=category_id)
-    photos = Photo.objects.filter(
+    category = await aget_object_or_404(PhotoCategory, pk=category_id)
+    user = await get_user(request)
+    photos = Photo.objects.visible_to(user).filter(
         category=category,
-        privacy='public'
-    ).order_by('-created_at')
-    
-    # Pagination
-    paginator = Paginator(photos, 12)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-    
+    ).select_related('owner')
+    if fragment:
+        return await _grid_fragment(request, photos)
+
+    page = await _grid_page(request, photos)
+
     context = {
+        **_grid_context(request, page, reverse('photos:category_grid', args=[category.pk])),
         'category': category,
-        'page_obj': page_obj,
     }
-    
-    return render(request, 'photos/category_photos.html', context)
 
+    return await arender(request, 'photos/category_photos.html', context)
 
-def tag_photos(request, tag_name):
+
+async def tag_photos(request, tag_name, fragment=False):
     """View photos with a specific tag"""
-    tag = get_object_or_404(PhotoTag, name=tag_name)
-    photos = Photo.objects.filter(
+    tag = await aget_object_or_404(PhotoTag, name=tag_name)
+    user = await get_user(request)
+    photos = Photo.objects.visible_to(user).filter(
         tags=tag,
-        privacy='public'
-    ).order_by('-created_at')
-    
-    # Pagination
-    paginator = Paginator(photos, 12)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-    
+    ).select_related('owner')
+    if fragment:
+        return await _grid_fragment(request, photos)
+
+    page = await _grid_page(request, photos)
+
     context = {
+        **_grid_context(request, page, reverse('photos:tag_grid', args=[tag.name])),
         'tag': tag,
-        'page_obj': page_obj,
+        'photo_count': await photos.acount(),
     }
-    
-    return render(request, 'photos/tag_photos.html', context)
+
+    return await arender(request, 'photos/tag_photos.html', context)